@@ -0,0 +1,127 @@
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from skimage.measure import label
+
+
+def get_erosion_depths(labeled_img):
+    # Number of erosions by diamond(1) that each fiber pixel survives, plus one. This is its city block distance to
+    # the nearest pixel outside its fiber. Fibers never touch, so that is the nearest background pixel. The image
+    # is padded so that fibers on its edge erode from that side too. Background pixels are 0.
+    padded = np.pad(labeled_img > 0, 1, mode='constant')
+    return ndimage.distance_transform_cdt(padded, metric='taxicab')[1:-1, 1:-1]
+
+
+def erode_fibers(labeled_img, states, erosion_percentage, depths=None):
+    # Erodes every fiber with state 1 until it has lost erosion_percentage of its area, the same result as eroding
+    # each one with diamond(1) until it is small enough. Returns an image where the eroded fibers are marked as 1.
+    # depths is the output of get_erosion_depths. Once it is computed, any erosion percentage is a per-fiber
+    # threshold on it.
+    if depths is None:
+        depths = get_erosion_depths(labeled_img)
+    n_rois = len(states)
+    inside = labeled_img > 0
+    labels = labeled_img[inside].astype(np.int64)
+    pixel_depths = depths[inside]
+    n_depths = int(np.max(pixel_depths, initial=0)) + 1
+
+    # survivors[i, k] is the area of fiber i after k erosions
+    histogram = np.bincount(labels * n_depths + pixel_depths, minlength=(n_rois + 1) * n_depths)
+    survivors = np.cumsum(histogram.reshape(n_rois + 1, n_depths)[:, ::-1], 1)[:, ::-1]
+    survivors = np.c_[survivors[:, 1:], np.zeros(n_rois + 1, dtype=survivors.dtype)]
+    targetarea = survivors[:, 0] * (100 - erosion_percentage) * .01
+    n_erosions = np.sum(survivors > targetarea[:, np.newaxis], 1)
+
+    eroded = (targetarea > 10) & np.r_[False, states == 1]
+    eroded_img = np.zeros(labeled_img.shape, dtype=np.uint8)
+    eroded_img[inside] = eroded[labels] & (pixel_depths > n_erosions[labels])
+    return eroded_img
+
+
+def get_nucleus_contingency(labeled_img, eroded_img, dapi_binarized_img, n_rois=None):
+    # Sparse (n_rois, n_nuclei) matrix where entry (i, j) is the number of pixels of the eroded interior of fiber i
+    # (label i + 1) that lie inside DAPI nucleus j. Nuclei are the 8-connected components of the DAPI image.
+    if n_rois is None:
+        n_rois = int(np.max(labeled_img))
+    nuclei = label(dapi_binarized_img > 0, connectivity=2)
+    overlap = (eroded_img > 0) & (nuclei > 0) & (labeled_img > 0)
+    fibers = labeled_img[overlap] - 1
+    nucleus_nums = nuclei[overlap] - 1
+    contingency = coo_matrix((np.ones(len(fibers), dtype=np.int64), (fibers, nucleus_nums)),
+                             shape=(n_rois, int(np.max(nuclei))))
+    # Converting sums the pixels of each (fiber, nucleus) pair
+    return contingency.tocsr()
+
+
+def get_central_nuclei_counts(contingency):
+    # Number of nuclei touching the eroded interior of each fiber, and the area they cover
+    contingency.sum_duplicates()
+    n_nuclei = np.diff(contingency.indptr)
+    overlap_areas = np.asarray(contingency.sum(1)).ravel()
+    return n_nuclei, overlap_areas
+
+
+def find_central_nuclei(labeled_img, eroded_img, dapi_binarized_img, states, contingency=None):
+    # Marks every fiber with state 1 whose eroded interior overlaps a DAPI nucleus as a CNF (state 3)
+    if contingency is None:
+        contingency = get_nucleus_contingency(labeled_img, eroded_img, dapi_binarized_img, len(states))
+    n_nuclei, overlap_areas = get_central_nuclei_counts(contingency)
+    states = np.copy(states)
+    states[(n_nuclei > 0) & (states == 1)] = 3
+    return states
+
+
+# Percentiles of the fiber intensities reported by get_channel_intensity_stats
+INTENSITY_PERCENTILES = (10, 25, 75, 90)
+
+
+def get_channel_intensity_stats(labeled_img, channels, percentiles=INTENSITY_PERCENTILES, n_rois=None):
+    # Intensity statistics of every fiber in every channel of a stack, e.g. a (n_channels, mx, my) memory-mapped
+    # stack from stacks.open_channel_stack, from a single sort of the fiber pixels. The label image is traversed
+    # once, and each channel is read once. Returns one dict per channel of arrays indexed by ROI number: area,
+    # integrated_intensity, mean_intensity, median_intensity and intensity_p<q> for each percentile q. Percentiles
+    # interpolate linearly, like np.percentile.
+    if n_rois is None:
+        n_rois = int(np.max(labeled_img))
+    inside = labeled_img > 0
+    labels = labeled_img[inside]
+    area = np.bincount(labels, minlength=n_rois + 1)[1:]
+    # Fiber i occupies sorted_values[starts[i]:starts[i] + area[i]]
+    starts = np.cumsum(area) - area
+    last = np.maximum(area - 1, 0)
+
+    def percentile(sorted_values, q):
+        if len(sorted_values) == 0:
+            return np.zeros(n_rois)
+        position = last * q / 100.
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, last)
+        low = sorted_values[np.minimum(starts + lower, len(sorted_values) - 1)]
+        high = sorted_values[np.minimum(starts + upper, len(sorted_values) - 1)]
+        return np.where(area > 0, low + (high - low) * (position - lower), 0)
+
+    channel_stats = []
+    for channel in channels:
+        values = np.asarray(channel)[inside].astype(np.float64)
+        sorted_values = values[np.lexsort((values, labels))]
+        integrated = np.bincount(labels, weights=values, minlength=n_rois + 1)[1:]
+        stats = {'area': area,
+                 'integrated_intensity': integrated,
+                 'mean_intensity': integrated / np.maximum(area, 1),
+                 'median_intensity': percentile(sorted_values, 50)}
+        for q in percentiles:
+            stats['intensity_p{}'.format(q)] = percentile(sorted_values, q)
+        channel_stats.append(stats)
+    return channel_stats
+
+
+def subtract_background(intensities, subtractionvalue):
+    # Background-subtracted MFI. Fibers dimmer than the background are reported as 0.
+    return np.maximum(np.asarray(intensities, dtype=np.float64) - subtractionvalue, 0)
+
+
+def find_positive_fibers(intensities, states, lowest_mfi_value):
+    # Every fiber that is not red and whose MFI is at least lowest_mfi_value is positive (state 3)
+    positive_states = np.copy(states)
+    positive_states[(states != 2) & (intensities >= lowest_mfi_value)] = 3
+    return positive_states
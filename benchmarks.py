@@ -0,0 +1,523 @@
+"""
+Benchmarks for the Qt-free parts of Quantimus.
+
+From the directory containing the plugin:
+    python -m quantimus.benchmarks <name> [<name> ...]
+
+Run without a name to list the available benchmarks. The classifiers benchmark also scores the training data in
+QUANTIMUS_TRAINING_DATA, if it is set.
+"""
+import sys
+import time
+import numpy as np
+from skimage import measure
+from skimage.draw import ellipse, polygon
+
+
+def make_label_image(n_rois=400, roi_size=40, seed=0):
+    # Label image of randomly sized and rotated ellipses and rectangles on a grid, one per cell
+    rng = np.random.RandomState(seed)
+    side = int(np.ceil(np.sqrt(n_rois)))
+    label_img = np.zeros((side * roi_size, side * roi_size), dtype=np.int32)
+    for i in range(n_rois):
+        cx, cy = (np.array(divmod(i, side)) + .5) * roi_size
+        a, b = rng.uniform(2, roi_size / 2 - 1, 2)
+        theta = rng.uniform(0, np.pi)
+        if i % 2:
+            rr, cc = ellipse(cx, cy, a, b, shape=label_img.shape, rotation=theta)
+        else:
+            corners = np.array([[-a, -b], [-a, b], [a, b], [a, -b]]) / np.sqrt(2)
+            c, s = np.cos(theta), np.sin(theta)
+            corners = np.dot(corners, [[c, s], [-s, c]]) + [cx, cy]
+            rr, cc = polygon(corners[:, 0], corners[:, 1], shape=label_img.shape)
+        label_img[rr, cc] = i + 1
+    return measure.label(label_img > 0, connectivity=2)
+
+
+def _time(f, *args):
+    t = time.time()
+    result = f(*args)
+    return result, time.time() - t
+
+
+def _contour_min_feret_diameters(props):
+    # The previous method: rotate the contour of each convex image through 157 angles and keep the narrowest box
+    min_feret_diameters = []
+    thetas = np.arange(0, np.pi / 2, .01)
+    rs = [np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]]) for theta in thetas]
+    for prop in props:
+        if np.all(prop.convex_image):
+            min_feret_diameters.append(len(prop.convex_image.shape))
+        else:
+            coordinates = np.vstack(measure.find_contours(prop.convex_image, 0.5, fully_connected='high'))
+            coordinates -= np.mean(coordinates, 0)
+            diams = []
+            for r in rs:
+                newcoords = np.dot(coordinates, r.T)
+                w, h = np.max(newcoords, 0) - np.min(newcoords, 0)
+                diams.extend([w, h])
+            min_feret_diameters.append(np.min(diams))
+    return np.array(min_feret_diameters)
+
+
+def _swept_min_feret_diameters(hulls, n_angles=20000):
+    # Width of every hull over a dense sweep of directions. Always at least the true minimum.
+    points, bounds = hulls
+    thetas = np.linspace(0, np.pi, n_angles, endpoint=False)
+    directions = np.array([np.cos(thetas), np.sin(thetas)])
+    widths = []
+    for i in range(len(bounds) - 1):
+        projections = np.dot(points[bounds[i]:bounds[i + 1]], directions)
+        widths.append(np.min(np.max(projections, 0) - np.min(projections, 0)))
+    return np.array(widths)
+
+
+def benchmark_min_feret():
+    from .features import get_convex_hulls, calc_min_feret_diameters
+
+    label_img = make_label_image()
+    props = measure.regionprops(label_img)
+    print('{} ROIs in a {}x{} image'.format(len(props), *label_img.shape))
+
+    old, old_time = _time(_contour_min_feret_diameters, props)
+    hulls, hull_time = _time(get_convex_hulls, label_img)
+    new, feret_time = _time(calc_min_feret_diameters, hulls)
+    print('contour rotation:  {:8.3f} s'.format(old_time))
+    print('rotating calipers: {:8.3f} s  ({:.3f} s hulls + {:.3f} s calipers)'.format(hull_time + feret_time, hull_time,
+                                                                                     feret_time))
+    print('speedup:           {:8.1f}x'.format(old_time / (hull_time + feret_time)))
+
+    # The convex hulls are the same polygons as the contours of RegionProperties.convex_image, so both methods can
+    # be compared against a dense sweep of the same hulls
+    swept = _swept_min_feret_diameters(hulls)
+    # The contour method returns 2 for any ROI whose convex image fills its bounding box
+    print('error vs. a 20000-angle sweep (median / max):')
+    for name, diameters in (('contour rotation: ', old), ('rotating calipers:', new)):
+        error = np.abs(diameters - swept)
+        print('  {} {:.4f} / {:.4f} px'.format(name, np.median(error), np.max(error)))
+
+
+def _iterative_erosion(mask, intensity, targetsize):
+    # The previous erosion: erode one fiber with diamond(1) until it has lost the requested fraction of its area
+    from skimage.morphology import binary_erosion, diamond
+    targetarea = np.count_nonzero(mask) * targetsize
+    if targetarea <= 10:
+        return None
+    image = np.pad(mask, 1, mode='constant')
+    while np.count_nonzero(image) > targetarea:
+        image = binary_erosion(image, diamond(1))
+    return image[1:-1, 1:-1]
+
+
+def _iterative_erode_fibers(label_img, states, erosion_percentage):
+    from .roi_map import get_roi_slices, map_rois
+    slices = get_roi_slices(label_img)
+    roi_nums = np.nonzero(states == 1)[0]
+    eroded = map_rois(_iterative_erosion, label_img, rois=roi_nums, args=((100 - erosion_percentage) * .01,),
+                      slices=slices)
+    eroded_img = np.zeros(label_img.shape, dtype=np.uint8)
+    for roi_num, image in zip(roi_nums, eroded):
+        if image is not None:
+            eroded_img[slices[roi_num]][image] = 1
+    return eroded_img
+
+
+def benchmark_erosion():
+    from .analysis import get_erosion_depths, erode_fibers
+
+    label_img = make_label_image(n_rois=2500)
+    states = np.ones(np.max(label_img), dtype=np.uint8)
+    print('{} ROIs in a {}x{} image'.format(len(states), *label_img.shape))
+    percentages = [50, 65, 80, 90]
+    old_time = 0
+    new_images = []
+    depths, depth_time = _time(get_erosion_depths, label_img)
+    for percentage in percentages:
+        old, t = _time(_iterative_erode_fibers, label_img, states, percentage)
+        old_time += t
+        new, t = _time(erode_fibers, label_img, states, percentage, depths)
+        assert np.array_equal(old, new)
+        new_images.append(t)
+    print('iterative erosion, {} percentages:  {:8.3f} s'.format(len(percentages), old_time))
+    print('erosion depths, once:              {:8.3f} s'.format(depth_time))
+    print('depth thresholds, {} percentages:   {:8.3f} s'.format(len(percentages), sum(new_images)))
+
+
+def benchmark_training_store():
+    import os
+    import json
+    import codecs
+    import shutil
+    import tempfile
+    from .classification import load_training_data
+    from .training_store import TrainingStore
+
+    n_samples = 300000
+    rng = np.random.RandomState(0)
+    features = rng.uniform(0, 1, (n_samples, 4)) * [4000, 1, 1, 1]
+    states = rng.randint(1, 3, n_samples)
+    print('{} samples'.format(n_samples))
+    directory = tempfile.mkdtemp()
+    try:
+        def save_json(filename):
+            # The previous format of 'Save Training Data'
+            y = np.where(states == 1, 1, 0)
+            data = {'features': features.tolist(), 'states': y.tolist()}
+            json.dump(data, codecs.open(filename, 'w', encoding='utf-8'), separators=(',', ':'), sort_keys=True,
+                      indent=4)
+
+        json_file = os.path.join(directory, 'training_data.json')
+        store_dir = os.path.join(directory, 'store')
+        _, json_save = _time(save_json, json_file)
+        (x_json, _), json_load = _time(load_training_data, json_file)
+        _, store_save = _time(TrainingStore(store_dir).append, features, states, np.arange(n_samples), 'image')
+        (x_store, _), store_load = _time(load_training_data, store_dir)
+        assert np.allclose(x_json, x_store, rtol=1e-6)
+        store_bytes = sum(os.path.getsize(os.path.join(store_dir, f)) for f in os.listdir(store_dir))
+        print('json:           save {:7.3f} s, load {:7.3f} s, {:6.1f} MB'.format(
+            json_save, json_load, os.path.getsize(json_file) / 1e6))
+        print('training store: save {:7.3f} s, load {:7.3f} s, {:6.1f} MB'.format(
+            store_save, store_load, store_bytes / 1e6))
+    finally:
+        shutil.rmtree(directory)
+
+
+def make_training_data(n_samples=20000, seed=0):
+    # Features in the layout of CLASSIFICATION_COLUMNS (filled area, eccentricity, convexity, circularity) and labels
+    # (1 for fibers, 0 otherwise). Fibers are compact and convex, everything else is spread out. The classes overlap.
+    rng = np.random.RandomState(seed)
+    y = (rng.uniform(0, 1, n_samples) < .6).astype(int)
+    fiber = y == 1
+    x = np.empty((n_samples, 4))
+    x[:, 0] = np.where(fiber, rng.lognormal(7, .5, n_samples), rng.lognormal(6, 1.5, n_samples))
+    x[:, 1] = np.where(fiber, rng.beta(5, 3, n_samples), rng.beta(5, 1.5, n_samples))
+    x[:, 2] = np.where(fiber, 1 - rng.beta(1.5, 30, n_samples), 1 - rng.beta(2, 8, n_samples))
+    x[:, 3] = np.clip(x[:, 2] * (1 - .4 * x[:, 1] ** 4) + rng.normal(0, .08, n_samples), 0, 1)
+    return x, y
+
+
+def benchmark_classifiers():
+    # Set QUANTIMUS_TRAINING_DATA to a training store or .json training data file to also benchmark it
+    import os
+    from .classification import CLASSIFIER_BACKENDS, Classifier, get_norm_coeffs, load_training_data
+
+    datasets = [('synthetic', make_training_data())]
+    if os.environ.get('QUANTIMUS_TRAINING_DATA'):
+        datasets.append(('saved', load_training_data(os.environ['QUANTIMUS_TRAINING_DATA'])))
+    for dataset_name, (x, y) in datasets:
+        # Train on 3/4 of the samples and test on the rest
+        test = np.random.RandomState(0).uniform(0, 1, len(y)) < .25
+        x_train, y_train, x_test, y_test = x[~test], y[~test], x[test], y[test]
+        mu, sigma = get_norm_coeffs(x_train)
+        print('{}: {} training and {} test samples'.format(dataset_name, len(y_train), len(y_test)))
+        print('  {:28s} {:>8s} {:>9s} {:>9s} {:>13s}'.format('backend', 'fit (s)', 'predict', 'accuracy',
+                                                                 'agrees w/ svc'))
+        reference = None
+        for backend in CLASSIFIER_BACKENDS:
+            for max_samples in (None, 2000):
+                if max_samples is not None and max_samples >= len(y_train):
+                    continue
+                clf, fit_time = _time(lambda: Classifier.train(x_train, y_train, mu, sigma, backend=backend,
+                                                                max_samples=max_samples))
+                states, predict_time = _time(clf.predict, x_test)
+                if reference is None:
+                    reference = states
+                name = backend if max_samples is None else '{}, {} samples'.format(backend, max_samples)
+                print('  {:28s} {:8.3f} {:9.3f} {:9.3f} {:13.3f}'.format(
+                    name, fit_time, predict_time, np.mean(np.where(states == 1, 1, 0) == y_test),
+                    np.mean(states == reference)))
+
+
+def _fftconvolve_stack(image, kernels):
+    # The previous filter bank: one scipy.signal.fftconvolve per kernel, stacked into one float64 array
+    from scipy.signal import fftconvolve
+    return np.array([fftconvolve(image, kernel, 'same') for kernel in kernels])
+
+
+def benchmark_gabor():
+    import tracemalloc
+    from .gabor import get_kernels, reduce_gabor_responses
+
+    image = np.random.RandomState(0).uniform(0, 1, (1024, 1024))
+    kernels, kernel_time = _time(get_kernels)
+    _, cached_time = _time(get_kernels)
+    print('{} kernels: built in {:.3f} s, {:.6f} s when cached'.format(len(kernels), kernel_time, cached_time))
+    tracemalloc.start()
+    old, old_time = _time(_fftconvolve_stack, image, kernels)
+    old_peak = tracemalloc.get_traced_memory()[1]
+    old_max = np.max(old, 0)
+    del old
+    tracemalloc.reset_peak()
+    new, new_time = _time(reduce_gabor_responses, image, kernels)
+    new_peak = tracemalloc.get_traced_memory()[1] - old_max.nbytes
+    tracemalloc.stop()
+    assert np.allclose(new['max'], old_max, atol=1e-5)
+    print('fftconvolve per kernel, stacked: {:7.3f} s, peak {:6.0f} MB'.format(old_time, old_peak / 1e6))
+    print('shared FFT, streaming reduction: {:7.3f} s, peak {:6.0f} MB'.format(new_time, new_peak / 1e6))
+
+
+def make_laminin_image(size=1536, fiber_size=40, seed=0):
+    # Laminin-like image of bright boundaries between the Voronoi cells of random points, as uint16
+    from scipy import ndimage
+    from scipy.spatial import cKDTree
+    rng = np.random.RandomState(seed)
+    points = rng.uniform(0, size, (size * size // fiber_size ** 2, 2))
+    pixels = np.indices((size, size)).reshape(2, -1).T
+    distances, _ = cKDTree(points).query(pixels, k=2)
+    image = np.exp(-(distances[:, 1] - distances[:, 0]).reshape(size, size) / 2)
+    image = ndimage.gaussian_filter(image, 1) + rng.normal(0, .02, image.shape)
+    return (np.clip(image, 0, 1) * 65535).astype(np.uint16)
+
+
+def _segment_whole(image):
+    from .segmentation import normalize_image, fill_boundaries, get_binary_image
+    filled_boundaries = fill_boundaries(normalize_image(image), .2, .4, 1, 8)
+    return measure.label(get_binary_image(filled_boundaries, .4), connectivity=2)
+
+
+def benchmark_roi_map():
+    import os
+    from .roi_map import get_roi_slices, map_rois
+
+    label_img = make_label_image(n_rois=900, roi_size=100)
+    slices = get_roi_slices(label_img)
+    print('{} ROIs in a {}x{} image, {} CPUs'.format(len(slices), label_img.shape[0], label_img.shape[1],
+                                                     os.cpu_count()))
+    # The per-ROI erosion of the erosion benchmark, which spends its time in scipy.ndimage with the GIL released
+    serial, serial_time = _time(map_rois, _iterative_erosion, label_img, None, None, (.5,), 1, 16, None, slices)
+    print('1 thread:   {:7.3f} s'.format(serial_time))
+    for threads in (2, 4, 8):
+        results, t = _time(map_rois, _iterative_erosion, label_img, None, None, (.5,), threads, 16, None, slices)
+        assert all(np.array_equal(a, b) for a, b in zip(serial, results))
+        print('{} threads: {:7.3f} s  ({:.1f}x)'.format(threads, t, serial_time / t))
+
+
+def benchmark_tiles():
+    import os
+    import tempfile
+    import tracemalloc
+    from .tiles import segment_tiled
+
+    with tempfile.TemporaryDirectory() as directory:
+        np.save(os.path.join(directory, 'laminin.npy'), make_laminin_image())
+        image = np.load(os.path.join(directory, 'laminin.npy'), mmap_mode='r')
+        tracemalloc.start()
+        whole, whole_time = _time(_segment_whole, np.asarray(image))
+        whole_peak = tracemalloc.get_traced_memory()[1]
+        whole = np.array(whole)
+        tracemalloc.reset_peak()
+        tiled, tiled_time = _time(segment_tiled, image, os.path.join(directory, 'segmentation'), .2, .4, 1, 8, 512,
+                                  64, 1)
+        tiled_peak = tracemalloc.get_traced_memory()[1] - whole.nbytes
+        tracemalloc.stop()
+        assert np.array_equal(whole, tiled)
+        print('{}x{} image, {} fibers'.format(image.shape[0], image.shape[1], np.max(whole)))
+        print('whole image:         {:7.3f} s, peak {:6.0f} MB'.format(whole_time, whole_peak / 1e6))
+        print('512 pixel tiles:     {:7.3f} s, peak {:6.0f} MB'.format(tiled_time, tiled_peak / 1e6))
+        del image, tiled
+
+
+def _run_stages(image, compact):
+    # The images held by the GUI after segmentation and erosion, with float64 images, the labels of skimage and a
+    # second label image for the erosion, or in compact-memory mode
+    from .segmentation import normalize_image, fill_boundaries, get_binary_image
+    from .analysis import erode_fibers
+    from .memory import get_intensity_dtype, label_fibers
+    stages = {}
+    stages['image'] = normalize_image(image, get_intensity_dtype(compact))
+    stages['filled_boundaries'] = fill_boundaries(stages['image'], .2, .4, 1, 8)
+    stages['binary'] = get_binary_image(stages['filled_boundaries'], .4)
+    if compact:
+        stages['labels'] = label_fibers(stages['binary'])
+    else:
+        stages['labels'] = measure.label(stages['binary'], connectivity=2)
+        stages['eroded_labels'] = measure.label(stages['binary'], connectivity=2)
+    stages['states'] = np.ones(int(np.max(stages['labels'])), dtype=np.uint8)
+    stages['eroded'] = erode_fibers(stages['labels'], stages['states'], 80)
+    return stages
+
+
+def benchmark_memory():
+    import tracemalloc
+    from .memory import get_memory_report, format_memory_report
+
+    image = make_laminin_image()
+    for compact in (False, True):
+        tracemalloc.start()
+        stages = _run_stages(image, compact)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('compact memory' if compact else 'float64 images, skimage labels')
+        print(format_memory_report(get_memory_report(list(stages.items()))))
+        print('{:<28} {:10.1f} MB'.format('Peak', peak / 1e6))
+
+
+def _open_window_labels(binary_image):
+    # The segmentation work of opening a ClassifierWindow before the segmentation cache
+    binary_image = binary_image.astype(bool)
+    return measure.label(binary_image, connectivity=2), measure.label(binary_image, connectivity=2)
+
+
+def benchmark_segmentation_cache():
+    from .segmentation import normalize_image, fill_boundaries, get_binary_image
+    from .segmentation_cache import SegmentationCache
+
+    image = normalize_image(make_laminin_image())
+    binary_image = get_binary_image(fill_boundaries(image, .2, .4, 1, 8), .4)
+    # Binary, training, trained, filtered, fluorescence and DAPI windows
+    n_windows = 6
+    _, old_time = _time(lambda: [_open_window_labels(binary_image) for _ in range(n_windows)])
+    cache = SegmentationCache()
+    segmentation, first_time = _time(cache.get, binary_image)
+    _, hit_time = _time(cache.get, binary_image)
+    assert np.array_equal(segmentation.labeled_img, measure.label(binary_image, connectivity=2))
+    print('{}x{} binary image, {} windows'.format(binary_image.shape[0], binary_image.shape[1], n_windows))
+    print('label twice per window:        {:7.3f} s'.format(old_time))
+    print('shared segmentation:           {:7.3f} s once, then {:.4f} s per lookup by hash'.format(first_time,
+                                                                                                 hit_time))
+
+
+def benchmark_pyramid():
+    from .segmentation import get_markers
+    from .pyramid import ImagePyramid, get_markers_preview
+
+    image = np.random.RandomState(0).uniform(0, 1, (8192, 8192)).astype(np.float32)
+    pyramid, pyramid_time = _time(ImagePyramid, image)
+    _, full_time = _time(get_markers, image, .2, .4)
+    # The whole image in a 1024 pixel wide window, and a 1024x768 view of it at full resolution
+    (overview, _, _), overview_time = _time(get_markers_preview, pyramid, .2, .4, 8192 / 1024)
+    (zoomed, _, _), zoomed_time = _time(get_markers_preview, pyramid, .2, .4, 1, (2000, 3024), (2000, 2768))
+    assert np.array_equal(zoomed, get_markers(image[2000:3025, 2000:2769], .2, .4))
+    print('8192x8192 image, pyramid of {} levels built in {:.3f} s'.format(len(pyramid), pyramid_time))
+    print('full resolution markers:     {:8.4f} s per slider tick'.format(full_time))
+    print('preview of the whole image:  {:8.4f} s ({}x{} pixels)'.format(overview_time, *overview.shape))
+    print('preview at full resolution:  {:8.4f} s ({}x{} pixels)'.format(zoomed_time, *zoomed.shape))
+
+
+def _add_fibers_per_row(filename, name, fibers):
+    # The upload of mysql_interface.add_fibers before database.py: a new connection, every name read to check for
+    # duplicates, and one INSERT per fiber looking the mouse up by its name
+    import sqlite3
+    con = sqlite3.connect(filename)
+    try:
+        names = [row[0] for row in con.execute('SELECT name FROM mice')]
+        if name in names:
+            return
+        con.execute('INSERT INTO mice (name) VALUES (?)', (name,))
+        con.commit()
+        for f in fibers:
+            con.execute('INSERT INTO fibers (mouse_id, area, eccentricity, convexity, circularity, minor_axis_length) '
+                        'VALUES ((SELECT id FROM mice WHERE name=?), ?, ?, ?, ?, ?)', (name,) + tuple(map(float, f)))
+            con.commit()
+    finally:
+        con.close()
+
+
+def benchmark_database():
+    import os
+    import sqlite3
+    import tempfile
+    from .database import FiberDatabase, SQLiteBackend
+
+    # A cohort of 100 mice of 1000 fibers. Per-row uploads commit every fiber, as the MySQL server did in autocommit
+    # mode, so only the first 10 mice are uploaded that way and the time is extrapolated.
+    rng = np.random.RandomState(0)
+    cohort = {'mouse{:03d}'.format(i): rng.uniform(0, 1, (1000, 5)) for i in range(100)}
+    n_fibers = sum(len(fibers) for fibers in cohort.values())
+    n_per_row = 10
+    with tempfile.TemporaryDirectory() as directory:
+        old_filename = os.path.join(directory, 'old.db')
+        con = sqlite3.connect(old_filename)
+        con.execute('CREATE TABLE mice (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(255))')
+        con.execute('CREATE TABLE fibers (id INTEGER PRIMARY KEY AUTOINCREMENT, mouse_id INTEGER, area DOUBLE, '
+                    'eccentricity DOUBLE, convexity DOUBLE, circularity DOUBLE, minor_axis_length DOUBLE)')
+        con.close()
+        names = sorted(cohort)[:n_per_row]
+        _, old_time = _time(lambda: [_add_fibers_per_row(old_filename, name, cohort[name]) for name in names])
+        old_time *= len(cohort) / n_per_row
+
+        database = FiberDatabase(SQLiteBackend(os.path.join(directory, 'new.db')))
+        _, sample_time = _time(lambda: [database.add_fibers(name, fibers) for name, fibers in cohort.items()])
+        _, cohort_time = _time(database.add_samples, cohort)
+        assert database.get_sample_names() == list(cohort)
+        assert np.allclose(database.get_fibers('mouse042'), cohort['mouse042'])
+        database.close()
+    print('{} mice, {} fibers, SQLite'.format(len(cohort), n_fibers))
+    print('one INSERT per fiber:        {:8.3f} s (extrapolated from {} mice)'.format(old_time, n_per_row))
+    print('one transaction per mouse:   {:8.3f} s'.format(sample_time))
+    print('cohort in one transaction:   {:8.3f} s (replacing every mouse)'.format(cohort_time))
+
+
+# Modules of the plugin in the order they are usually loaded. quantimus and marking_binary_window need flika.
+PLUGIN_MODULES = ['quantimus', 'marking_binary_window', 'classification', 'training_store', 'rules', 'fiber_table',
+                  'features', 'analysis', 'segmentation', 'roi_map', 'stacks', 'gabor', 'export',
+                  'memory', 'segmentation_cache', 'tiles', 'pyramid', 'workers',
+                  'database', 'mysql_interface', 'pipeline']
+
+
+def _import_times(module):
+    # Import time in seconds of module, and the time spent in the modules of each package it imports, measured with
+    # python -X importtime in a fresh interpreter. Returns None if module cannot be imported.
+    import os
+    import subprocess
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.environ.get('PYTHONPATH', '')]))
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], cwd=root, env=env,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        return None
+    total = 0
+    packages = {}
+    for line in process.stderr.splitlines():
+        fields = line[len('import time:'):].split('|')
+        if line.startswith('import time:') and len(fields) == 3 and fields[0].strip().isdigit():
+            name = fields[2].strip()
+            package = name.split('.')[0]
+            packages[package] = packages.get(package, 0) + int(fields[0]) * 1e-6
+            if name == module:
+                total = int(fields[1]) * 1e-6
+    return total, packages
+
+
+def benchmark_import():
+    print('{:24s} {:>8s}   slowest packages'.format('module', 'import'))
+    for module in PLUGIN_MODULES:
+        times = _import_times('{}.{}'.format(__package__, module))
+        if times is None:
+            print('{:24s} {:>8s}'.format(module, 'failed'))
+            continue
+        total, packages = times
+        slowest = sorted((t, name) for name, t in packages.items() if name != __package__)[-3:][::-1]
+        print('{:24s} {:7.3f}s   {}'.format(module, total, ', '.join('{} {:.3f}s'.format(name, t)
+                                                                       for t, name in slowest)))
+
+
+BENCHMARKS = {
+    'min_feret': benchmark_min_feret,
+    'erosion': benchmark_erosion,
+    'roi_map': benchmark_roi_map,
+    'training_store': benchmark_training_store,
+    'classifiers': benchmark_classifiers,
+    'gabor': benchmark_gabor,
+    'tiles': benchmark_tiles,
+    'memory': benchmark_memory,
+    'segmentation_cache': benchmark_segmentation_cache,
+    'pyramid': benchmark_pyramid,
+    'database': benchmark_database,
+    'import': benchmark_import,
+}
+
+
+def main(argv=None):
+    names = sys.argv[1:] if argv is None else argv
+    if not names or any(name not in BENCHMARKS for name in names):
+        print('Available benchmarks: {}'.format(', '.join(sorted(BENCHMARKS))))
+        return 1
+    for name in names:
+        print('== {} =='.format(name))
+        BENCHMARKS[name]()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
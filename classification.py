@@ -0,0 +1,289 @@
+import os
+import numpy as np
+import json
+import codecs
+from concurrent.futures import ThreadPoolExecutor
+
+from .rules import apply_rules, ranges_to_rules
+from .fiber_table import CLASSIFICATION_COLUMNS
+from .training_store import TrainingStore, is_training_store
+
+
+FILTER_FEATURES = ['area', 'eccentricity', 'convexity', 'circularity']
+
+CLASSIFIER_BACKENDS = ['svc', 'linear_svm', 'nystroem', 'boosted_trees']
+
+
+def get_norm_coeffs(x):
+    mean = np.mean(x, 0)
+    std = np.std(x, 0)
+    return mean, std
+
+
+def normalize_data(x, mean, std):
+    x = x - mean
+    x = x / (2 * std)
+    return x
+
+
+def get_training_data(features_array, states):
+    states = np.asarray(states)
+    x = features_array[states > 0, :]
+    y = states[states > 0]
+    y[y == 2] = 0
+    return x, y
+
+
+def load_training_data(filename):
+    # filename is a training store (see training_store.py) or a .json file saved by earlier versions
+    if is_training_store(filename):
+        return TrainingStore(filename).get_training_data()
+    obj_text = codecs.open(filename, 'r', encoding='utf-8').read()
+    data = json.loads(obj_text)
+    x_train = np.array(data['features'])
+    y_train = np.array(data['states'])
+    return x_train, y_train
+
+
+def classify(x_train, y_train, x_test, mu, sigma):
+    # Trains an SVM on the training data and returns the states of x_test. 1 is a fiber, 2 is not a fiber.
+    # Raises a ValueError unless there is at least 1 positive and 1 negative sample.
+    return Classifier.train(x_train, y_train, mu, sigma).predict(x_test)
+
+
+def get_stratified_subsample(y, max_samples, seed=0):
+    # Indices of at most max_samples samples, drawn at random from each class in proportion to its size. Every class
+    # keeps at least one sample.
+    y = np.asarray(y)
+    if max_samples is None or len(y) <= max_samples:
+        return np.arange(len(y))
+    rng = np.random.RandomState(seed)
+    classes, counts = np.unique(y, return_counts=True)
+    n_per_class = np.maximum(np.floor(counts * max_samples / float(len(y))).astype(int), 1)
+    indices = [rng.choice(np.nonzero(y == c)[0], n, replace=False) for c, n in zip(classes, n_per_class)]
+    return np.sort(np.concatenate(indices))
+
+
+def _rbf_kernel(x, y, gamma):
+    sq_dists = np.sum(x ** 2, 1)[:, np.newaxis] + np.sum(y ** 2, 1) - 2 * np.dot(x, y.T)
+    return np.exp(-gamma * np.maximum(sq_dists, 0))
+
+
+def _get_gamma(x):
+    # The default RBF kernel width of scikit-learn ('scale'), computed here rather than read back from the model
+    return 1. / (x.shape[1] * x.var()) if x.var() > 0 else 1.
+
+
+def _get_tree_params(clf):
+    # The fitted trees of a HistGradientBoostingClassifier as flat node arrays, so that a saved classifier is plain
+    # data. Children are indices into the arrays of all trees, and roots holds the first node of each tree.
+    if clf.n_trees_per_iteration_ != 1:
+        raise ValueError('Only classifiers of 2 classes can be saved')
+    trees = [predictor.nodes for (predictor,) in clf._predictors]
+    if any(np.any(tree['is_categorical']) for tree in trees):
+        raise ValueError('Trees with categorical splits cannot be saved')
+    sizes = [len(tree) for tree in trees]
+    roots = np.cumsum([0] + sizes[:-1])
+    offsets = np.repeat(roots, sizes)
+    nodes = np.concatenate(trees)
+    leaf = nodes['is_leaf'].astype(bool)
+    return {'roots': roots.astype(np.int64),
+            'feature': np.where(leaf, 0, nodes['feature_idx']).astype(np.int64),
+            'threshold': nodes['num_threshold'].astype(np.float64),
+            'missing_go_to_left': nodes['missing_go_to_left'].astype(bool),
+            'left': np.where(leaf, 0, nodes['left'] + offsets).astype(np.int64),
+            'right': np.where(leaf, 0, nodes['right'] + offsets).astype(np.int64),
+            'is_leaf': leaf,
+            'value': nodes['value'].astype(np.float64),
+            'baseline': float(np.ravel(clf._baseline_prediction)[0])}
+
+
+def _tree_decision_function(x, p):
+    # Sum of the leaf values that every row of x reaches in every tree, plus the baseline. A feature value goes left
+    # if it is at most the threshold of the node, and NaN goes the way the tree learned for missing values.
+    feature = np.asarray(p['feature'])
+    threshold = np.asarray(p['threshold'])
+    missing_go_to_left = np.asarray(p['missing_go_to_left'], dtype=bool)
+    left = np.asarray(p['left'])
+    right = np.asarray(p['right'])
+    is_leaf = np.asarray(p['is_leaf'], dtype=bool)
+    node = np.tile(np.asarray(p['roots'], dtype=np.int64), (len(x), 1))
+    rows = np.arange(len(x))[:, np.newaxis]
+    while True:
+        active = ~is_leaf[node]
+        if not np.any(active):
+            break
+        r, t = np.nonzero(active)
+        n = node[r, t]
+        values = x[rows[r, 0], feature[n]]
+        go_left = np.where(np.isnan(values), missing_go_to_left[n], values <= threshold[n])
+        node[r, t] = np.where(go_left, left[n], right[n])
+    return np.sum(np.asarray(p['value'])[node], 1) + p['baseline']
+
+
+class Classifier:
+    """
+    A trained fiber classifier: the fitted model, the normalization coefficients and the fiber table columns of its
+    features, saved together as one versioned .json file.
+
+    Backends (see CLASSIFIER_BACKENDS):
+        svc            the RBF support vector machine. Training time grows about quadratically with the samples.
+        linear_svm     a linear support vector machine
+        nystroem       a Nystroem approximation of the RBF kernel followed by a linear (ridge) classifier
+        boosted_trees  histogram gradient-boosted trees, saved as arrays of tree nodes
+
+    Train once with Classifier.train (or load a saved classifier with Classifier.load), then score any number of
+    images with predict or predict_tables. max_samples trains on a stratified random subsample of large pooled training
+    sets. Prediction only needs numpy. A saved classifier is plain data rather than a pickle, so it does not depend on
+    the installed version of scikit-learn, and loading a shared file cannot run code. predict splits the features
+    into chunks that are scored in a pool of threads.
+    """
+    VERSION = 3
+
+    def __init__(self, backend, params, classes, mean, std, feature_columns=CLASSIFICATION_COLUMNS):
+        if backend not in CLASSIFIER_BACKENDS:
+            raise ValueError('Unknown classifier backend {!r}. Use one of {}'.format(
+                backend, ', '.join(CLASSIFIER_BACKENDS)))
+        self.backend = backend
+        self.params = params
+        self.classes = np.asarray(classes)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.std = np.asarray(std, dtype=np.float64)
+        self.feature_columns = list(feature_columns)
+
+    @classmethod
+    def train(cls, x_train, y_train, mu, sigma, feature_columns=CLASSIFICATION_COLUMNS, backend='svc',
+              max_samples=None, seed=0):
+        # y_train is 1 for fibers and 0 for everything else, as returned by get_training_data.
+        # Raises a ValueError unless there is at least 1 positive and 1 negative sample.
+        if backend not in CLASSIFIER_BACKENDS:
+            raise ValueError('Unknown classifier backend {!r}. Use one of {}'.format(
+                backend, ', '.join(CLASSIFIER_BACKENDS)))
+        if len(np.unique(y_train)) < 2:
+            raise ValueError('The training data needs at least 1 positive and 1 negative sample')
+        subsample = get_stratified_subsample(y_train, max_samples, seed)
+        x = normalize_data(np.asarray(x_train, dtype=np.float64)[subsample], mu, sigma)
+        y = np.asarray(y_train)[subsample]
+        # scikit-learn takes over a second to import, so it is only imported to train
+        from sklearn import svm
+        if backend == 'svc':
+            gamma = _get_gamma(x)
+            clf = svm.SVC(gamma=gamma)
+            clf.fit(x, y)
+            params = {'support_vectors': clf.support_vectors_, 'dual_coef': clf.dual_coef_[0],
+                      'intercept': clf.intercept_[0], 'gamma': gamma}
+        elif backend == 'linear_svm':
+            clf = svm.LinearSVC()
+            clf.fit(x, y)
+            params = {'coef': clf.coef_[0], 'intercept': clf.intercept_[0]}
+        elif backend == 'nystroem':
+            from sklearn.kernel_approximation import Nystroem
+            from sklearn.linear_model import RidgeClassifier
+            # The same kernel width as svc
+            gamma = _get_gamma(x)
+            nystroem = Nystroem(gamma=gamma, n_components=min(300, len(x)), random_state=seed)
+            transformed = nystroem.fit_transform(x)
+            # A ridge classifier fits the transformed features about 20 times faster than a linear SVM, and as well
+            clf = RidgeClassifier()
+            clf.fit(transformed, y)
+            params = {'components': nystroem.components_, 'normalization': nystroem.normalization_, 'gamma': gamma,
+                      'coef': np.ravel(clf.coef_), 'intercept': np.ravel(clf.intercept_)[0]}
+        else:
+            from sklearn.ensemble import HistGradientBoostingClassifier
+            clf = HistGradientBoostingClassifier(random_state=seed)
+            clf.fit(x, y)
+            params = _get_tree_params(clf)
+            # The node arrays rely on internals of scikit-learn, so they are checked against the fitted model
+            if not np.allclose(_tree_decision_function(x, params), clf.decision_function(x)):
+                import sklearn
+                raise ValueError('The trees of scikit-learn {} cannot be saved'.format(sklearn.__version__))
+        return cls(backend, params, clf.classes_, mu, sigma, feature_columns)
+
+    def decision_function(self, x):
+        # Signed distance of every row of x from the decision boundary. Positive values are classes[1].
+        x = normalize_data(np.asarray(x, dtype=np.float64), self.mean, self.std)
+        p = self.params
+        if self.backend == 'svc':
+            kernel = _rbf_kernel(x, np.asarray(p['support_vectors']), p['gamma'])
+            return np.dot(kernel, p['dual_coef']) + p['intercept']
+        if self.backend == 'linear_svm':
+            return np.dot(x, p['coef']) + p['intercept']
+        if self.backend == 'nystroem':
+            transformed = np.dot(_rbf_kernel(x, np.asarray(p['components']), p['gamma']),
+                                 np.asarray(p['normalization']).T)
+            return np.dot(transformed, p['coef']) + p['intercept']
+        return _tree_decision_function(x, p)
+
+    def predict(self, features, chunk_size=4096, threads=None, callback=None):
+        # States of the fibers in features, a (n_fibers, n_features) array or a FiberTable. 1 is a fiber, 2 is not.
+        # callback is called after every chunk, e.g. to report progress.
+        if hasattr(features, 'get_columns'):
+            features = features.get_columns(self.feature_columns)
+        features = np.asarray(features)
+        if features.ndim != 2 or features.shape[1] != len(self.feature_columns):
+            raise ValueError('Expected features with {} columns ({}), got shape {}'.format(
+                len(self.feature_columns), ', '.join(self.feature_columns), features.shape))
+        chunks = [features[i:i + chunk_size] for i in range(0, len(features), chunk_size)]
+        if threads is None:
+            threads = os.cpu_count() or 1
+        executor = ThreadPoolExecutor(threads) if threads > 1 and len(chunks) > 1 else None
+        results = map(self.decision_function, chunks) if executor is None else \
+            executor.map(self.decision_function, chunks)
+        decisions = []
+        try:
+            for decision in results:
+                decisions.append(decision)
+                if callback is not None:
+                    callback()
+        finally:
+            # If callback raised, the remaining chunks are not scored
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        decision = np.concatenate(decisions) if decisions else np.zeros(0)
+        y = self.classes[(decision > 0).astype(int)]
+        return np.where(y == 1, 1, 2).astype(self.classes.dtype)
+
+    def predict_tables(self, fiber_tables, chunk_size=4096, threads=None):
+        # predict for many images at once. Returns the states of each FiberTable.
+        features = [fibers.get_columns(self.feature_columns) for fibers in fiber_tables]
+        if not features:
+            return []
+        states = self.predict(np.concatenate(features), chunk_size, threads)
+        return np.split(states, np.cumsum([len(f) for f in features])[:-1])
+
+    def save(self, filename):
+        params = {name: value.tolist() if isinstance(value, np.ndarray) else value
+                  for name, value in self.params.items()}
+        data = {'version': Classifier.VERSION,
+                'backend': self.backend,
+                'params': params,
+                'feature_columns': self.feature_columns,
+                'mean': self.mean.tolist(),
+                'std': self.std.tolist(),
+                'classes': self.classes.tolist()}
+        json.dump(data, codecs.open(filename, 'w', encoding='utf-8'), separators=(',', ':'), sort_keys=True, indent=4)
+
+    @classmethod
+    def load(cls, filename):
+        obj_text = codecs.open(filename, 'r', encoding='utf-8').read()
+        data = json.loads(obj_text)
+        if data.get('version') == 1:
+            # Version 1 only saved svc classifiers
+            data['backend'] = 'svc'
+            data['params'] = {name: data[name] for name in ('support_vectors', 'dual_coef', 'intercept', 'gamma')}
+        elif data.get('version') == 2 and data['backend'] == 'boosted_trees':
+            # Version 2 saved boosted_trees as a pickle, which can run arbitrary code when it is loaded
+            raise ValueError('{} holds a pickled scikit-learn model, which is not loaded for safety. Train and save '
+                             'the classifier again.'.format(filename))
+        elif data.get('version') not in (2, Classifier.VERSION):
+            raise ValueError('{} is a version {} classifier. Versions up to {} are supported.'.format(
+                filename, data.get('version'), Classifier.VERSION))
+        return cls(data['backend'], data['params'], data['classes'], data['mean'], data['std'],
+                   data['feature_columns'])
+
+
+def filter_states(features_array, states, filters):
+    # filters maps a feature name in FILTER_FEATURES to a (min, max) range, or None if the filter is disabled.
+    # Fibers outside any enabled range, or that were not green to begin with, become red.
+    columns = {name: features_array[:, column] for column, name in enumerate(FILTER_FEATURES)}
+    return apply_rules(ranges_to_rules(filters), columns, states)
@@ -0,0 +1,314 @@
+"""
+Storage of fiber tables in a database.
+
+The fibers of every sample (a mouse) are stored in two tables:
+
+    mice    id, name (unique)
+    fibers  id, mouse_id (indexed), area, eccentricity, convexity, circularity, minor_axis_length
+
+A FiberDatabase keeps a pool of open connections, looks samples up through the unique index on their name, and
+stores all the fibers of a sample, or of a whole cohort, with one executemany in one transaction. Storing a sample
+that already exists replaces its fibers (an upsert keyed by the sample name), so an interrupted or repeated upload
+never leaves a sample half stored or stored twice.
+
+Tables created by earlier versions of Quantimus have no indexes. FiberDatabase adds them when it opens the database
+(FiberDatabase.migrate).
+
+Backends:
+    SQLiteBackend(filename)   the sqlite3 module of the standard library, for local use and testing
+    MySQLBackend(...)         a MySQL server through pymysql. MySQLBackend.from_environment reads the connection
+                              settings from QUANTIMUS_MYSQL_HOST, _USER, _PASSWORD and _DATABASE.
+"""
+import os
+import queue
+import threading
+import contextlib
+import numpy as np
+
+from .fiber_table import DATABASE_COLUMNS
+
+
+# Column of the fibers table for each column of fiber_table.DATABASE_COLUMNS
+FIBER_COLUMNS = ['area', 'eccentricity', 'convexity', 'circularity', 'minor_axis_length']
+
+# (name, table, column, unique) of every index of the schema
+INDEXES = [('mice_name', 'mice', 'name', True), ('fibers_mouse_id', 'fibers', 'mouse_id', False)]
+
+
+class SampleExistsError(ValueError):
+    pass
+
+
+class SQLiteBackend:
+    """
+    A SQLite database file. ':memory:' is a database of its own for every connection, so it needs a pool of size 1.
+    """
+    placeholder = '?'
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def connect(self):
+        import sqlite3
+        # Connections are handed between threads by the pool, but only used by one thread at a time
+        return sqlite3.connect(self.filename, check_same_thread=False)
+
+    def ping(self, con):
+        pass
+
+    def get_schema(self):
+        columns = ', '.join('`{}` DOUBLE'.format(name) for name in FIBER_COLUMNS)
+        return ['CREATE TABLE IF NOT EXISTS `mice` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, '
+                '`name` VARCHAR(255) NOT NULL)',
+                'CREATE TABLE IF NOT EXISTS `fibers` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, '
+                '`mouse_id` INTEGER NOT NULL REFERENCES `mice` (`id`), {})'.format(columns)]
+
+    def get_indexes(self, cursor, table):
+        # {column: unique} for the first column of every index of table
+        indexes = {}
+        cursor.execute('PRAGMA index_list(`{}`)'.format(table))
+        for row in cursor.fetchall():
+            name, unique = row[1], row[2]
+            cursor.execute('PRAGMA index_info(`{}`)'.format(name))
+            columns = sorted(cursor.fetchall())
+            if columns:
+                indexes[columns[0][2]] = indexes.get(columns[0][2], False) or bool(unique)
+        return indexes
+
+
+class MySQLBackend:
+    """
+    A MySQL database, through pymysql.
+    """
+    placeholder = '%s'
+
+    def __init__(self, host='localhost', user=None, password=None, db='myoquant', port=3306):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.db = db
+        self.port = port
+
+    @classmethod
+    def from_environment(cls):
+        return cls(os.environ.get('QUANTIMUS_MYSQL_HOST', 'localhost'), os.environ.get('QUANTIMUS_MYSQL_USER'),
+                   os.environ.get('QUANTIMUS_MYSQL_PASSWORD'), os.environ.get('QUANTIMUS_MYSQL_DATABASE', 'myoquant'),
+                   int(os.environ.get('QUANTIMUS_MYSQL_PORT', 3306)))
+
+    def connect(self):
+        import pymysql
+        return pymysql.connect(host=self.host, user=self.user, password=self.password, db=self.db, port=self.port,
+                               charset='utf8mb4')
+
+    def ping(self, con):
+        # Reopens connections the server closed while they were idle in the pool
+        con.ping(reconnect=True)
+
+    def get_schema(self):
+        columns = ', '.join('`{}` DOUBLE'.format(name) for name in FIBER_COLUMNS)
+        return ['CREATE TABLE IF NOT EXISTS `mice` (`id` INT NOT NULL AUTO_INCREMENT PRIMARY KEY, '
+                '`name` VARCHAR(255) NOT NULL)',
+                'CREATE TABLE IF NOT EXISTS `fibers` (`id` BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY, '
+                '`mouse_id` INT NOT NULL, {})'.format(columns)]
+
+    def get_indexes(self, cursor, table):
+        # {column: unique} for the first column of every index of table
+        indexes = {}
+        cursor.execute('SHOW INDEX FROM `{}`'.format(table))
+        for row in cursor.fetchall():
+            non_unique, seq_in_index, column = row[1], row[3], row[4]
+            if seq_in_index == 1:
+                indexes[column] = indexes.get(column, False) or not non_unique
+        return indexes
+
+
+class ConnectionPool:
+    """
+    Up to size open connections, reused across calls. A connection is used by one caller at a time.
+    """
+
+    def __init__(self, backend, size=4):
+        self.backend = backend
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.n_open = 0
+        self.lock = threading.Lock()
+
+    def _discard(self, con):
+        # Closes a broken connection, making room for a new one
+        try:
+            con.close()
+        except Exception:
+            pass
+        with self.lock:
+            self.n_open -= 1
+
+    def _acquire(self):
+        # An idle connection that still answers, or a new one while fewer than size are open
+        while True:
+            try:
+                con = self.idle.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    can_open = self.n_open < self.size
+                    if can_open:
+                        self.n_open += 1
+                if can_open:
+                    try:
+                        return self.backend.connect()
+                    except Exception:
+                        with self.lock:
+                            self.n_open -= 1
+                        raise
+                try:
+                    # Waits for a connection to be released, or for a broken one to be discarded
+                    con = self.idle.get(timeout=.1)
+                except queue.Empty:
+                    continue
+            try:
+                self.backend.ping(con)
+                return con
+            except Exception:
+                self._discard(con)
+
+    @contextlib.contextmanager
+    def connection(self):
+        # A connection in a transaction. It is committed if the block succeeds, and rolled back if it raises.
+        con = self._acquire()
+        try:
+            yield con
+            con.commit()
+        except BaseException:
+            try:
+                con.rollback()
+            except Exception:
+                self._discard(con)
+                con = None
+            raise
+        finally:
+            if con is not None:
+                self.idle.put(con)
+
+    def close(self):
+        while True:
+            try:
+                con = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            con.close()
+            with self.lock:
+                self.n_open -= 1
+
+
+def _get_fiber_rows(mouse_id, fibers):
+    # (mouse_id, area, eccentricity, ...) for every fiber. fibers is a FiberTable or a (n_fibers, 5) array in the
+    # order of DATABASE_COLUMNS.
+    if hasattr(fibers, 'get_columns'):
+        fibers = fibers.get_columns(DATABASE_COLUMNS)
+    fibers = np.asarray(fibers, dtype=np.float64)
+    if fibers.ndim != 2 or fibers.shape[1] != len(FIBER_COLUMNS):
+        raise ValueError('Expected fibers with {} columns ({}), got shape {}'.format(
+            len(FIBER_COLUMNS), ', '.join(DATABASE_COLUMNS), fibers.shape))
+    return [(mouse_id,) + row for row in map(tuple, fibers.tolist())]
+
+
+class FiberDatabase:
+    """
+    Fibers of many samples in a SQLiteBackend or MySQLBackend database. The tables are created if they do not exist.
+    """
+
+    def __init__(self, backend, pool_size=4):
+        self.backend = backend
+        self.pool = ConnectionPool(backend, pool_size)
+        self.create_schema()
+
+    def _sql(self, sql):
+        # sql with %s placeholders, in the placeholder style of the backend
+        return sql.replace('%s', self.backend.placeholder)
+
+    def create_schema(self):
+        with self.pool.connection() as con:
+            cursor = con.cursor()
+            for statement in self.backend.get_schema():
+                cursor.execute(statement)
+            self.migrate(cursor)
+
+    def migrate(self, cursor):
+        # Adds the INDEXES that tables created by earlier versions lack. If names are already stored twice, mice_name
+        # cannot be unique. It is then a plain index, and _store_sample still refuses new duplicates.
+        for name, table, column, unique in INDEXES:
+            indexes = self.backend.get_indexes(cursor, table)
+            if column in indexes and (indexes[column] or not unique):
+                continue
+            if unique:
+                cursor.execute('SELECT `{0}` FROM `{1}` GROUP BY `{0}` HAVING COUNT(*) > 1 LIMIT 1'.format(column,
+                                                                                                          table))
+                has_duplicates = cursor.fetchone() is not None
+                if has_duplicates and column in indexes:
+                    continue
+                unique = not has_duplicates
+                if column in indexes:
+                    # Replaces the plain index of a table that had duplicates when it was migrated
+                    name += '_unique'
+            cursor.execute('CREATE {}INDEX `{}` ON `{}` (`{}`)'.format('UNIQUE ' if unique else '', name, table,
+                                                                     column))
+
+    def close(self):
+        self.pool.close()
+
+    def _get_sample_id(self, cursor, name):
+        cursor.execute(self._sql('SELECT `id` FROM `mice` WHERE `name` = %s ORDER BY `id` LIMIT 1'), (name,))
+        row = cursor.fetchone()
+        return None if row is None else row[0]
+
+    def has_sample(self, name):
+        with self.pool.connection() as con:
+            return self._get_sample_id(con.cursor(), name) is not None
+
+    def get_sample_names(self):
+        with self.pool.connection() as con:
+            cursor = con.cursor()
+            cursor.execute('SELECT `name` FROM `mice` ORDER BY `id`')
+            return [row[0] for row in cursor.fetchall()]
+
+    def _store_sample(self, cursor, name, fibers, replace):
+        # Concurrent uploads of the same new name both insert it. The unique index then fails the second one.
+        mouse_id = self._get_sample_id(cursor, name)
+        if mouse_id is None:
+            cursor.execute(self._sql('INSERT INTO `mice` (`name`) VALUES (%s)'), (name,))
+            mouse_id = self._get_sample_id(cursor, name)
+        elif not replace:
+            raise SampleExistsError('A sample named {!r} already exists'.format(name))
+        else:
+            cursor.execute(self._sql('DELETE FROM `fibers` WHERE `mouse_id` = %s'), (mouse_id,))
+        rows = _get_fiber_rows(mouse_id, fibers)
+        sql = 'INSERT INTO `fibers` (`mouse_id`, {}) VALUES ({})'.format(
+            ', '.join('`{}`'.format(name) for name in FIBER_COLUMNS), ', '.join(['%s'] * (len(FIBER_COLUMNS) + 1)))
+        # pymysql sends the rows of an executemany INSERT as multi-row INSERTs
+        cursor.executemany(self._sql(sql), rows)
+        return len(rows)
+
+    def add_fibers(self, name, fibers, replace=True):
+        # Stores the fibers of one sample in one transaction and returns their number. fibers is a FiberTable or a
+        # (n_fibers, 5) array in the order of fiber_table.DATABASE_COLUMNS. The fibers of an existing sample are
+        # replaced, or with replace=False, SampleExistsError is raised and nothing is stored.
+        with self.pool.connection() as con:
+            return self._store_sample(con.cursor(), name, fibers, replace)
+
+    def add_samples(self, samples, replace=True):
+        # add_fibers for every sample of a dict from names to fibers, e.g. a cohort, in one transaction. Either all
+        # samples are stored or none are. Returns the number of fibers stored.
+        with self.pool.connection() as con:
+            cursor = con.cursor()
+            return sum(self._store_sample(cursor, name, fibers, replace) for name, fibers in samples.items())
+
+    def get_fibers(self, name):
+        # (n_fibers, 5) array of the stored fibers of a sample, in the order of FIBER_COLUMNS, or None
+        with self.pool.connection() as con:
+            cursor = con.cursor()
+            mouse_id = self._get_sample_id(cursor, name)
+            if mouse_id is None:
+                return None
+            cursor.execute(self._sql('SELECT {} FROM `fibers` WHERE `mouse_id` = %s ORDER BY `id`'.format(
+                ', '.join('`{}`'.format(column) for column in FIBER_COLUMNS))), (mouse_id,))
+            return np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, len(FIBER_COLUMNS))
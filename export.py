@@ -0,0 +1,67 @@
+import numpy as np
+
+
+def build_data_array(states, areas, min_ferets, scalefactor, resizefactor, dapi_states=None, intensities=None,
+                     positive_states=None):
+    # intensities is either one MFI per fiber, or a (n_channels, n_rois) array for a stack of channels. They are
+    # written as they are, so they should be the background-subtracted corrected_mfi columns of a FiberTable. For a
+    # stack, positive_states has one entry per channel, which is an array of states or None, and every channel gets
+    # its own MFI and Positive column.
+    if intensities is not None and np.ndim(intensities) == 2:
+        n_channels = len(intensities)
+        mfi_columns = [['MFI ch{}'.format(c + 1)] for c in range(n_channels)]
+        positive_columns = [['Positive ch{}'.format(c + 1)] for c in range(n_channels)]
+        if positive_states is None:
+            positive_states = [None] * n_channels
+    else:
+        mfi_columns = [['MFI']]
+        positive_columns = [['Positive']]
+        if intensities is not None:
+            intensities = [intensities]
+        positive_states = [positive_states]
+
+    # Set up the multi-dimensional array to store all of the data
+    dataarray = [['ROI #'], ['Area'], ['Minferet'], ['CNF']] + mfi_columns + positive_columns
+
+    for i in range(len(states)):
+        # Green States
+        if states[i] == 1 or states[i] == 3:
+            # ROI Number
+            dataarray[0].append(str(i))
+
+            # Area
+            dataarray[1].append(areas[i] / (scalefactor ** 2 * resizefactor ** 2))
+
+            # MinFeret
+            dataarray[2].append(min_ferets[i] / (scalefactor * resizefactor))
+
+            # CNF - Purple States
+            if dapi_states is not None:
+                dataarray[3].append("1" if dapi_states[i] == 3 else "0")
+
+            # MFI
+            if intensities is not None:
+                for column, mfi in zip(mfi_columns, intensities):
+                    column.append(mfi[i])
+
+            # Positive Fibers
+            for column, positives in zip(positive_columns, positive_states):
+                if positives is not None:
+                    column.append("1" if positives[i] == 3 else "0")
+    return dataarray
+
+
+def write_xlsx(filename, dataarray, scalefactor, resizefactor):
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(filename)
+    worksheet = workbook.add_worksheet()
+    for column, data in enumerate(dataarray):
+        worksheet.write_column(0, column, data)
+
+    # The scale factors go in the two columns after the data
+    worksheet.write(0, len(dataarray), 'Scale Factor (pixels/micron)')
+    worksheet.write(1, len(dataarray), scalefactor)
+    worksheet.write(0, len(dataarray) + 1, 'Resize Factor')
+    worksheet.write(1, len(dataarray) + 1, resizefactor)
+
+    workbook.close()
@@ -0,0 +1,200 @@
+import numpy as np
+from scipy import ndimage
+from skimage.measure import label
+
+from .segmentation import select_labels
+from .roi_map import map_rois
+
+
+# Offsets and weights of the neighbours used by skimage.measure.perimeter to classify boundary pixels
+PERIMETER_NEIGHBOURS = [(-1, -1, 10), (-1, 0, 2), (-1, 1, 10), (0, -1, 2), (0, 1, 2), (1, -1, 10), (1, 0, 2), (1, 1, 10)]
+PERIMETER_WEIGHTS = np.zeros(50)
+PERIMETER_WEIGHTS[[5, 7, 15, 17, 25, 27]] = 1
+PERIMETER_WEIGHTS[[21, 33]] = np.sqrt(2)
+PERIMETER_WEIGHTS[[13, 23]] = (1 + np.sqrt(2)) / 2
+
+
+def _shifted(padded, dx, dy):
+    # View of a 1-pixel padded image, shifted so that each pixel lines up with its neighbour at (dx, dy)
+    mx, my = padded.shape[0] - 2, padded.shape[1] - 2
+    return padded[1 + dx:1 + dx + mx, 1 + dy:1 + dy + my]
+
+
+def get_areas(label_img):
+    # Number of pixels in every ROI, indexed by ROI number
+    return np.bincount(label_img.ravel(), minlength=int(np.max(label_img)) + 1)[1:]
+
+
+def get_filled_areas(label_img):
+    # Area of every ROI with its holes filled, the same measure as RegionProperties.filled_area.
+    # Only ROIs next to a patch of background that does not reach the edge of the image can have holes, so only
+    # those are filled one by one.
+    areas = get_areas(label_img)
+    background = label(label_img == 0, connectivity=2)
+    edge = np.unique(np.r_[background[:, 0], background[0, :], background[-1, :], background[:, -1]])
+    enclosed = ~select_labels(background, edge) & (label_img == 0)
+    padded = np.pad(label_img, 1, mode='constant')
+    candidates = [_shifted(padded, dx, dy)[enclosed] for dx, dy, _ in PERIMETER_NEIGHBOURS]
+    candidates = np.unique(np.concatenate(candidates))
+    candidates = candidates[candidates > 0] - 1
+    filled = map_rois(_filled_area, label_img, rois=candidates)
+    areas[candidates] = filled
+    return areas
+
+
+def _filled_area(mask, intensity):
+    return np.count_nonzero(ndimage.binary_fill_holes(mask, np.ones((3, 3))))
+
+
+def get_perimeters(label_img):
+    # Perimeter of every ROI, the same measure as RegionProperties.perimeter, for all ROIs at once.
+    # A pixel is on the boundary of its ROI if one of its 4 neighbours is not. Each boundary pixel is weighted by
+    # which of its 8 neighbours are boundary pixels of the same ROI.
+    n_rois = int(np.max(label_img))
+    padded = np.pad(label_img, 1, mode='constant')
+    boundary = label_img > 0
+    interior = boundary.copy()
+    for dx, dy, weight in PERIMETER_NEIGHBOURS:
+        if weight == 2:
+            interior &= _shifted(padded, dx, dy) == label_img
+    boundary &= ~interior
+    padded_boundary = np.pad(boundary, 1, mode='constant')
+    codes = boundary.astype(np.intp)
+    for dx, dy, weight in PERIMETER_NEIGHBOURS:
+        codes += weight * (_shifted(padded_boundary, dx, dy) & (_shifted(padded, dx, dy) == label_img))
+    return np.bincount(label_img[boundary], weights=PERIMETER_WEIGHTS[codes[boundary]], minlength=n_rois + 1)[1:]
+
+
+def get_inertia_eigvals(label_img):
+    # Eigenvalues (largest first) of the inertia tensor of every ROI, as in RegionProperties.inertia_tensor_eigvals
+    n_rois = int(np.max(label_img))
+    rows, cols = np.nonzero(label_img)
+    labels = label_img[rows, cols]
+    area = np.maximum(np.bincount(labels, minlength=n_rois + 1), 1)
+    dr = rows - (np.bincount(labels, weights=rows, minlength=n_rois + 1) / area)[labels]
+    dc = cols - (np.bincount(labels, weights=cols, minlength=n_rois + 1) / area)[labels]
+    mu20 = np.bincount(labels, weights=dr * dr, minlength=n_rois + 1)[1:] / area[1:]
+    mu02 = np.bincount(labels, weights=dc * dc, minlength=n_rois + 1)[1:] / area[1:]
+    mu11 = np.bincount(labels, weights=dr * dc, minlength=n_rois + 1)[1:] / area[1:]
+    common = np.sqrt(4 * mu11 ** 2 + (mu20 - mu02) ** 2)
+    l1 = np.maximum((mu20 + mu02 + common) / 2, 0)
+    l2 = np.maximum((mu20 + mu02 - common) / 2, 0)
+    return l1, l2
+
+
+def get_convex_hulls(label_img):
+    # Convex hulls of every ROI in a label image, as flat arrays.
+    # Returns (points, bounds). The hull of ROI i (label i + 1) is points[bounds[i]:bounds[i + 1]], a list of
+    # (row, col) vertices in clockwise order.
+    mx, my = label_img.shape
+    n_rois = int(np.max(label_img))
+
+    # The hull only depends on the leftmost and rightmost pixel of each row of each ROI
+    padded = np.pad(label_img, ((0, 0), (1, 1)), mode='constant')
+    rows, cols = np.nonzero((padded[:, 1:-1] != padded[:, :-2]) & (padded[:, 1:-1] > 0))
+    keys = label_img[rows, cols].astype(np.int64) * mx + rows
+    order = np.argsort(keys, kind='stable')
+    left = cols[order]
+    rows, cols = np.nonzero((padded[:, 1:-1] != padded[:, 2:]) & (padded[:, 1:-1] > 0))
+    keys = label_img[rows, cols].astype(np.int64) * mx + rows
+    order = np.argsort(keys, kind='stable')
+    right = cols[order]
+    keys = keys[order]
+    first = np.r_[True, keys[1:] != keys[:-1]]
+    last = np.r_[keys[1:] != keys[:-1], True]
+    roi, row = np.divmod(keys[first], mx)
+    roi -= 1
+    left, right = left[np.nonzero(first)[0]], right[last]
+
+    # Walk down the right side of each ROI and back up the left side. Like RegionProperties.convex_image, each
+    # pixel is represented by the midpoints of its edges, and only the outer ones of each row can be on the hull.
+    rank = np.arange(len(row)) - np.searchsorted(roi, roi)
+    points = np.concatenate([np.c_[row - .5, right], np.c_[row, right + .5], np.c_[row + .5, right],
+                             np.c_[row + .5, left], np.c_[row, left - .5], np.c_[row - .5, left]])
+    point_roi = np.tile(roi, 6)
+    side = np.repeat([0, 0, 0, 1, 1, 1], len(row))
+    position = np.concatenate([3 * rank, 3 * rank + 1, 3 * rank + 2, -3 * rank, -3 * rank + 1, -3 * rank + 2])
+    order = np.lexsort((position, side, point_roi))
+    points, point_roi = points[order], point_roi[order]
+    keep = np.r_[True, np.any(points[1:] != points[:-1], 1) | (point_roi[1:] != point_roi[:-1])]
+    points, point_roi = points[keep], point_roi[keep]
+    # The outline of a ROI whose top row is one pixel wide also starts where it ends
+    bounds = np.searchsorted(point_roi, np.arange(n_rois + 1))
+    closed = np.all(points[bounds[1:] - 1] == points[bounds[:-1]], 1) & (bounds[1:] > bounds[:-1] + 1)
+    keep = np.ones(len(points), dtype=bool)
+    keep[bounds[1:][closed] - 1] = False
+    points, point_roi = points[keep], point_roi[keep]
+
+    # Remove every vertex that does not turn clockwise until only the hull is left. The outline is monotone in
+    # rows, so hull vertices are never removed.
+    while True:
+        bounds = np.searchsorted(point_roi, np.arange(n_rois + 1))
+        idx = np.arange(len(points))
+        prev = np.where(idx == bounds[point_roi], bounds[point_roi + 1] - 1, idx - 1)
+        nxt = np.where(idx == bounds[point_roi + 1] - 1, bounds[point_roi], idx + 1)
+        a = points - points[prev]
+        b = points[nxt] - points
+        reflex = a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0] >= 0
+        if not np.any(reflex):
+            break
+        points, point_roi = points[~reflex], point_roi[~reflex]
+    return points, bounds
+
+
+def _get_hull_edges(hulls):
+    points, bounds = hulls
+    point_roi = np.repeat(np.arange(len(bounds) - 1), np.diff(bounds))
+    idx = np.arange(len(points))
+    nxt = np.where(idx == bounds[point_roi + 1] - 1, bounds[point_roi], idx + 1)
+    return points[nxt] - points, point_roi
+
+
+def get_convex_areas(hulls):
+    # Number of pixels whose centres lie in each hull, the same measure as RegionProperties.convex_area.
+    # The top and bottom of every hull are half way between pixel rows, so every pixel row crosses exactly one
+    # edge going down the right side of a hull and one edge going up its left side. Each edge is assigned the
+    # rows from its upper end (inclusive) to its lower end (exclusive).
+    points, bounds = hulls
+    edges, point_roi = _get_hull_edges(hulls)
+    crossings = []
+    for going_down in (True, False):
+        idx = np.nonzero(edges[:, 0] > 0 if going_down else edges[:, 0] < 0)[0]
+        upper = np.where(going_down, points[idx, 0], points[idx, 0] + edges[idx, 0])
+        lower = upper + np.abs(edges[idx, 0])
+        first_row = np.ceil(upper).astype(np.int64)
+        n_rows = np.ceil(lower).astype(np.int64) - first_row
+        idx = np.repeat(idx, n_rows)
+        rows = np.repeat(first_row, n_rows) + np.arange(len(idx)) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+        cols = points[idx, 1] + (rows - points[idx, 0]) * edges[idx, 1] / edges[idx, 0]
+        order = np.lexsort((rows, point_roi[idx]))
+        crossings.append((point_roi[idx][order], cols[order]))
+    (rois, right), (_, left) = crossings
+    counts = np.floor(right + 1e-9) - np.ceil(left - 1e-9) + 1
+    return np.bincount(rois, weights=np.maximum(counts, 0), minlength=len(bounds) - 1).astype(np.int64)
+
+
+def calc_min_feret_diameters(hulls):
+    # Exact minimum feret diameter of every hull, using rotating calipers.
+    # The minimum width of a convex polygon is measured perpendicular to one of its edges. For each edge, the
+    # farthest vertex is the one whose neighbouring edges bracket the opposite direction, found for all edges of
+    # all hulls with a single searchsorted over the edge angles.
+    points, bounds = hulls
+    edges, point_roi = _get_hull_edges(hulls)
+    n_rois = len(bounds) - 1
+    angles = np.arctan2(edges[:, 1], edges[:, 0])
+    # Clockwise hulls have decreasing edge angles. Measure them from the first edge so they increase within a ROI.
+    angles = np.mod(angles[bounds[point_roi]] - angles, 2 * np.pi)
+    keys = point_roi * 8 + angles
+    opposite = point_roi * 8 + np.mod(angles + np.pi, 2 * np.pi)
+    far = np.searchsorted(keys, opposite, side='right')
+    lengths = np.diff(bounds)[point_roi]
+    start = bounds[point_roi]
+    widths = np.zeros(len(points))
+    for shift in (-1, 0, 1):
+        vertex = start + np.mod(far - start + shift, lengths)
+        d = points[vertex] - points
+        widths = np.maximum(widths, np.abs(edges[:, 0] * d[:, 1] - edges[:, 1] * d[:, 0]))
+    widths /= np.hypot(edges[:, 0], edges[:, 1])
+    min_feret_diameters = np.full(n_rois, np.inf)
+    np.minimum.at(min_feret_diameters, point_roi, widths)
+    return min_feret_diameters
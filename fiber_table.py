@@ -0,0 +1,165 @@
+import re
+import threading
+import numpy as np
+
+from .features import (get_areas, get_filled_areas, get_perimeters, get_inertia_eigvals, get_convex_hulls,
+                       get_convex_areas, calc_min_feret_diameters)
+from .analysis import INTENSITY_PERCENTILES, get_channel_intensity_stats, get_erosion_depths, subtract_background
+from .stacks import as_channel_stack
+
+
+# Columns of the features array used for SVM training, classification and filtering, in the order of
+# classification.FILTER_FEATURES. Saved training data uses this layout.
+CLASSIFICATION_COLUMNS = ['filled_area', 'eccentricity', 'convexity', 'circularity']
+
+# Columns stored for every fiber by database.FiberDatabase.add_fibers
+DATABASE_COLUMNS = ['filled_area', 'eccentricity', 'convexity', 'circularity', 'minor_axis_length']
+
+
+class FiberTable:
+    """
+    Columnar table of fiber features for one label image. Row i is ROI i (label i + 1).
+
+    Each column is one array, computed for every fiber at once the first time it is read and cached after that.
+    Classification, filtering, export and the database all read from the same table, so no feature is computed
+    twice for a segmentation. Columns:
+
+    area, filled_area, perimeter, eccentricity, major_axis_length, minor_axis_length, convex_area, convexity,
+    circularity, min_feret
+
+    With an intensity image: mfi, median_intensity, integrated_intensity and intensity_p10, _p25, _p75, _p90, all
+    from one pass over the image, and corrected_mfi, the MFI minus the background set with set_background. Changing
+    the background only recomputes corrected_mfi from mfi. With a stack of several channels, each of these has one
+    column per channel, named e.g. mfi_ch1, mfi_ch2.
+
+    A table can be shared by the GUI thread and background jobs (see workers.py). Columns are computed, and the
+    intensity image replaced, under a lock, so each column is computed once and never from a half-replaced image.
+    """
+
+    def __init__(self, label_img, intensity_img=None):
+        self.label_img = label_img
+        self.n_rois = int(np.max(label_img))
+        self.columns = {}
+        self.convex_hulls = None
+        self.erosion_depths = None
+        # Reentrant, since columns are computed from other columns
+        self.lock = threading.RLock()
+        self.background = 0.
+        self.set_intensity_image(intensity_img)
+
+    def __len__(self):
+        return self.n_rois
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        column = self.columns.get(name)
+        if column is not None:
+            return column
+        with self.lock:
+            if name not in self.columns:
+                base_name = re.sub(r'_ch\d+$', '', name)
+                compute = getattr(self, '_compute_' + COLUMN_GROUPS.get(base_name, base_name), None)
+                if compute is None:
+                    raise KeyError('Unknown fiber feature: {}'.format(name))
+                compute()
+                if name not in self.columns:
+                    raise KeyError('Unknown fiber feature: {}'.format(name))
+            return self.columns[name]
+
+    def get_columns(self, names):
+        # (n_rois, len(names)) array of the named columns
+        return np.column_stack([self[name] for name in names]) if names else np.zeros((self.n_rois, 0))
+
+    def get_features_array(self):
+        return self.get_columns(CLASSIFICATION_COLUMNS)
+
+    def set_intensity_image(self, intensity_img):
+        # A 2D image, or a stack of channels (see stacks.as_channel_stack)
+        with self.lock:
+            self.intensity_img = intensity_img
+            self.n_channels = 0 if intensity_img is None else len(as_channel_stack(intensity_img))
+            self._drop_columns(INTENSITY_COLUMNS + ['corrected_mfi'])
+
+    def set_background(self, background):
+        # Value subtracted from the MFI of every channel in the corrected_mfi columns
+        with self.lock:
+            if background != self.background:
+                self.background = background
+                self._drop_columns(['corrected_mfi'])
+
+    def _drop_columns(self, base_names):
+        for name in list(self.columns):
+            if re.sub(r'_ch\d+$', '', name) in base_names:
+                del self.columns[name]
+
+    def get_channel_names(self, name):
+        # Names of the column of an intensity feature for every channel
+        if self.n_channels == 1:
+            return [name]
+        return ['{}_ch{}'.format(name, channel + 1) for channel in range(self.n_channels)]
+
+    def get_convex_hulls(self):
+        with self.lock:
+            if self.convex_hulls is None:
+                self.convex_hulls = get_convex_hulls(self.label_img)
+            return self.convex_hulls
+
+    def get_erosion_depths(self):
+        # Image of erosion depths for analysis.erode_fibers. Any erosion percentage is a lookup into it.
+        with self.lock:
+            if self.erosion_depths is None:
+                self.erosion_depths = get_erosion_depths(self.label_img)
+            return self.erosion_depths
+
+    def _compute_area(self):
+        self.columns['area'] = get_areas(self.label_img)
+
+    def _compute_filled_area(self):
+        self.columns['filled_area'] = get_filled_areas(self.label_img)
+
+    def _compute_perimeter(self):
+        self.columns['perimeter'] = get_perimeters(self.label_img)
+
+    def _compute_moments(self):
+        l1, l2 = get_inertia_eigvals(self.label_img)
+        self.columns['eccentricity'] = np.sqrt(1 - l2 / np.where(l1 == 0, 1, l1)) * (l1 > 0)
+        self.columns['major_axis_length'] = 4 * np.sqrt(l1)
+        self.columns['minor_axis_length'] = 4 * np.sqrt(l2)
+
+    def _compute_convex_area(self):
+        self.columns['convex_area'] = get_convex_areas(self.get_convex_hulls())
+
+    def _compute_convexity(self):
+        self.columns['convexity'] = self['filled_area'] / self['convex_area']
+
+    def _compute_circularity(self):
+        perimeter = self['perimeter']
+        circularity = 4 * np.pi * self['filled_area'] / np.where(perimeter == 0, 1, perimeter) ** 2
+        self.columns['circularity'] = np.where(perimeter == 0, 0, circularity)
+
+    def _compute_min_feret(self):
+        self.columns['min_feret'] = calc_min_feret_diameters(self.get_convex_hulls())
+
+    def _compute_intensity(self):
+        if self.intensity_img is None:
+            raise KeyError('Intensity features need an intensity image. Call set_intensity_image first.')
+        channels = as_channel_stack(self.intensity_img)
+        channel_stats = get_channel_intensity_stats(self.label_img, channels, INTENSITY_PERCENTILES, self.n_rois)
+        for name in INTENSITY_COLUMNS:
+            stat_name = 'mean_intensity' if name == 'mfi' else name
+            for column, stats in zip(self.get_channel_names(name), channel_stats):
+                self.columns[column] = stats[stat_name]
+
+    def _compute_corrected_mfi(self):
+        for column, mfi in zip(self.get_channel_names('corrected_mfi'), self.get_channel_names('mfi')):
+            self.columns[column] = subtract_background(self[mfi], self.background)
+
+
+INTENSITY_COLUMNS = ['mfi', 'median_intensity', 'integrated_intensity'] + \
+                    ['intensity_p{}'.format(q) for q in INTENSITY_PERCENTILES]
+
+# Columns that are computed together
+COLUMN_GROUPS = {'eccentricity': 'moments', 'major_axis_length': 'moments', 'minor_axis_length': 'moments'}
+COLUMN_GROUPS.update({name: 'intensity' for name in INTENSITY_COLUMNS})
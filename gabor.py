@@ -0,0 +1,113 @@
+"""
+Gabor filter bank for texture-based boundary enhancement.
+
+The kernels are built the first time they are used and cached. Filtering an image computes its FFT once and reuses
+it for every kernel, filters the kernels in a pool of threads, and reduces the responses as they are produced
+(reduce_gabor_responses), so only a few full-size responses are held in memory at once instead of one per kernel.
+"""
+import os
+import functools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+def generate_kernel(theta=0):
+    from skimage.filters import gabor_kernel
+    frequency = .1
+    sigma_x = 1  # left right axis. Bigger this number, smaller the width
+    sigma_y = 2  # right left axis. Bigger this number, smaller the height
+    kernel = np.real(gabor_kernel(frequency, theta, sigma_x, sigma_y))
+    kernel -= np.mean(kernel)
+    return kernel
+
+
+def get_thetas(n_orientations=40):
+    return np.linspace(0, np.pi, n_orientations)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_kernels(n_orientations):
+    kernels = tuple(generate_kernel(theta) for theta in get_thetas(n_orientations))
+    for kernel in kernels:
+        kernel.flags.writeable = False
+    return kernels
+
+
+def get_kernels(n_orientations=40):
+    # One kernel per orientation in get_thetas. The kernels are cached and read-only.
+    return list(_get_kernels(n_orientations))
+
+
+class _ImageSpectrum:
+    """
+    The FFT of an image, padded for convolution with kernels of up to kernel_shape. filter(kernel) gives the same
+    result as scipy.signal.fftconvolve(image, kernel, 'same') for kernels with an odd size.
+    """
+
+    def __init__(self, image, kernel_shape, dtype=np.float32):
+        from scipy import fft
+        self.fft = fft
+        self.image_shape = image.shape
+        self.kernel_shape = kernel_shape
+        self.dtype = dtype
+        full_shape = [s + k - 1 for s, k in zip(image.shape, kernel_shape)]
+        self.fft_shape = [fft.next_fast_len(s, real=True) for s in full_shape]
+        self.spectrum = fft.rfft2(np.asarray(image, dtype=np.float64), self.fft_shape)
+
+    def filter(self, kernel):
+        # Center the kernel in kernel_shape, so every kernel is cropped the same way
+        padded = np.zeros(self.kernel_shape)
+        offsets = [(p - k) // 2 for p, k in zip(self.kernel_shape, kernel.shape)]
+        padded[offsets[0]:offsets[0] + kernel.shape[0], offsets[1]:offsets[1] + kernel.shape[1]] = kernel
+        response = self.fft.irfft2(self.spectrum * self.fft.rfft2(padded, self.fft_shape), self.fft_shape)
+        x0, y0 = [(k - 1) // 2 for k in self.kernel_shape]
+        return response[x0:x0 + self.image_shape[0], y0:y0 + self.image_shape[1]].astype(self.dtype)
+
+
+def iter_gabor_responses(image, kernels=None, threads=None, dtype=np.float32):
+    # Yields (kernel index, response) for every kernel, in order. Only about threads responses are in memory at once.
+    if kernels is None:
+        kernels = get_kernels()
+    kernel_shape = tuple(max(kernel.shape[d] for kernel in kernels) for d in range(2))
+    spectrum = _ImageSpectrum(image, kernel_shape, dtype)
+    if threads is None:
+        threads = os.cpu_count() or 1
+    if threads == 1:
+        for k, kernel in enumerate(kernels):
+            yield k, spectrum.filter(kernel)
+        return
+    with ThreadPoolExecutor(threads) as executor:
+        for start in range(0, len(kernels), threads):
+            batch = kernels[start:start + threads]
+            for k, response in enumerate(executor.map(spectrum.filter, batch), start):
+                yield k, response
+
+
+def reduce_gabor_responses(image, kernels=None, threads=None, callback=None):
+    # Reduces the responses of the filter bank without keeping them. Returns a dict of images:
+    #   max          the largest response over all orientations
+    #   orientation  the index of the kernel with the largest response
+    #   energy       the sum of the squared responses
+    # callback is called after every kernel, e.g. to keep a GUI responsive.
+    # The responses are compared in float64, so orientation is the same as the argmax of the stacked responses
+    max_response = orientation = energy = None
+    for k, response in iter_gabor_responses(image, kernels, threads, np.float64):
+        if max_response is None:
+            max_response = response
+            orientation = np.zeros(response.shape, dtype=np.uint8)
+            energy = response ** 2
+        else:
+            larger = response > max_response
+            np.copyto(max_response, response, where=larger)
+            orientation[larger] = k
+            energy += response ** 2
+        if callback is not None:
+            callback()
+    if max_response is None:
+        raise ValueError('The filter bank has no kernels')
+    return {'max': max_response.astype(np.float32), 'orientation': orientation, 'energy': energy.astype(np.float32)}
+
+
+def convolve_with_kernels_fft(i, kernels):
+    # The full (n_kernels, mx, my) stack of responses. reduce_gabor_responses uses much less memory.
+    return np.array([response for _, response in iter_gabor_responses(i, kernels, dtype=np.float64)])
@@ -1,19 +1,17 @@
 from flika.window import Window
 from flika.utils.misc import save_file_gui, open_file_gui
 from flika import global_vars as g
-from skimage import measure
-from skimage import morphology
-from skimage.measure import label
-from skimage.morphology import diamond
 from qtpy import QtWidgets
+import pyqtgraph as pg
 import numpy as np
 import json
 import codecs
 
-
-def rotation_matrix(theta):
-    return np.array([[np.cos(theta), -np.sin(theta)],
-                     [np.sin(theta), np.cos(theta)]])
+from .segmentation import select_labels
+from .segmentation_cache import get_segmentation
+from .classification import get_training_data
+from .training_store import TrainingStore, get_image_hash
+from .analysis import erode_fibers
 
 
 class ClassifierWindow(Window):
@@ -25,54 +23,60 @@ class ClassifierWindow(Window):
     PURPLE = np.array([True, False, True])
     YELLOW = np.array([True, True, False])
 
+    # Number of ROIs redrawn on their own before the whole image is redrawn
+    MAX_ROI_PATCHES = 256
+
     TRAINING = "TRAINING"
     DAPI = "DAPI"
     FLR = "FLOURESCENCE"
 
-    def __init__(self, tif, name='flika', filename='', commands=None, metadata=None):
+    def __init__(self, tif, name='flika', filename='', commands=None, metadata=None, segmentation=None):
         if commands is None:
             commands = []
         if metadata is None:
             metadata = dict()
 
-        tif = tif.astype(np.bool)
-        super().__init__(tif, name, filename, commands, metadata)
+        # Windows of the same binary image share one segmentation, so only the states and colors are per window
+        if segmentation is None:
+            segmentation = get_segmentation(tif)
+        self.segmentation = segmentation
+        super().__init__(segmentation.binary_image, name, filename, commands, metadata)
 
         # Window images
         self.imageIdentifier = None
-        self.labeled_img = label(tif, connectivity=2)
-        self.eroded_labeled_img = label(tif, connectivity=2)
-        self.colored_img = np.repeat(self.image[:, :, np.newaxis], 3, 2)
+        self.labeled_img = segmentation.labeled_img
+        self.fiber_table = segmentation.fiber_table
+        # Allocated by the first erosion
+        self.eroded_labeled_img = None
+        # Color of every label, background first. The displayed image is always label_colors[labeled_img].
+        self.label_colors = np.repeat(ClassifierWindow.WHITE[np.newaxis], int(np.max(self.labeled_img)) + 1, 0)
+        self.label_colors[0] = ClassifierWindow.BLACK
+        self.colored_img = self.label_colors[self.labeled_img]
         self.imageview.setImage(self.colored_img)
 
         # Window specific ROI and States
-        self.window_props = None
         self.window_states = None
-        self.temp_props = None
         self.temp_states = None
+        self.roi_patches = {}
 
         # GUI Actions
         self.menu.addAction(QtWidgets.QAction("&Save Training Data", self, triggered=self.save_training_data))
         self.menu.addAction(QtWidgets.QAction("&Save Classifications", self, triggered=self.save_classifications))
         self.menu.addAction(QtWidgets.QAction("&Load Classifications", self, triggered=self.load_classifications_act))
         self.menu.addAction(QtWidgets.QAction("&Create Binary Window", self, triggered=self.create_binary_window))
-        self.features_array = None
-        self.features_array_extended = None
 
     def mouseClickEvent(self, ev):
-        if self.window_props is None:
-            self.window_props = measure.regionprops(self.labeled_img)
         if ev.button() == 1:
             x = int(self.x)
             y = int(self.y)
             try:
-                roi_num = self.labeled_img[x, y] - 1
+                roi_num = int(self.labeled_img[x, y]) - 1
             except IndexError:
                 roi_num = -1
             if roi_num < 0:
                 pass
             else:
-                prop = self.window_props[roi_num]
+                fibers = self.fiber_table
 
                 mfi = 'Unknown'
                 if g.quantimus.flourescenceIntensities is not None:
@@ -80,37 +84,31 @@ class ClassifierWindow(Window):
 
                 print('ROI #{}. area={}. eccentricity={}. convexity={}. circularity={}. perimeter={}. minor_axis_length={}. MFI={}. '
                       .format(roi_num,
-                              prop.area,
-                              prop.eccentricity,
-                              prop.area / prop.convex_area,
-                              (4 * np.pi * prop.area) / (prop.perimeter * prop.perimeter),
-                              prop.perimeter,
-                              prop.minor_axis_length,
+                              fibers['filled_area'][roi_num],
+                              fibers['eccentricity'][roi_num],
+                              fibers['convexity'][roi_num],
+                              fibers['circularity'][roi_num],
+                              fibers['perimeter'][roi_num],
+                              fibers['minor_axis_length'][roi_num],
                               mfi))
 
                 # Different windows have different MouseClickEvent logic
                 if self.imageIdentifier == ClassifierWindow.TRAINING:
-                    x, y = self.window_props[roi_num].coords.T
                     color, state = self.training_mouse_click_event(roi_num)
                     self.window_states[roi_num] = state
-                    self.colored_img[x, y] = color
-                    self.update_image(self.colored_img)
+                    self.paint_roi(roi_num, color)
                 elif self.imageIdentifier == ClassifierWindow.FLR:
                     if self.temp_states is None:
                         self.temp_states = np.copy(self.window_states)
-                    x, y = self.window_props[roi_num].coords.T
                     color, state = self.flr_mouse_click_event(roi_num)
                     self.temp_states[roi_num] = state
-                    self.colored_img[x, y] = color
-                    self.update_image(self.colored_img)
-                    self.update_parent_image(roi_num, x, y, self.temp_states)
+                    self.paint_roi(roi_num, color)
+                    self.update_parent_image(roi_num, self.temp_states)
                 elif self.imageIdentifier == ClassifierWindow.DAPI:
-                    x, y = self.window_props[roi_num].coords.T
                     color, state = self.dapi_mouse_click_event(roi_num)
                     self.window_states[roi_num] = state
-                    self.colored_img[x, y] = color
-                    self.update_image(self.colored_img)
-                    self.update_parent_image(roi_num, x, y, self.window_states)
+                    self.paint_roi(roi_num, color)
+                    self.update_parent_image(roi_num, self.window_states)
 
         super().mouseClickEvent(ev)
 
@@ -139,21 +137,49 @@ class ClassifierWindow(Window):
         return color, new_state
 
     def update_image(self, image):
+        self.clear_roi_patches()
         viewrange = self.imageview.getView().viewRange()
         xrange, yrange = viewrange
         self.imageview.setImage(image)
         self.imageview.getView().setXRange(xrange[0], xrange[1], 0, False)
         self.imageview.getView().setYRange(yrange[0], yrange[1], 0)
 
-    def update_parent_image(self, roi_num, x, y, states):
+    def paint_roi(self, roi_num, color):
+        # Recolors one ROI and redraws only its bounding box, so the cost does not depend on the size of the image
+        bbox = self.segmentation.get_roi_slices()[roi_num]
+        self.label_colors[roi_num + 1] = color
+        self.colored_img[bbox][self.labeled_img[bbox] == roi_num + 1] = color
+        self.update_image_region(roi_num, bbox)
+
+    def update_image_region(self, roi_num, bbox):
+        # Draws colored_img[bbox] as a small image on top of the displayed one. The patch is a child of the image
+        # item, so it shares its transform and stays under any overlay above the image. The newest patch is always
+        # on top and up to date, which keeps older patches it overlaps from showing stale colors.
+        old_patch = self.roi_patches.pop(roi_num, None)
+        if old_patch is not None:
+            old_patch.scene().removeItem(old_patch)
+        if len(self.roi_patches) >= ClassifierWindow.MAX_ROI_PATCHES:
+            self.update_image(self.colored_img)
+            return
+        patch = pg.ImageItem(self.colored_img[bbox].astype(np.uint8) * 255, levels=(0, 255))
+        patch.setParentItem(self.imageview.getImageItem())
+        patch.setPos(bbox[0].start, bbox[1].start)
+        self.roi_patches[roi_num] = patch
+
+    def clear_roi_patches(self):
+        for patch in self.roi_patches.values():
+            if patch.scene() is not None:
+                patch.scene().removeItem(patch)
+        self.roi_patches = {}
+
+    def update_parent_image(self, roi_num, states):
         # Update the Parent window's colors
         if g.quantimus.filtered_trained_img is not None:
             # Update the Filtered Trained Image if available
             try:
                 trained_color, trained_state = self.filtered_mouse_click_event(roi_num, states)
                 g.quantimus.filtered_trained_img.window_states[roi_num] = trained_state
-                g.quantimus.filtered_trained_img.colored_img[x, y] = trained_color
-                g.quantimus.filtered_trained_img.update_image(g.quantimus.filtered_trained_img.colored_img)
+                g.quantimus.filtered_trained_img.paint_roi(roi_num, trained_color)
                 # Update the Parent window's States
                 g.quantimus.roiStates[roi_num] = trained_state
             except AttributeError:
@@ -163,8 +189,7 @@ class ClassifierWindow(Window):
             try:
                 trained_color, trained_state = self.filtered_mouse_click_event(roi_num, states)
                 g.quantimus.trained_img.window_states[roi_num] = trained_state
-                g.quantimus.trained_img.colored_img[x, y] = trained_color
-                g.quantimus.trained_img.update_image(g.quantimus.trained_img.colored_img)
+                g.quantimus.trained_img.paint_roi(roi_num, trained_color)
                 # Update the Parent window's States
                 g.quantimus.roiStates[roi_num] = trained_state
             except AttributeError:
@@ -181,85 +206,40 @@ class ClassifierWindow(Window):
         return color, new_state
 
     def get_features_array(self):
-        # important features include:
-        # convexity: ratio of convex_image area to image area
-        # area: number of pixels total
-        # eccentricity: 0 is a circle, 1 is a line
-        if self.features_array is None:
-            if self.window_props is None:
-                self.window_props = measure.regionprops(self.labeled_img)
-            area = np.array([p.filled_area for p in self.window_props])
-            eccentricity = np.array([p.eccentricity for p in self.window_props])
-            convexity = np.array([p.filled_area / p.convex_area for p in self.window_props])
-            perimeter = np.array([p.perimeter for p in self.window_props])
-            circularity = np.empty_like(perimeter)
-
-            for i in np.arange(len(circularity)):
-                if perimeter[i] == 0:
-                    circularity[i] = 0
-                else:
-                    circularity[i] = (4 * np.pi * area[i]) / perimeter[i]**2
-            self.features_array = np.array([area, eccentricity, convexity, circularity]).T
-        return self.features_array
-
-    def calculate_window_props(self):
-        if self.window_props is None:
-            self.window_props = measure.regionprops(self.labeled_img)
+        return self.fiber_table.get_features_array()
 
     def get_training_data(self):
-        if self.features_array is None:
-            self.features_array = self.get_features_array()
-        states = np.array([np.asscalar(a)for a in self.window_states])
-        x = self.features_array[states > 0, :]
-        y = states[states > 0]
-        y[y == 2] = 0
-        return x, y
+        return get_training_data(self.get_features_array(), np.asarray(self.window_states))
 
     def get_extended_features_array(self):
-        if self.features_array is None:
-            self.features_array = self.get_features_array()
-
-        min_ferets = np.array([g.quantimus.calc_min_feret_diameters(g.win.props)]).T
-        roi_num = np.arange(self.window_states)
-        area = self.features_array[:, 0]
-
-        x = np.concatenate((roi_num[:, np.newaxis], area[:, np.newaxis], min_ferets), 1)
-        if g.quantimus.intensity_img is not None and g.quantimus.flourescence_img is not None:
-            y = measure.regionprops(g.quantimus.flourescence_img, g.quantimus.intensity_img)
-            mfi = np.array([p.mean_intensity for p in y])
-            x = np.concatenate((x, mfi[:, np.newaxis]), 1)
-        return x
+        # ROI number, area, minimum feret diameter and, once it has been measured, the MFI of every channel
+        columns = ['filled_area', 'min_feret']
+        if self.fiber_table.intensity_img is not None:
+            columns.extend(self.fiber_table.get_channel_names('mfi'))
+        roi_num = np.arange(len(self.fiber_table))
+        return np.concatenate((roi_num[:, np.newaxis], self.fiber_table.get_columns(columns)), 1)
 
     def save_classifications(self):
         filename = save_file_gui("Save classifications", filetypes='*.json')
         if filename is None:
             return None
-        states = [np.asscalar(a)for a in self.window_states]
-        data = {'states': states}
+        data = {'states': np.asarray(self.window_states).tolist()}
         # this saves the array in .json format
-        json.dump(data, codecs.open(filename, 'w', encoding='utf-8'), separators=(',', ':'), sort_keys=True, indent=4)
+        json.dump(data, codecs.open(filename, 'w', encoding='utf-8'), separators=(',', ':'), sort_keys=True)
 
     def save_training_data(self):
-        progress = g.quantimus.create_progress_bar('Please wait training data is being saved...')
-        progress.show()
-        QtWidgets.QApplication.processEvents()
-
-        filename = save_file_gui("Save training_data", filetypes='*.json')
-        if filename is None:
+        # The labeled fibers are appended to a training store, which can hold any number of sessions and images
+        directory = QtWidgets.QFileDialog.getExistingDirectory(None, 'Select a training store directory')
+        if not directory:
             return None
-        x, y = self.get_training_data()
-        y = y.tolist()
-        x = x.tolist()
-        data = {'features': x, 'states': y}
-        # this saves the array in .json format
-        json.dump(data, codecs.open(filename, 'w', encoding='utf-8'), separators=(',', ':'), sort_keys=True, indent=4)
+        store = TrainingStore(directory)
+        states = np.asarray(self.window_states)
+        store.append(self.get_features_array(), states, np.arange(len(states)), get_image_hash(self.labeled_img),
+                     self.name)
 
     def create_binary_window(self):
-        true_rois = self.window_states == 1
-        bin_im = np.zeros_like(self.image, dtype=np.uint8)
-        for i in np.nonzero(true_rois)[0]:
-            x, y = self.window_props[i].coords.T
-            bin_im[x, y] = 1
+        true_rois = np.nonzero(self.window_states == 1)[0]
+        bin_im = select_labels(self.labeled_img, true_rois + 1).astype(np.uint8)
         Window(bin_im, 'Binary')
 
     def load_classifications_act(self):
@@ -281,81 +261,47 @@ class ClassifierWindow(Window):
             self.window_states = np.copy(roi_states)
             self.set_roi_states()
 
-    def set_roi_states(self):
-        if self.window_props is None:
-            self.window_props = measure.regionprops(self.labeled_img)
-        self.colored_img = np.repeat(self.image[:, :, np.newaxis], 3, 2)
-        for i in np.nonzero(self.window_states == 1)[0]:
-            x, y = self.window_props[i].coords.T
-            self.colored_img[x, y] = ClassifierWindow.GREEN
-        for i in np.nonzero(self.window_states == 2)[0]:
-            x, y = self.window_props[i].coords.T
-            self.colored_img[x, y] = ClassifierWindow.RED
-        for i in np.nonzero(self.window_states == 3)[0]:
-            x, y = self.window_props[i].coords.T
-            if self.imageIdentifier == ClassifierWindow.DAPI:
-                self.colored_img[x, y] = ClassifierWindow.PURPLE
-            elif self.imageIdentifier == ClassifierWindow.FLR:
-                self.colored_img[x, y] = ClassifierWindow.BLUE
-            else:
-                self.colored_img[x, y] = ClassifierWindow.GREEN
+    def get_palette(self):
+        # Color of each state. The meaning of state 3 depends on the window.
+        if self.imageIdentifier == ClassifierWindow.DAPI:
+            state_3 = ClassifierWindow.PURPLE
+        elif self.imageIdentifier == ClassifierWindow.FLR:
+            state_3 = ClassifierWindow.BLUE
+        else:
+            state_3 = ClassifierWindow.GREEN
+        return np.array([ClassifierWindow.WHITE, ClassifierWindow.GREEN, ClassifierWindow.RED, state_3])
+
+    def render_roi_states(self, states=None):
+        # Colors every ROI by its state (window_states by default) with a single lookup, without updating the display
+        if states is None:
+            states = self.window_states
+        self.label_colors = np.concatenate([ClassifierWindow.BLACK[np.newaxis], self.get_palette()[states]])
+        self.render_label_colors()
+
+    def render_label_colors(self):
+        self.colored_img = self.label_colors[self.labeled_img]
+
+    def set_roi_states(self, states=None):
+        self.render_roi_states(states)
         self.update_image(self.colored_img)
 
     def run_erosion(self):
-        progress = g.quantimus.create_progress_bar('Please wait while fibers are being eroded...')
-        progress.show()
-        QtWidgets.QApplication.processEvents()
+        # The erosion depths are computed once, in the background. After that, any erosion percentage is a lookup.
+        if self.fiber_table.erosion_depths is None:
+            g.quantimus.run_in_background('Please wait while fibers are being eroded...',
+                                          lambda progress: self.fiber_table.get_erosion_depths(),
+                                          on_done=lambda depths: self.update_erosion())
+        else:
+            self.update_erosion()
 
+    def update_erosion(self):
+        # Once the erosion depths are cached, any erosion percentage is a lookup
         for i in np.nonzero(self.window_states == 3)[0]:
             self.window_states[i] = 1
         g.quantimus.saved_dapi_states = None
-        # Set all values in eroded_labeled_img to 0
-        # The appropriate coordinates will be marked as 1 later
-        self.eroded_labeled_img[:len(self.eroded_labeled_img - 1)] = 0
-
-        for state in np.nonzero(self.window_states == 1)[0]:
-            QtWidgets.QApplication.processEvents()
-
-            # Reset the ROIs to green
-            x, y = self.window_props[state].coords.T
-            self.colored_img[x, y] = ClassifierWindow.GREEN
-
-            individualprop = self.window_props[state]
-            targetsize = (100 - g.quantimus.algorithm_gui.erosion_percentage_SpinBox.value()) * .01
-            targetarea = individualprop.area * targetsize
-
-            if targetarea > 10:
-                image = individualprop.image
-                while True:
-                    # Get the size of the array
-                    arrayrows = len(image)
-                    arraycols = len(image[0])
-                    arraysize = arrayrows*arraycols
-                    # Count the number of 'false' in the array
-                    arrayfalsecount = (image == False).sum()
-                    # Subtract the two to get the positive area
-                    erodedarea = arraysize - arrayfalsecount
-
-                    if erodedarea > targetarea:
-                        image = morphology.binary_erosion(image, selem=diamond(1))
-                    else:
-                        break
-
-                # Get the coordinate for the pixel at the upper left of the bbox for the original ROI Prop image
-                originalx = individualprop.bbox[0]
-                originaly = individualprop.bbox[1]
-                erodedx = []
-                erodedy = []
-
-                for i in range(len(image)):
-                    for j in range(len(image[i])):
-                        if image[i][j]:
-                            erodedx.append(i + originalx)
-                            erodedy.append(j + originaly)
-
-                self.eroded_labeled_img[erodedx, erodedy] = 1
-
-        eroded_label = label(self.eroded_labeled_img, connectivity=2)
-        g.quantimus.eroded_roi_states = measure.regionprops(eroded_label)
+        erosion_percentage = g.quantimus.algorithm_gui.erosion_percentage_SpinBox.value()
+        self.eroded_labeled_img = erode_fibers(self.labeled_img, self.window_states, erosion_percentage,
+                                               self.fiber_table.get_erosion_depths())
+
         g.quantimus.eroded_labeled_img = self.eroded_labeled_img
         g.quantimus.paint_dapi_colored_image()
@@ -0,0 +1,102 @@
+"""
+Compact in-memory representations of images, and reports of the memory they hold.
+
+Label images are stored with the smallest unsigned type that holds their number of labels (uint16, or uint32 for more
+than 65535 fibers) instead of the int32 or int64 returned by skimage.measure.label, and states as uint8. In compact-memory mode,
+intensities are also processed as float32 instead of float64, which halves the size of the source image and of every
+image derived from it. Thresholds then resolve to float32 precision.
+
+get_memory_report lists the bytes held by the arrays of any objects, e.g. the windows of each stage of the GUI.
+"""
+import numpy as np
+from skimage.measure import label
+
+
+def get_intensity_dtype(compact=False):
+    return np.float32 if compact else np.float64
+
+
+def get_label_dtype(n_labels):
+    if n_labels <= np.iinfo(np.uint16).max:
+        return np.uint16
+    return np.uint32
+
+
+def compact_labels(label_img):
+    # label_img with the smallest dtype for its number of labels. Returns label_img itself if it already has it.
+    return label_img.astype(get_label_dtype(int(np.max(label_img, initial=0))), copy=False)
+
+
+def label_fibers(binary_image):
+    # The 8-connected label image of a binary image, as compact_labels
+    return compact_labels(label(binary_image, connectivity=2))
+
+
+def _get_owner(array):
+    # The array that owns the memory of a view
+    while isinstance(array.base, np.ndarray):
+        array = array.base
+    return array
+
+
+def _iter_arrays(obj, seen, depth=0):
+    # Every array held by obj, following lists, tuples, dicts and the attributes of the classes of this plugin.
+    # Objects already in seen are skipped, so an array held by several objects is found once.
+    if id(obj) in seen or depth > 8:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        owner = _get_owner(obj)
+        if id(owner) not in seen or owner is obj:
+            seen.add(id(owner))
+            yield owner
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            yield from _iter_arrays(item, seen, depth + 1)
+    elif isinstance(obj, dict):
+        for item in obj.values():
+            yield from _iter_arrays(item, seen, depth + 1)
+    elif type(obj).__module__.startswith(__name__.rsplit('.', 1)[0] + '.'):
+        # The windows of the plugin are flika Windows. Their Qt objects are not followed.
+        for item in vars(obj).values():
+            yield from _iter_arrays(item, seen, depth + 1)
+
+
+def get_nbytes(obj, seen=None):
+    # Bytes held in memory by the arrays of obj. Memory-mapped arrays are on disk and are not counted.
+    if seen is None:
+        seen = set()
+    return sum(array.nbytes for array in _iter_arrays(obj, seen) if not isinstance(array, np.memmap))
+
+
+def get_memory_report(objects):
+    # [(name, attribute, bytes)] for the top-level attributes of every object in objects, a list of (name, object).
+    # An array held by several objects is counted for the first one only.
+    seen = set()
+    report = []
+    for name, obj in objects:
+        if obj is None:
+            continue
+        if isinstance(obj, np.ndarray) or not hasattr(obj, '__dict__'):
+            report.append((name, '', get_nbytes(obj, seen)))
+            continue
+        seen.add(id(obj))
+        for attribute, value in vars(obj).items():
+            nbytes = get_nbytes(value, seen)
+            if nbytes > 0:
+                report.append((name, attribute, nbytes))
+    return report
+
+
+def format_memory_report(report):
+    lines = []
+    totals = {}
+    for name, attribute, nbytes in report:
+        totals[name] = totals.get(name, 0) + nbytes
+    for name in totals:
+        lines.append('{:<28} {:10.1f} MB'.format(name, totals[name] / 1e6))
+        for row_name, attribute, nbytes in report:
+            if row_name == name and attribute:
+                lines.append('    {:<24} {:10.1f} MB'.format(attribute, nbytes / 1e6))
+    lines.append('{:<28} {:10.1f} MB'.format('Total', sum(totals.values()) / 1e6))
+    return '\n'.join(lines)
@@ -1,42 +1,34 @@
+"""
+Upload of fiber tables to the MySQL database of the lab. See database.py.
+
+The connection settings are read from the environment variables QUANTIMUS_MYSQL_HOST (default localhost),
+QUANTIMUS_MYSQL_USER, QUANTIMUS_MYSQL_PASSWORD, QUANTIMUS_MYSQL_DATABASE (default myoquant) and QUANTIMUS_MYSQL_PORT.
+"""
+import threading
+
+from .database import FiberDatabase, MySQLBackend, SampleExistsError
+
+_database = None
+_database_lock = threading.Lock()
+
+
+def get_database():
+    # The FiberDatabase of the MySQL server, whose connections are reused by every upload
+    global _database
+    with _database_lock:
+        if _database is None:
+            _database = FiberDatabase(MySQLBackend.from_environment())
+        return _database
 
 
 def get_connection():
-    import pymysql.cursors
-    con = pymysql.connect(host='localhost',
-                                 user='****',
-                                 password='******',
-                                 db='myoquant',
-                                 charset='utf8mb4',
-                                 cursorclass=pymysql.cursors.DictCursor)
-    return con
+    return get_database().backend.connect()
+
 
 def add_fibers(mousename, fibers):
-    con = get_connection()
+    # fibers is a FiberTable. One row is stored for every fiber, all in one transaction.
     try:
-        with con.cursor() as cursor:
-            cursor.execute("SELECT name FROM `mice`")
-            result = cursor.fetchall()
-        names = [r['name'] for r in result]
-        if mousename in names:
-            return "An entry with the mousname '{}' already exists. Change the name and try again".format(mousename)
-        with con.cursor() as cursor:
-            sql = "INSERT INTO `mice` (`name`) VALUES (%s);"
-            cursor.execute(sql, (mousename))
-        con.commit()
-        with con.cursor() as cursor:
-            sql = """
-                INSERT INTO `fibers` SET 
-                  `mouse_id` = (SELECT `id` FROM `mice` WHERE `name`=%s), 
-                  `area` = %s,
-                  `eccentricity` = %s,
-                  `convexity` = %s,
-                  `circularity` = %s,
-                  `minor_axis_length` = %s;
-            """
-            for f in fibers:
-                f2 = [float(n) for n in f]
-                cursor.execute(sql, (mousename, f2[0], f2[1], f2[2], f2[3], f2[5]))
-        con.commit()
-    finally:
-        con.close()
-    return 'Successfully added all fibers to database'
\ No newline at end of file
+        get_database().add_fibers(mousename, fibers, replace=False)
+    except SampleExistsError:
+        return "An entry with the mousname '{}' already exists. Change the name and try again".format(mousename)
+    return 'Successfully added all fibers to database'
@@ -0,0 +1,253 @@
+"""
+Headless batch processing for Quantimus.
+
+Runs the same stages as the GUI (markers -> filled boundaries -> binary -> features -> classification -> filters ->
+CNF/MFI -> export) on every sample in a directory, without Qt. Samples are processed in parallel in a process pool.
+
+From the directory containing the plugin:
+    python -m quantimus.pipeline <image_directory> [-p parameters.json] [-o output_directory] [-j processes]
+
+Each sample is a group of images sharing a name, e.g. mouse1_laminin.tif, mouse1_dapi.tif and mouse1_flr.tif.
+Only the laminin image is required. DAPI and fluorescence images enable the CNF and MFI columns. The fluorescence
+image can be a multi-channel stack, which is memory-mapped when possible.
+
+Sections too large to segment in memory can be segmented in overlapping tiles by setting tile_size (see tiles.py).
+"""
+import os
+import sys
+import json
+import codecs
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from skimage import io
+from skimage.filters import threshold_otsu
+
+from .segmentation import normalize_image, fill_boundaries, get_binary_image
+from .fiber_table import FiberTable
+from .classification import get_norm_coeffs, load_training_data, filter_states, Classifier
+from .rules import apply_rules, load_rules
+from .analysis import erode_fibers, find_central_nuclei, find_positive_fibers
+from .export import build_data_array, write_xlsx
+from .stacks import open_channel_stack
+from .tiles import segment_tiled
+from .memory import get_intensity_dtype, label_fibers
+
+
+DEFAULT_PARAMETERS = {
+    # Markers and boundary filling
+    'threshold1': .2,
+    'threshold2': .4,
+    'n_thresholds': 8,
+    'resize_factor': 1.,
+    # Process the laminin image as float32 instead of float64 (see memory.py)
+    'compact_memory': False,
+    # Tiled segmentation of sections that do not fit in memory (see tiles.py). If tile_size is set, the laminin image
+    # is segmented in overlapping tiles of tile_size pixels by tile_processes processes, and the binary and label
+    # images are written to <sample name>_segmentation in the output directory. tile_overlap must be larger than the
+    # fibers.
+    'tile_size': None,
+    'tile_overlap': 256,
+    'tile_processes': 1,
+    # Classification. classifier is a .json file saved with 'Save Classifier', and training_data a .json file saved
+    # with 'Save Training Data'. The classifier is trained or loaded once for the whole batch. If both are None, every
+    # fiber is kept. classifier_backend is one of classification.CLASSIFIER_BACKENDS, and max_training_samples limits
+    # the training data to a stratified random subsample.
+    'classifier': None,
+    'training_data': None,
+    'classifier_backend': 'svc',
+    'max_training_samples': None,
+    # Filters. Maps 'area', 'eccentricity', 'convexity' or 'circularity' to a [min, max] range. rules is a list of
+    # rules over the columns of the fiber table (see rules.py), or a .json file saved with 'Save Filters'.
+    'filters': {},
+    'rules': [],
+    # CNF. If dapi_threshold is None, the DAPI image is binarized with Otsu's method.
+    'erosion_percentage': 80,
+    'dapi_threshold': None,
+    # MFI. The exported MFI is background-subtracted: flourescence_subtraction is subtracted and negative values become
+    # 0. Fibers whose subtracted MFI is at least positive_mfi_threshold are positive. If None, positives are not
+    # measured.
+    # The fluorescence image can be a stack of channels. Each channel then gets its own MFI and Positive columns, and
+    # positive_mfi_threshold can be a list with one threshold (or None) per channel.
+    'flourescence_subtraction': 0.,
+    'positive_mfi_threshold': None,
+    # Export
+    'microns_per_pixel': 2.649,
+    # Sample discovery
+    'laminin_suffix': '_laminin',
+    'dapi_suffix': '_dapi',
+    'flourescence_suffix': '_flr',
+    'extensions': ['.tif', '.tiff', '.png'],
+}
+
+CHANNELS = {'laminin': 'laminin_suffix', 'dapi': 'dapi_suffix', 'flourescence': 'flourescence_suffix'}
+
+
+def load_parameters(filename=None):
+    parameters = dict(DEFAULT_PARAMETERS)
+    if filename is not None:
+        obj_text = codecs.open(filename, 'r', encoding='utf-8').read()
+        data = json.loads(obj_text)
+        unknown = set(data) - set(DEFAULT_PARAMETERS)
+        if unknown:
+            raise ValueError('Unknown parameters in {}: {}'.format(filename, ', '.join(sorted(unknown))))
+        parameters.update(data)
+    return parameters
+
+
+def find_samples(directory, parameters):
+    # Groups the images in directory by sample name. Returns {sample name: {channel: filename}}
+    samples = {}
+    for filename in sorted(os.listdir(directory)):
+        base, ext = os.path.splitext(filename)
+        if ext.lower() not in parameters['extensions']:
+            continue
+        for channel, suffix_key in CHANNELS.items():
+            suffix = parameters[suffix_key]
+            if base.endswith(suffix) and len(base) > len(suffix):
+                samples.setdefault(base[:-len(suffix)], {})[channel] = os.path.join(directory, filename)
+    return {name: paths for name, paths in samples.items() if 'laminin' in paths}
+
+
+def binarize_dapi(image, threshold=None):
+    if threshold is None:
+        if np.max(image) <= 1:
+            return image > 0
+        threshold = threshold_otsu(image)
+    return image > threshold
+
+
+def get_classifier(parameters):
+    # The classifier of the parameters, or None if every fiber is kept
+    if parameters['classifier'] is not None:
+        return Classifier.load(parameters['classifier'])
+    if parameters['training_data'] is not None:
+        x_train, y_train = load_training_data(parameters['training_data'])
+        mu, sigma = get_norm_coeffs(x_train)
+        return Classifier.train(x_train, y_train, mu, sigma, backend=parameters['classifier_backend'],
+                                max_samples=parameters['max_training_samples'])
+    return None
+
+
+def process_sample(name, paths, parameters, output_dir, classifier=None):
+    # Runs the whole workflow on one sample and returns the filename of the exported spreadsheet. classifier defaults
+    # to get_classifier(parameters).
+    if classifier is None:
+        classifier = get_classifier(parameters)
+    resizefactor = parameters['resize_factor']
+    scalefactor = parameters['microns_per_pixel']
+
+    if parameters['tile_size'] is not None:
+        labeled_img = segment_tiled(paths['laminin'], os.path.join(output_dir, name + '_segmentation'),
+                                    parameters['threshold1'], parameters['threshold2'], resizefactor,
+                                    parameters['n_thresholds'], parameters['tile_size'], parameters['tile_overlap'],
+                                    parameters['tile_processes'])
+    else:
+        # Markers and filled boundaries
+        image = io.imread(paths['laminin'])
+        if np.max(image) > 1:
+            image = normalize_image(image, get_intensity_dtype(parameters['compact_memory']))
+        elif parameters['compact_memory'] and image.dtype == np.float64:
+            image = image.astype(np.float32)
+        filled_boundaries = fill_boundaries(image, parameters['threshold1'], parameters['threshold2'], resizefactor,
+                                            parameters['n_thresholds'])
+
+        # Binary image
+        binary_image = get_binary_image(filled_boundaries, parameters['threshold2'])
+        labeled_img = label_fibers(binary_image)
+        del image, filled_boundaries, binary_image
+
+    # Features
+    fibers = FiberTable(labeled_img)
+    features_array = fibers.get_features_array()
+
+    # Classification and filters
+    states = np.ones(len(fibers), dtype=np.uint8)
+    if classifier is not None:
+        states = classifier.predict(fibers, threads=1)
+    states = filter_states(features_array, states, parameters['filters'])
+    rules = parameters['rules']
+    if isinstance(rules, str):
+        rules = load_rules(rules)
+    states = apply_rules(rules, fibers, states)
+
+    # CNF
+    dapi_states = None
+    if 'dapi' in paths:
+        dapi_binarized_img = binarize_dapi(io.imread(paths['dapi']), parameters['dapi_threshold'])
+        eroded_img = erode_fibers(labeled_img, states, parameters['erosion_percentage'], fibers.get_erosion_depths())
+        dapi_states = find_central_nuclei(labeled_img, eroded_img, dapi_binarized_img, states)
+
+    # MFI
+    intensities = None
+    positive_states = None
+    if 'flourescence' in paths:
+        fibers.set_intensity_image(open_channel_stack(paths['flourescence']))
+        fibers.set_background(parameters['flourescence_subtraction'])
+        channel_intensities = [fibers[name] for name in fibers.get_channel_names('corrected_mfi')]
+        thresholds = parameters['positive_mfi_threshold']
+        if not isinstance(thresholds, (list, tuple)):
+            thresholds = [thresholds] * len(channel_intensities)
+        channel_positives = [None if threshold is None else find_positive_fibers(mfi, states, threshold)
+                             for mfi, threshold in zip(channel_intensities, thresholds)]
+        if len(channel_intensities) == 1:
+            intensities, positive_states = channel_intensities[0], channel_positives[0]
+        else:
+            intensities, positive_states = np.array(channel_intensities), channel_positives
+
+    # Export
+    dataarray = build_data_array(states, fibers['area'], fibers['min_feret'], scalefactor, resizefactor,
+                                 dapi_states, intensities, positive_states)
+    filename = os.path.join(output_dir, name + '.xlsx')
+    write_xlsx(filename, dataarray, scalefactor, resizefactor)
+    return filename
+
+
+def run_batch(directory, parameters=None, output_dir=None, processes=None):
+    # Processes every sample in directory. Returns {sample name: exported filename, or the exception it raised}
+    if parameters is None:
+        parameters = load_parameters()
+    if output_dir is None:
+        output_dir = directory
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    samples = find_samples(directory, parameters)
+    classifier = get_classifier(parameters)
+    results = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {name: executor.submit(process_sample, name, paths, parameters, output_dir, classifier)
+                   for name, paths in samples.items()}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                results[name] = e
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m quantimus.pipeline',
+                                     description='Run the Quantimus workflow on every sample in a directory.')
+    parser.add_argument('directory', help='directory of laminin, DAPI and fluorescence images')
+    parser.add_argument('-p', '--parameters', help='.json parameter file. Missing entries use the defaults.')
+    parser.add_argument('-o', '--output', help='directory for the exported spreadsheets. Defaults to the input.')
+    parser.add_argument('-j', '--processes', type=int, help='number of worker processes. Defaults to the CPU count.')
+    args = parser.parse_args(argv)
+
+    parameters = load_parameters(args.parameters)
+    results = run_batch(args.directory, parameters, args.output, args.processes)
+    if not results:
+        print('No samples found in {}'.format(args.directory))
+        return 1
+    failed = 0
+    for name in sorted(results):
+        if isinstance(results[name], Exception):
+            failed += 1
+            print('{}: failed ({})'.format(name, results[name]))
+        else:
+            print('{}: {}'.format(name, results[name]))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+"""
+Multi-resolution previews of large images.
+
+An ImagePyramid holds an image and copies of it subsampled by 2, 4, 8, ... in each dimension. It is built once,
+and costs a third of the size of the image. A preview of a view of the image reads only the level whose pixels are
+about the size of a screen pixel, and only the part of it that is in view. When zoomed in to full resolution, only
+the visible pixels are read.
+
+Levels are subsampled rather than averaged, so every preview pixel is a pixel of the original image, and a preview
+of the markers shows exactly the markers of those pixels.
+"""
+import numpy as np
+
+from .segmentation import get_markers
+
+
+class ImagePyramid:
+    """
+    levels[k] is image[::2 ** k, ::2 ** k]. The smallest level is at most min_size pixels on its shorter side.
+    """
+
+    def __init__(self, image, min_size=256):
+        self.shape = image.shape
+        self.levels = [image]
+        while min(self.levels[-1].shape) > min_size:
+            self.levels.append(np.ascontiguousarray(self.levels[-1][::2, ::2]))
+
+    def __len__(self):
+        return len(self.levels)
+
+    def get_level(self, pixel_size):
+        # The coarsest level whose pixels are not larger than pixel_size pixels of the image, e.g. the size of a
+        # screen pixel in image pixels
+        if pixel_size < 2:
+            return 0
+        return min(int(np.log2(pixel_size)), len(self.levels) - 1)
+
+    def get_region(self, pixel_size, x_range=None, y_range=None):
+        # The part of level get_level(pixel_size) that covers x_range and y_range (in pixels of the image, as
+        # returned by pyqtgraph's ViewBox.viewRange). Returns (region, (x0, y0), scale): the region covers the image
+        # from (x0, y0), and each of its pixels is scale pixels of the image.
+        k = self.get_level(pixel_size)
+        scale = 2 ** k
+        level = self.levels[k]
+        bounds = []
+        for axis, limits in enumerate((x_range, y_range)):
+            if limits is None:
+                bounds.append((0, level.shape[axis]))
+                continue
+            start = int(np.clip(np.floor(limits[0] / scale), 0, level.shape[axis]))
+            stop = int(np.clip(np.ceil(limits[1] / scale) + 1, start, level.shape[axis]))
+            bounds.append((start, stop))
+        (x0, x1), (y0, y1) = bounds
+        return level[x0:x1, y0:y1], (x0 * scale, y0 * scale), scale
+
+
+def get_markers_preview(pyramid, thresh1, thresh2, pixel_size, x_range=None, y_range=None):
+    # segmentation.get_markers of the part of the image in view, at the resolution of the screen. Returns
+    # (markers, (x0, y0), scale) as ImagePyramid.get_region.
+    region, position, scale = pyramid.get_region(pixel_size, x_range, y_range)
+    return get_markers(region, thresh1, thresh2), position, scale
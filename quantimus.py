@@ -1,15 +1,8 @@
 import os
-import scipy
-from distutils.version import StrictVersion
-import xlsxwriter
-from skimage.filters import gabor_kernel
-from scipy.signal import convolve2d
-from qtpy import uic, QtGui
-from skimage.morphology import binary_dilation
-from itertools import chain
-from sklearn import svm
+import re
+import traceback
+from qtpy import uic, QtGui, QtCore
 import pyqtgraph as pg
-import math
 import flika
 
 import warnings
@@ -17,97 +10,110 @@ import warnings
 warnings.filterwarnings("ignore")
 
 from .marking_binary_window import *
+from .segmentation import normalize_image, get_markers, fill_boundaries, get_binary_image, LabelStack
+from .classification import get_norm_coeffs, normalize_data, load_training_data, Classifier, CLASSIFIER_BACKENDS
+from .training_store import is_training_store
+from .analysis import get_nucleus_contingency, get_central_nuclei_counts, find_central_nuclei, find_positive_fibers
+from .fiber_table import FiberTable
+from .rules import FALSE_POSITIVE_RULES, apply_rules, save_rules, load_rules
+from .export import build_data_array, write_xlsx
+from .stacks import as_channel_stack
+from .memory import get_intensity_dtype, get_memory_report, format_memory_report
+from .segmentation_cache import get_segmentation, segmentation_cache
+from .workers import Job, Cancelled
+from .pyramid import ImagePyramid, get_markers_preview
 
 
 flika_version = flika.__version__
-if StrictVersion(flika_version) < StrictVersion('0.2.23'):
+# distutils is slow to import and no longer part of Python 3.12
+if tuple(int(part) for part in re.findall(r'\d+', flika_version)[:3]) < (0, 2, 23):
     from flika.process.BaseProcess import BaseProcess, WindowSelector, SliderLabel, CheckBox
 else:
     from flika.utils.BaseProcess import BaseProcess, WindowSelector, SliderLabel, CheckBox
 
 
 def show_label_img(binary_img):
-    newlabel = label(binary_img, connectivity=2)
-    image = np.zeros((np.max(newlabel), newlabel.shape[0], newlabel.shape[1]), dtype=np.bool)
-    for i in np.arange(1, np.max(newlabel)):
-        image[i - 1] = newlabel == i
-    return Window(image)
+    # Each frame shows one ROI. Frames are only drawn when they are viewed.
+    return Window(LabelStack(get_segmentation(binary_img).labeled_img))
 
 
-def get_important_features(binary_image):
+def get_important_features(binary_image, fiber_table=None):
+    if fiber_table is None:
+        fiber_table = get_segmentation(binary_image).fiber_table
     features = {}
-    label_img = label(binary_image, connectivity=2)
-    props = measure.regionprops(label_img)
-    features['convexity'] = np.array([p.filled_area / p.convex_area for p in props])
-    features['eccentricity'] = np.array([p.eccentricity for p in props])
-    features['area'] = np.array([p.filled_area for p in props]) / 4000
-    features['circularity'] = np.array([p.filled_area * (4 * np.pi) / p.perimeter ** 2 for p in props])
+    features['convexity'] = fiber_table['convexity']
+    features['eccentricity'] = fiber_table['eccentricity']
+    features['area'] = fiber_table['filled_area'] / 4000
+    features['circularity'] = fiber_table['circularity']
     return features
 
 
-def remove_borders(binary_image):
-    label_img = label(binary_image, connectivity=2)
-    mx, my = binary_image.shape
-    border_labels = set(label_img[:, 0]) | set(label_img[0, :]) | set(label_img[mx - 1, :]) | set(label_img[:, my - 1])
-    for i in border_labels:
-        binary_image[label_img == i] = 0
-    return binary_image
-
-
-def remove_false_positives(binary_window, features):
-    label_img = binary_window.labeled_img
-    elements = np.max(label_img)
-    for i in np.arange(elements):
-        if features['area'][i] < .05:
-            binary_window.roi_states[i] = 2
-        elif features['convexity'][i] < .7:
-            binary_window.roi_states[i] = 2
-        elif features['eccentricity'][i] > .96 and features['convexity'][i] < .85:
-            binary_window.roi_states[i] = 2
-        elif features['area'][i] > 3:
-            binary_window.roi_states[i] = 2
-        elif features['circularity'][i] < 0.4:
-            binary_window.roi_states[i] = 2
-        else:
-            binary_window.roi_states[i] = 1
-    binary_window.colored_img = np.repeat(binary_window.image[:, :, np.newaxis], 3, 2)
-    binary_window.colored_img[binary_window.image == 1] = ClassifierWindow.GREEN
-    for roi_num, new_state in enumerate(binary_window.roi_states):
-        if new_state != 1:
-            color = [ClassifierWindow.WHITE, ClassifierWindow.GREEN, ClassifierWindow.RED][new_state]
-            binary_window.colored_img[binary_window.labeled_img == roi_num + 1] = color
-    binary_window.update_image(binary_window.colored_img)
+def remove_false_positives(binary_window, features, rules=FALSE_POSITIVE_RULES):
+    # features is the output of get_important_features. Fibers that break any rule become red.
+    states = np.ones(len(features['area']), dtype=np.uint8)
+    binary_window.window_states = apply_rules(rules, features, states)
+    binary_window.set_roi_states()
+
+
+# Stages run in the background by Quantimus.run_in_background. Each reports to progress (a workers.Progress) and
+# only reads the arrays it is given, so the GUI can keep drawing while it runs.
+
+def fill_boundaries_job(image, lower_bound, upper_bound, resizefactor, progress=None):
+    # Returns the full resolution markers, the filled boundaries and the segmentation of the binary image
+    markers = get_markers(image, lower_bound, upper_bound)
+    # Original linspace = 8
+    image_new = fill_boundaries(image, lower_bound, upper_bound, resizefactor, 8,
+                                progress.get_callback(7, .1, .9, 'Filling boundaries...'))
+    progress.set(.9, 'Labeling fibers...')
+    return markers, image_new, get_segmentation(get_binary_image(image_new, upper_bound))
+
+
+def train_classifier_job(x_train, y_train, mu, sigma, backend, max_samples, progress=None):
+    progress.set(0, 'Training {} classifier...'.format(backend))
+    return Classifier.train(x_train, y_train, mu, sigma, backend=backend, max_samples=max_samples)
+
 
+def classify_job(classifier, fiber_table, chunk_size=4096, progress=None):
+    progress.set(0, 'Measuring fibers...')
+    features = fiber_table.get_columns(classifier.feature_columns)
+    n_chunks = -(-len(features) // chunk_size)
+    return classifier.predict(features, chunk_size,
+                              callback=progress.get_callback(n_chunks, .5, 1., 'Classifying fibers...'))
 
-def generate_kernel(theta=0):
-    frequency = .1
-    sigma_x = 1  # left right axis. Bigger this number, smaller the width
-    sigma_y = 2  # right left axis. Bigger this number, smaller the height
-    kernel = np.real(gabor_kernel(frequency, theta, sigma_x, sigma_y))
-    kernel -= np.mean(kernel)
-    return kernel
 
+def central_nuclei_job(labeled_img, eroded_img, dapi_binarized_img, states, progress=None):
+    # Returns the nucleus contingency and the states with the CNFs
+    progress.set(0, 'Finding nuclei...')
+    contingency = get_nucleus_contingency(labeled_img, eroded_img, dapi_binarized_img, len(states))
+    progress.set(.8, 'Finding central nuclei...')
+    return contingency, find_central_nuclei(labeled_img, eroded_img, dapi_binarized_img, states, contingency)
 
-def get_kernels():
-    # prepare filter bank kernels
-    kernels = []
-    for theta in np.linspace(0, np.pi, 40):
-        kernel = generate_kernel(theta)
-        kernels.append(kernel)
-    return kernels
 
+def get_corrected_intensities(fiber_table, background):
+    # The background-subtracted MFI of every channel. Only the first call after a new intensity image reads the image.
+    with fiber_table.lock:
+        fiber_table.set_background(background)
+        return [fiber_table[name] for name in fiber_table.get_channel_names('corrected_mfi')]
 
-kernels = get_kernels()
 
+def intensity_job(fiber_table, intensity_img, background, progress=None):
+    # The background-subtracted MFI of every channel of intensity_img
+    progress.set(0, 'Measuring intensities...')
+    # Holding the lock keeps the GUI from reading the intensities of another image in between
+    with fiber_table.lock:
+        fiber_table.set_intensity_image(intensity_img)
+        return get_corrected_intensities(fiber_table, background)
 
-def convolve_with_kernels_fft(i, kernels):
-    results = []
-    for k, kernel in enumerate(kernels):
-        print(k)
-        filtered = scipy.signal.fftconvolve(i, kernel, 'same')
-        results.append(filtered)
-    results = np.array(results)
-    return results
+
+def export_job(filename, states, fiber_table, scalefactor, resizefactor, dapi_states, intensities, positive_states,
+               progress=None):
+    progress.set(0, 'Measuring fibers...')
+    areas, min_ferets = fiber_table['area'], fiber_table['min_feret']
+    progress.set(.8, 'Writing {}...'.format(os.path.basename(filename)))
+    dataarray = build_data_array(states, areas, min_ferets, scalefactor, resizefactor, dapi_states, intensities,
+                                 positive_states)
+    write_xlsx(filename, dataarray, scalefactor, resizefactor)
+    return filename
 
 
 def plot_regression_results(xparam1, xparam2, y):
@@ -121,46 +127,6 @@ def plot_regression_results(xparam1, xparam2, y):
     s1.addPoints(x1, x2, size=10, pen=None, brush=pg.mkBrush(255, 0, 0, 255))
 
 
-def get_border_between_two_props(prop1, prop2):
-    image2 = prop2.image
-    image1 = np.zeros_like(image2)
-    bbox = np.array(prop2.bbox)
-    top_left = bbox[:2]
-    a = prop1.coords - top_left
-    image1[a[:, 0], a[:, 1]] = 1
-    image1_expanded1 = binary_dilation(image1)
-    image1_expanded2 = binary_dilation(binary_dilation(image1_expanded1))
-    image1_expanded2[image1_expanded1] = 0
-    border = image1_expanded2 * image2
-    return np.argwhere(border) + top_left
-
-
-def get_new_image(image, thresh1=.20, thresh2=.30):
-    resizefactor = g.quantimus.algorithm_gui.resize_factor_SpinBox.value()
-    label_im_1 = label(image < thresh1, connectivity=2)
-    label_im_2 = label(image < thresh2, connectivity=2)
-    props_1 = measure.regionprops(label_im_1)
-    props_2 = measure.regionprops(label_im_2)
-    borders = np.zeros_like(image)
-
-    #  The maximum of the labeled image is the number of contiguous regions, or ROIs.
-    rois = np.max(label_im_1)
-    for roi_num in np.arange(rois):
-        QtWidgets.QApplication.processEvents()
-        prop1 = props_1[roi_num]
-        x, y = prop1.coords[0, :]
-        prop2 = props_2[label_im_2[x, y] - 1]
-
-        if prop1.area > 65 * resizefactor ** 2:
-            area_ratio = prop2.area / prop1.area
-            if area_ratio > 1.2:
-                border_idx = get_border_between_two_props(prop1, prop2)
-                borders[border_idx[:, 0], border_idx[:, 1]] = 1
-    image_new = np.copy(image)
-    image_new[np.where(borders)] = 2
-    return image_new
-
-
 class Quantimus:
     """
     Muscle Cell Analysis Software
@@ -169,6 +135,13 @@ class Quantimus:
     MARKERS = "MARKERS"
     BINARY = "BINARY"
 
+    # Milliseconds without slider or zoom changes before the markers preview is redrawn
+    PREVIEW_DELAY = 40
+
+    # Fiber table column of each filter in the GUI, and the name of its check box and spin boxes
+    FILTER_WIDGETS = [('filled_area', 'area'), ('eccentricity', 'eccentricity'), ('convexity', 'convexity'),
+                      ('circularity', 'circularity')]
+
     def __init__(self):
         # Windows
         self.markers_win = None
@@ -177,20 +150,29 @@ class Quantimus:
         self.classifier_window = None
         self.trained_img = None
         self.filtered_trained_img = None
+        self.classifier = None
+        self.extra_filter_rules = []
         self.dapi_img = None
         self.dapi_binarized_img = None
         self.eroded_labeled_img = None
         self.flourescence_img = None
         self.intensity_img = None
+        self.image_pyramid = None
+        # Thresholds of the full resolution markers shown in the markers window, if any
+        self.full_markers_thresholds = None
+        # Background jobs that are running, with their progress dialog and timer
+        self.jobs = []
 
         # ROIs and States
         self.roiStates = None
-        self.eroded_roi_states = None
         self.dapi_rois = None
+        self.dapi_contingency = None
         self.roiProps = None
         self.flourescenceIntensities = None
+        self.channelIntensities = None
         self.positiveFiberRois = None
         self.positiveFiberStates = None
+        self.channelPositiveStates = {}
 
         # Printing Data
         self.saved_flourescence_rois = None
@@ -199,6 +181,7 @@ class Quantimus:
         self.saved_dapi_states = None
         self.saved_positive_rois = None
         self.saved_positive_states = None
+        self.saved_channel_positive_states = {}
 
         # Misc
         self.isMarkersFirstSelection = True
@@ -215,6 +198,7 @@ class Quantimus:
         self.flourescence_img_selector = None
         self.dapi_img_selector = None
         self.binarized_dapi_img_selector = None
+        self.preview_timer = None
 
         pass
 
@@ -237,11 +221,25 @@ class Quantimus:
         self.threshold2_slider.valueChanged.connect(self.threshold_slider_changed)
         gui.gridLayout_threshold_one.addWidget(self.threshold1_slider)
         gui.gridLayout_threshold_two.addWidget(self.threshold2_slider)
+        # Slider ticks, zooming and panning restart the timer, so the preview is only drawn once they stop
+        self.preview_timer = QtCore.QTimer()
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(Quantimus.PREVIEW_DELAY)
+        self.preview_timer.timeout.connect(self.update_markers_preview)
         gui.fill_boundaries_button.pressed.connect(self.fill_boundaries_button)
         gui.SVM_button.pressed.connect(self.run_svm_classification_on_image)
         gui.SVM_saved_button.pressed.connect(self.run_svm_classification_on_saved_training_data)
+        gui.SVM_classifier_button.pressed.connect(self.run_saved_classifier)
+        gui.classifier_backend_ComboBox.addItems(CLASSIFIER_BACKENDS)
+        gui.save_classifier_button.pressed.connect(self.save_classifier)
         gui.load_classification_button.pressed.connect(self.load_classification_to_trained_image)
         gui.manual_filter_button.pressed.connect(self.filter_update)
+        gui.save_filters_button.pressed.connect(self.save_filters)
+        gui.load_filters_button.pressed.connect(self.load_filters)
+        for feature, widget_name in Quantimus.FILTER_WIDGETS:
+            getattr(gui, '{}_CheckBox'.format(widget_name)).stateChanged.connect(self.filter_rules_changed)
+            getattr(gui, 'min_{}_SpinBox'.format(widget_name)).valueChanged.connect(self.filter_rules_changed)
+            getattr(gui, 'max_{}_SpinBox'.format(widget_name)).valueChanged.connect(self.filter_rules_changed)
 
         self.binary_img_selector = WindowSelector()
         self.binary_img_selector.valueChanged.connect(self.select_binary_image)
@@ -263,11 +261,15 @@ class Quantimus:
         self.binarized_dapi_img_selector.valueChanged.connect(self.select_dapi_binarized_image)
         gui.gridLayout_contains_DAPI.addWidget(self.binarized_dapi_img_selector)
 
+        gui.run_erosion_button.pressed.connect(self.run_erosion)
+        gui.erosion_percentage_SpinBox.valueChanged.connect(self.erosion_percentage_changed)
         gui.run_DAPI_button.pressed.connect(self.calculate_dapi)
         gui.save_DAPI_button.pressed.connect(self.save_dapi)
         gui.run_Flr_button.pressed.connect(self.calculate_flourescence)
+        gui.flourescence_subtraction_SpinBox.valueChanged.connect(self.flourescence_subtraction_changed)
         gui.save_flourescence_button.pressed.connect(self.save_flourescence)
         gui.print_button.pressed.connect(self.print_data)
+        gui.memory_report_button.pressed.connect(self.print_memory_report)
 
         gui.determine_positives_button.pressed.connect(self.determine_positives)
         gui.measure_positives_button.pressed.connect(self.measure_positives)
@@ -282,19 +284,25 @@ class Quantimus:
         else:
             if self.reset_data(Quantimus.MARKERS):
                 win = self.original_window_selector.window
-                needalert = False
-                if np.max(win.image) > 1:
-                    needalert = True
-                    image = win.image.astype(np.float)
-                    image -= np.min(image)
-                    image /= np.max(image)
+                # In compact-memory mode the image is processed as float32
+                compact = self.algorithm_gui.compact_memory_CheckBox.isChecked()
+                needalert = np.max(win.image) > 1
+                if needalert or (compact and win.image.dtype == np.float64):
+                    if needalert:
+                        image = normalize_image(win.image, get_intensity_dtype(compact))
+                    else:
+                        image = win.image.astype(np.float32)
                     win.image = image
                     win.dtype = image.dtype
                     win.imageview.setImage(win.image)
                     win._init_dimensions(win.image)
                     win.imageview.ui.graphicsView.addItem(win.top_left_label)
                 original = win.image
+                # The markers are previewed from a pyramid of the image, at the resolution of the screen
+                self.image_pyramid = ImagePyramid(original)
+                self.full_markers_thresholds = None
                 self.markers_win = Window(np.zeros_like(original, dtype=np.uint8), 'Binary Markers')
+                self.markers_win.imageview.getView().sigRangeChanged.connect(self.preview_timer.start)
                 self.markers_win.imageview.setLevels(0, 2)
                 self.markers_win.imageview.ui.histogram.gradient.addTick(0, QtGui.QColor(0, 0, 255), True)
                 self.markers_win.imageview.ui.histogram.gradient.setTickValue(1, .50)
@@ -309,56 +317,49 @@ class Quantimus:
         if self.original_window_selector.window is None:
             g.alert('You must select a Window before adjusting the levels.')
         else:
-            thresh1 = self.threshold1_slider.value()
-            thresh2 = self.threshold2_slider.value()
-            image = self.original_window_selector.window.image
-            markers = (image > thresh1).astype(dtype=np.uint8)
-            markers[image > thresh2] = 2
-            self.markers_win.imageview.setImage(markers, autoRange=False, autoLevels=False)
+            self.preview_timer.start()
+
+    def update_markers_preview(self):
+        # Draws the markers of the part of the image in view, from the level of the pyramid that matches the zoom
+        if self.markers_win is None or self.image_pyramid is None:
+            return
+        thresholds = (self.threshold1_slider.value(), self.threshold2_slider.value())
+        if thresholds == self.full_markers_thresholds:
+            return
+        view = self.markers_win.imageview.getView()
+        x_range, y_range = view.viewRange()
+        pixel_size = max(view.viewPixelSize())
+        markers, position, scale = get_markers_preview(self.image_pyramid, thresholds[0], thresholds[1], pixel_size,
+                                                       x_range, y_range)
+        self.full_markers_thresholds = None
+        self.markers_win.imageview.setImage(markers, autoRange=False, autoLevels=False, levels=(0, 2), pos=position,
+                                            scale=(scale, scale))
 
     def fill_boundaries_button(self):
         # Reset any data currently saved in the system
         lower_bound = self.threshold1_slider.value()
         upper_bound = self.threshold2_slider.value()
-        # Original linspace = 8
-        thresholds = np.linspace(lower_bound, upper_bound, 8)
+        resizefactor = self.algorithm_gui.resize_factor_SpinBox.value()
         image = self.original_window_selector.window.image
-        image_new = image
-
-        label_im_1 = label(image < lower_bound, connectivity=2)
-        label_im_2 = label(image < upper_bound, connectivity=2)
-        props_2 = measure.regionprops(label_im_2)
-
-        progress = self.create_progress_bar('Please wait while image is processed...')
-        progress.show()
-        QtWidgets.QApplication.processEvents()
-
-        for i in np.arange(len(thresholds) - 1):
-            QtWidgets.QApplication.processEvents()
-            print(thresholds[i])
-            image_new = get_new_image(image_new, thresholds[i], thresholds[i + 1])
-
-        # Remove ROIs that
-        rois_2 = np.max(label_im_2)
-        for roi_num in np.arange(rois_2):
-            prop2 = props_2[roi_num]
-            x, y = prop2.coords.T
-            if np.max(label_im_1[x, y]) == 0:
-                image_new[x, y] = 2
-
+        self.run_in_background('Please wait while image is processed...', fill_boundaries_job,
+                               (image, lower_bound, upper_bound, resizefactor),
+                               self.show_filled_boundaries)
+
+    def show_filled_boundaries(self, result):
+        markers, image_new, segmentation = result
+        if self.markers_win is not None:
+            # The full resolution markers replace the preview until the thresholds change
+            self.full_markers_thresholds = (self.threshold1_slider.value(), self.threshold2_slider.value())
+            self.markers_win.imageview.setImage(markers, autoRange=False, autoLevels=False, levels=(0, 2), pos=(0, 0),
+                                                scale=(1, 1))
         self.filled_boundaries_win = Window(image_new, 'Filled Boundaries')
-        classifier_image = remove_borders(image_new < upper_bound)
-        self.binary_img = ClassifierWindow(classifier_image, 'Binary Window')
+        self.binary_img = ClassifierWindow(segmentation.binary_image, 'Binary Window', segmentation=segmentation)
 
     def get_norm_coeffs(self, x):
-        mean = np.mean(x, 0)
-        std = np.std(x, 0)
-        return mean, std
+        return get_norm_coeffs(x)
 
     def normalize_data(self, x, mean, std):
-        x = x - mean
-        x = x / (2 * std)
-        return x
+        return normalize_data(x, mean, std)
 
     def close_event(self, event):
         print('Closing quantimus gui')
@@ -366,24 +367,62 @@ class Quantimus:
             self.classifier_window.close()
         event.accept()  # let the window close
 
-    def create_progress_bar(self, msg):
-        progress = QtWidgets.QProgressDialog()
-        progress.parent = self
-        progress.setLabelText(msg)
-        progress.setRange(0, 0)
-        progress.setMinimumWidth(375)
-        progress.setMinimumHeight(100)
-        progress.setCancelButton(None)
-        progress.setModal(True)
-        return progress
+    def run_in_background(self, msg, func, args=(), on_done=None, on_error=None):
+        # Runs func(*args, progress=...) in the worker pool (see workers.py) behind a progress dialog with a cancel
+        # button. The dialog is polled by a timer, so the GUI stays responsive. on_done is called with the result, and
+        # on_error with the exception func raised, on the GUI thread. Nothing is called if the job is cancelled.
+        job = Job(func, *args)
+        dialog = QtWidgets.QProgressDialog(msg, 'Cancel', 0, 1000)
+        dialog.setMinimumWidth(375)
+        dialog.setMinimumHeight(100)
+        dialog.setMinimumDuration(0)
+        dialog.setAutoClose(False)
+        dialog.setAutoReset(False)
+        dialog.setModal(True)
+        dialog.canceled.connect(job.cancel)
+        timer = QtCore.QTimer()
+        entry = (job, dialog, timer)
+
+        def poll():
+            fraction, message = job.progress.get()
+            dialog.setValue(int(fraction * 1000))
+            if message:
+                dialog.setLabelText('{}\n{}'.format(msg, message))
+            if not job.done():
+                return
+            timer.stop()
+            dialog.close()
+            self.jobs.remove(entry)
+            try:
+                result = job.result()
+            except Cancelled:
+                print('Cancelled: {}'.format(msg))
+            except Exception as e:
+                traceback.print_exception(type(e), e, e.__traceback__)
+                if on_error is not None:
+                    on_error(e)
+                else:
+                    g.alert(str(e))
+            else:
+                if on_done is not None:
+                    on_done(result)
+
+        timer.timeout.connect(poll)
+        timer.start(50)
+        dialog.show()
+        self.jobs.append(entry)
+        return job
 
     def select_binary_image(self):
         # Reset any data currently saved in the system
         if self.reset_data(Quantimus.BINARY):
             print('Binary image selected.')
-            self.classifier_window = ClassifierWindow(self.binary_img_selector.window.image, 'Training Image')
+            # Reuse the features of the selected window if it is one of ours
+            self.classifier_window = ClassifierWindow(self.binary_img_selector.window.image, 'Training Image',
+                                                      segmentation=getattr(self.binary_img_selector.window,
+                                                                           'segmentation', None))
             self.classifier_window.imageIdentifier = ClassifierWindow.TRAINING
-            self.roiStates = np.zeros(np.max(self.classifier_window.labeled_img), dtype=np.uint8)
+            self.roiStates = np.zeros(int(np.max(self.classifier_window.labeled_img)), dtype=np.uint8)
             self.classifier_window.window_states = np.copy(self.roiStates)
             self.isBinaryFirstSelection = False
 
@@ -391,70 +430,97 @@ class Quantimus:
         if self.classifier_window is None:
             g.alert("Please select a Binary Image")
         else:
-            # Start threading and Progress Bar
-            progress = g.quantimus.create_progress_bar('Please wait while fibers are being classified...')
-            progress.show()
-            QtWidgets.QApplication.processEvents()
-
             x_train, y_train = self.classifier_window.get_training_data()
-            mu, sigma = self.get_norm_coeffs(self.classifier_window.features_array)
+            mu, sigma = self.get_norm_coeffs(self.classifier_window.get_features_array())
             self.run_svm_classification_general(x_train, y_train, mu, sigma)
 
     def run_svm_classification_on_saved_training_data(self):
         if self.classifier_window is None:
             g.alert("Please select a Binary Image")
         else:
-            filename = open_file_gui("Open training_data", filetypes='*.json')
-            if filename is None:
+            # 'Save Training Data' appends to a training store directory, so the same directory is opened here
+            directory = QtWidgets.QFileDialog.getExistingDirectory(None, 'Select a training store directory')
+            if not directory:
                 return None
-            obj_text = codecs.open(filename, 'r', encoding='utf-8').read()
-            data = json.loads(obj_text)
-
-            # Start threading and Progress Bar
-            progress = self.create_progress_bar('Please wait while fibers are being classified...')
-            progress.show()
-            QtWidgets.QApplication.processEvents()
-
-            x_train = np.array(data['features'])
-            y_train = np.array(data['states'])
+            if not is_training_store(directory):
+                g.alert('{} is not a training store. Select a directory saved with Save Training Data.'.format(
+                    directory))
+                return None
+            x_train, y_train = load_training_data(directory)
             mu, sigma = self.get_norm_coeffs(x_train)
             self.run_svm_classification_general(x_train, y_train, mu, sigma)
 
     def run_svm_classification_general(self, x_train, y_train, mu, sigma):
+        gui = self.algorithm_gui
+        backend = gui.classifier_backend_ComboBox.currentText()
+        print('Training {} classifier'.format(backend))
+
+        def on_trained(classifier):
+            self.classifier = classifier
+            self.run_classifier()
+
+        def on_error(e):
+            if isinstance(e, ValueError):
+                g.alert('Please train a minimum of 1 positive and 1 negative sample')
+            else:
+                g.alert(str(e))
+
+        # Large pooled training sets can be subsampled, or trained with a backend that scales better than svc
+        self.run_in_background('Please wait while the classifier is trained...', train_classifier_job,
+                               (x_train, y_train, mu, sigma, backend, gui.max_training_samples_SpinBox.value() or None),
+                               on_trained, on_error)
+
+    def run_saved_classifier(self):
+        if self.classifier_window is None:
+            g.alert("Please select a Binary Image")
+        else:
+            filename = open_file_gui("Open classifier", filetypes='*.json')
+            if filename is None:
+                return None
+            try:
+                self.classifier = Classifier.load(filename)
+            except (ValueError, KeyError) as e:
+                g.alert('Could not load the classifier: {}'.format(e))
+                return None
+            self.run_classifier()
+
+    def save_classifier(self):
+        # Saves the last trained or loaded classifier, so it can be run on other images without retraining
+        if self.classifier is None:
+            g.alert('Please run the SVM Classification Training')
+            return None
+        filename = save_file_gui("Save classifier", filetypes='*.json')
+        if filename is None:
+            return None
+        self.classifier.save(filename)
+
+    def run_classifier(self):
         print('Running SVM classification')
-        try:
-            x_train = self.normalize_data(x_train, mu, sigma)
-            clf = svm.SVC()
-            clf.fit(x_train, y_train)
-            x_test = self.normalize_data(self.classifier_window.get_features_array(), mu, sigma)
-            y = clf.predict(x_test)
-            self.roiStates = np.zeros_like(y)
-            self.roiStates[y == 1] = 1
-            self.roiStates[y == 0] = 2
-            self.trained_img = ClassifierWindow(self.classifier_window.image, 'Trained Image')
-            self.trained_img.imageIdentifier = ClassifierWindow.TRAINING
-            self.trained_img.window_states = np.copy(self.roiStates)
-
-            # Add hand-designed rules here if you want.
-            # For instance, you could remove all ROIs smaller than 15 pixels like this:
-
-            # X = self.classifier_window.features_array
-            # roi_states[X[:, 0] < 15] = 2 # Area must be smaller than 15 pixels
-            # roi_states[X[:, 3] < 0.6] = 2 # Convexity must be smaller than 0.6
-
-            self.trained_img.set_roi_states()
-            self.roiStates = np.copy(self.trained_img.window_states)
-        except ValueError:
-            g.alert('Please train a minimum of 1 positive and 1 negative sample')
+        # A ValueError means the classifier was trained on different features, and is shown as an alert
+        self.run_in_background('Please wait while fibers are being classified...', classify_job,
+                               (self.classifier, self.classifier_window.fiber_table), self.show_classification)
+
+    def show_classification(self, states):
+        self.roiStates = states
+        self.trained_img = ClassifierWindow(self.classifier_window.image, 'Trained Image',
+                                            segmentation=self.classifier_window.segmentation)
+        self.trained_img.imageIdentifier = ClassifierWindow.TRAINING
+        self.trained_img.window_states = np.copy(self.roiStates)
 
-    def load_classification_to_trained_image(self):
-        print('Loading Classification to Trained Image')
+        # Add hand-designed rules here if you want.
+        # For instance, you could remove all ROIs smaller than 15 pixels like this:
+
+        # X = self.classifier_window.features_array
+        # roi_states[X[:, 0] < 15] = 2 # Area must be smaller than 15 pixels
+        # roi_states[X[:, 3] < 0.6] = 2 # Convexity must be smaller than 0.6
 
-        progress = self.create_progress_bar('Please wait while fibers are being classified...')
-        progress.show()
-        QtWidgets.QApplication.processEvents()
+        self.trained_img.set_roi_states()
+        self.roiStates = np.copy(self.trained_img.window_states)
 
-        self.trained_img = ClassifierWindow(self.classifier_window.image, 'Trained Image')
+    def load_classification_to_trained_image(self):
+        print('Loading Classification to Trained Image')
+        self.trained_img = ClassifierWindow(self.classifier_window.image, 'Trained Image',
+                                            segmentation=self.classifier_window.segmentation)
         self.trained_img.imageIdentifier = ClassifierWindow.TRAINING
         self.trained_img.window_states = np.copy(self.roiStates)
         self.trained_img.load_classifications_act()
@@ -462,68 +528,75 @@ class Quantimus:
 
     def filter_update(self):
         print('Manually filtering...')
-
-        progress = self.create_progress_bar('Please wait while image is filtered...')
-        progress.show()
-        QtWidgets.QApplication.processEvents()
-
-        try:
-            min_circularity = g.quantimus.algorithm_gui.min_circularity_SpinBox.value()
-            max_circularity = g.quantimus.algorithm_gui.max_circularity_SpinBox.value()
-            circularitycheckbox = g.quantimus.algorithm_gui.circularity_CheckBox
-            min_area = g.quantimus.algorithm_gui.min_area_SpinBox.value()
-            max_area = g.quantimus.algorithm_gui.max_area_SpinBox.value()
-            areacheckbox = g.quantimus.algorithm_gui.area_CheckBox
-            min_convexity = g.quantimus.algorithm_gui.min_convexity_SpinBox.value()
-            max_convexity = g.quantimus.algorithm_gui.max_convexity_SpinBox.value()
-            convexitycheckbox = g.quantimus.algorithm_gui.convexity_CheckBox
-            min_eccentricity = g.quantimus.algorithm_gui.min_eccentricity_SpinBox.value()
-            max_eccentricity = g.quantimus.algorithm_gui.max_eccentricity_SpinBox.value()
-            eccentricitycheckbox = g.quantimus.algorithm_gui.eccentricity_CheckBox
-
-            features = self.trained_img.get_features_array()
-            states = np.copy(self.trained_img.window_states)
-            count = 0
-
-            for feature in features:
-                # Update the progress bar so it shows movement
-                QtWidgets.QApplication.processEvents()
-                if self.trained_img.window_states[count] == 1:
-                    # Area
-                    if areacheckbox.isChecked():
-                        if feature[0] >= min_area and feature[0] <= max_area:
-                            states[count] = 1
-                        else:
-                            states[count] = 2
-                    # Eccentricity
-                    if eccentricitycheckbox.isChecked():
-                        if states[count] == 1 and feature[1] >= min_eccentricity and feature[1] <= max_eccentricity:
-                            states[count] = 1
-                        else:
-                            states[count] = 2
-                    # Convexity
-                    if convexitycheckbox.isChecked():
-                        if states[count] == 1 and feature[2] >= min_convexity and feature[2] <= max_convexity:
-                            states[count] = 1
-                        else:
-                            states[count] = 2
-                    # Circularity
-                    if circularitycheckbox.isChecked():
-                        if states[count] == 1 and feature[3] >= min_circularity and feature[3] <= max_circularity:
-                            states[count] = 1
-                        else:
-                            states[count] = 2
-                else:
-                    states[count] = 2
-                count += 1
-
-            self.filtered_trained_img = ClassifierWindow(self.trained_img.image, 'Filtered Trained Image')
-            self.filtered_trained_img.imageIdentifier = ClassifierWindow.TRAINING
-            self.filtered_trained_img.window_states = states
-            self.filtered_trained_img.set_roi_states()
-            self.roiStates = np.copy(self.filtered_trained_img.window_states)
-        except AttributeError:
+        if self.trained_img is None:
             g.alert('Please run the SVM Classification Training')
+            return
+        self.filtered_trained_img = ClassifierWindow(self.trained_img.image, 'Filtered Trained Image',
+                                                     segmentation=self.trained_img.segmentation)
+        self.filtered_trained_img.imageIdentifier = ClassifierWindow.TRAINING
+        self.apply_filters()
+
+    def apply_filters(self):
+        # Evaluates every filter over the whole fiber table at once and repaints the Filtered Trained Image
+        try:
+            states = apply_rules(self.get_filter_rules(), self.trained_img.fiber_table, self.trained_img.window_states)
+        except (ValueError, KeyError) as e:
+            g.alert('Invalid filter: {}'.format(e))
+            return
+        self.filtered_trained_img.window_states = states
+        self.filtered_trained_img.set_roi_states()
+        self.roiStates = np.copy(self.filtered_trained_img.window_states)
+
+    def filter_rules_changed(self):
+        # An open Filtered Trained Image follows the filter spin boxes and check boxes as they change
+        if self.filtered_trained_img is not None and self.trained_img is not None and \
+                not getattr(self.filtered_trained_img, 'closed', False):
+            self.apply_filters()
+
+    def get_filter_rules(self):
+        # The filters of the GUI as rules (see rules.py), followed by loaded rules that have no controls in the GUI
+        gui = self.algorithm_gui
+        rules = []
+        for feature, widget_name in Quantimus.FILTER_WIDGETS:
+            rules.append({'feature': feature,
+                          'min': getattr(gui, 'min_{}_SpinBox'.format(widget_name)).value(),
+                          'max': getattr(gui, 'max_{}_SpinBox'.format(widget_name)).value(),
+                          'enabled': getattr(gui, '{}_CheckBox'.format(widget_name)).isChecked()})
+        return rules + self.extra_filter_rules
+
+    def set_filter_rules(self, rules):
+        gui = self.algorithm_gui
+        widget_names = dict(Quantimus.FILTER_WIDGETS)
+        self.extra_filter_rules = []
+        for rule in rules:
+            widget_name = widget_names.get(rule.get('feature'))
+            if widget_name is None or rule.get('min') is None or rule.get('max') is None:
+                self.extra_filter_rules.append(rule)
+                continue
+            widgets = [getattr(gui, '{}_CheckBox'.format(widget_name)),
+                       getattr(gui, 'min_{}_SpinBox'.format(widget_name)),
+                       getattr(gui, 'max_{}_SpinBox'.format(widget_name))]
+            # Apply the filters once at the end rather than for every widget
+            for widget in widgets:
+                widget.blockSignals(True)
+            widgets[0].setChecked(rule.get('enabled', True))
+            widgets[1].setValue(rule['min'])
+            widgets[2].setValue(rule['max'])
+            for widget in widgets:
+                widget.blockSignals(False)
+        self.filter_rules_changed()
+
+    def save_filters(self):
+        filename = save_file_gui("Save filters", filetypes='*.json')
+        if filename is None:
+            return None
+        save_rules(filename, self.get_filter_rules())
+
+    def load_filters(self):
+        filename = open_file_gui("Open filters", filetypes='*.json')
+        if filename is None:
+            return None
+        self.set_filter_rules(load_rules(filename))
 
     def select_flourescence_image(self):
         print('Flourescence image selected.')
@@ -531,7 +604,9 @@ class Quantimus:
         self.reset_flourescence_data()
         self.flourescence_img = None
         # Select the image
-        self.flourescence_img = ClassifierWindow(self.flourescence_img_selector.window.image, 'Flourescence Image')
+        self.flourescence_img = ClassifierWindow(self.flourescence_img_selector.window.image, 'Flourescence Image',
+                                                 segmentation=getattr(self.flourescence_img_selector.window,
+                                                                      'segmentation', None))
         self.flourescence_img.imageIdentifier = None
         self.flourescence_img.window_states = np.copy(self.flourescence_img_selector.window.window_states)
         self.paint_flr_colored_image()
@@ -541,6 +616,7 @@ class Quantimus:
         # Reset potentially old data
         self.reset_flourescence_data()
         # Select the image
+        # A stack is treated as one channel per frame, all measured at once
         self.intensity_img = self.intensity_img_selector.window.image
         self.flourescence_img.set_bg_im()
         self.flourescence_img.bg_im_dialog.setWindowTitle("Select an image")
@@ -550,7 +626,8 @@ class Quantimus:
             self.flourescence_img.bg_im_dialog.bg_im = None
         # Remove the 'Select Window' button from the popup
         self.flourescence_img.bg_im_dialog.formlayout.removeRow(0)
-        self.flourescence_img.bg_im_dialog.parent.bg_im = pg.ImageItem(self.intensity_img)
+        self.flourescence_img.bg_im_dialog.parent.bg_im = pg.ImageItem(
+            as_channel_stack(self.intensity_img)[self.get_intensity_channel()])
         self.flourescence_img.bg_im_dialog.parent.bg_im.setOpacity(
             self.flourescence_img.bg_im_dialog.alpha_slider.value())
         self.flourescence_img.bg_im_dialog.parent.imageview.view.addItem(
@@ -558,31 +635,37 @@ class Quantimus:
 
     def calculate_flourescence(self):
         print('Calculating Flourescence Intensity')
-
-        progress = self.create_progress_bar('Please wait while fluorescence intensity is being calculated...')
-        progress.show()
-        QtWidgets.QApplication.processEvents()
-
         if self.flourescence_img is None:
             g.alert('Make sure a Flourescence image is selected')
         elif self.intensity_img is None:
             g.alert('Make sure an Intensity image is selected')
         else:
-            intensityprops = measure.regionprops(self.flourescence_img.labeled_img, self.intensity_img)
-            self.flourescenceIntensities = np.array([p.mean_intensity for p in intensityprops])
-            self.isIntensityCalculated = True
+            self.run_in_background('Please wait while fluorescence intensity is being calculated...', intensity_job,
+                                   (self.flourescence_img.fiber_table, self.intensity_img,
+                                    self.algorithm_gui.flourescence_subtraction_SpinBox.value()), self.show_intensities)
+
+    def show_intensities(self, channel_intensities):
+        self.channelIntensities = channel_intensities
+        self.isIntensityCalculated = True
+        self.select_intensity_channel()
+
+    def get_intensity_channel(self):
+        # The channel of a stack is the frame shown in the intensity window
+        if self.intensity_img is None or np.ndim(self.intensity_img) == 2:
+            return 0
+        return self.intensity_img_selector.window.currentIndex
+
+    def select_intensity_channel(self):
+        # Positives are determined and measured on the channel currently shown in the intensity window
+        if self.channelIntensities is not None:
+            self.flourescenceIntensities = self.channelIntensities[self.get_intensity_channel()]
 
     def save_flourescence(self):
         print("Saving Flourescence Data")
-
-        progress = self.create_progress_bar('Please wait while fluorescence intensity is being saved...')
-        progress.show()
-        QtWidgets.QApplication.processEvents()
-
         if not self.isIntensityCalculated:
             g.alert("Make sure the Flourescence Intensity has been calculated")
         else:
-            self.saved_flourescence_rois = self.flourescence_img.window_props
+            self.saved_flourescence_rois = self.flourescence_img.fiber_table
             self.saved_flourescence_states = np.copy(self.flourescence_img.window_states)
 
     def determine_positives(self):
@@ -593,34 +676,31 @@ class Quantimus:
         print("Measuring Positive Fibers")
         if not self.isIntensityCalculated:
             g.alert("Make sure the Flourescence Intensity has been calculated")
-        else:
-            # Get the user-selected Positive Fiber's MFI values
-            userselectedprops = []
-            for i in range(len(self.flourescence_img.window_props)):
-                if self.flourescence_img.temp_states is not None and self.flourescence_img.temp_states[i] == 3:
-                    userselectedprops.append(g.quantimus.flourescenceIntensities[i])
-
-            # Sort the MFI values
-            userselectedprops.sort()
-
-            if len(userselectedprops) > 0:
-                # Get the lowest MFI from the list
-                lowest_mfi_value = userselectedprops[0]
-
-                # Loop through all ROIs and get any MFI that is higher than the lowest user selected
-                self.positiveFiberRois = []
-                self.positiveFiberStates = []
-                for i in range(len(self.flourescence_img.window_props)):
-                    # build the positive states list - for printing
-                    self.positiveFiberStates.append(self.flourescence_img.temp_states[i])
-                    if self.flourescence_img.temp_states[i] != 2 and g.quantimus.flourescenceIntensities[i] >= lowest_mfi_value:
-                        self.positiveFiberRois.append(self.flourescence_img.window_props[i])
-                        self.positiveFiberStates[i] = 3
-
-                # Paint the image appropriately
-                self.paint_positive_fibers(self.positiveFiberRois)
-            else:
-                g.alert("Please select at least one Positive Fiber")
+        elif not self.update_positives():
+            g.alert("Please select at least one Positive Fiber")
+
+    def update_positives(self):
+        # Every fiber whose MFI is at least the lowest MFI of the user-selected Positive Fibers is positive. The MFI is
+        # a column of the fiber table, so this is cheap to repeat. Returns False if no fiber is selected.
+        self.select_intensity_channel()
+        temp_states = self.flourescence_img.temp_states
+        if temp_states is None or not np.any(temp_states == 3):
+            return False
+        lowest_mfi_value = np.min(self.flourescenceIntensities[temp_states == 3])
+        self.positiveFiberStates = find_positive_fibers(self.flourescenceIntensities, temp_states, lowest_mfi_value)
+        self.positiveFiberRois = np.nonzero(self.positiveFiberStates == 3)[0]
+        self.channelPositiveStates[self.get_intensity_channel()] = self.positiveFiberStates
+        # Repaint every fiber, so fibers that are no longer positive lose their color
+        self.flourescence_img.set_roi_states(self.positiveFiberStates)
+        return True
+
+    def flourescence_subtraction_changed(self):
+        # The background-subtracted MFI is recomputed from the cached MFI, and the positives are re-evaluated with it
+        if self.isIntensityCalculated:
+            self.show_intensities(get_corrected_intensities(
+                self.flourescence_img.fiber_table, self.algorithm_gui.flourescence_subtraction_SpinBox.value()))
+            if self.positiveFiberStates is not None:
+                self.update_positives()
 
     def clear_positives(self):
         print("Clearing Positive Fibers")
@@ -635,6 +715,7 @@ class Quantimus:
         print("Saving Positive Fibers")
         self.saved_positive_rois = self.positiveFiberRois
         self.saved_positive_states = self.positiveFiberStates
+        self.saved_channel_positive_states = dict(self.channelPositiveStates)
 
     def paint_flr_colored_image(self):
         if self.flourescence_img is not None:
@@ -642,30 +723,26 @@ class Quantimus:
 
     def reset_flourescence_data(self):
         self.flourescenceIntensities = None
+        self.channelIntensities = None
         self.isIntensityCalculated = False
         self.positiveFiberRois = None
         self.positiveFiberStates = None
+        self.channelPositiveStates = {}
+        self.saved_channel_positive_states = {}
         self.saved_flourescence_rois = None
         self.saved_flourescence_states = None
         self.saved_positive_rois = None
         self.saved_positive_states = None
 
-    def paint_positive_fibers(self, props):
-        if props is not None:
-            for prop in props:
-                x, y = prop.coords.T
-                self.flourescence_img.colored_img[x, y] = ClassifierWindow.BLUE
-            self.flourescence_img.update_image(self.flourescence_img.colored_img)
-
     def select_dapi_image(self):
         print('DAPI image selected.')
         # Reset potentially old data
         self.reset_dapi_data()
         # Select the image
-        self.dapi_img = ClassifierWindow(self.dapi_img_selector.window.image, 'CNF Image')
+        self.dapi_img = ClassifierWindow(self.dapi_img_selector.window.image, 'CNF Image',
+                                         segmentation=getattr(self.dapi_img_selector.window, 'segmentation', None))
         self.dapi_img.imageIdentifier = ClassifierWindow.DAPI
         self.dapi_img.window_states = np.copy(self.dapi_img_selector.window.window_states)
-        self.algorithm_gui.run_erosion_button.pressed.connect(self.dapi_img.run_erosion)
         self.paint_dapi_colored_image()
 
     def select_dapi_binarized_image(self):
@@ -674,7 +751,6 @@ class Quantimus:
         self.reset_dapi_data()
         # Select the image
         self.dapi_binarized_img = self.binarized_dapi_img_selector.window.image
-        self.dapi_rois = measure.regionprops(self.dapi_binarized_img)
         # Overlay the DAPI onto the image
         self.dapi_img.set_bg_im()
 
@@ -692,74 +768,55 @@ class Quantimus:
 
     def calculate_dapi(self):
         print('Calculating DAPI')
-
-        progress = self.create_progress_bar('Please wait while CNF is being calculated...')
-        progress.show()
-        QtWidgets.QApplication.processEvents()
-
         if self.dapi_img is None:
             g.alert('Make sure a DAPI image is selected')
         elif self.dapi_binarized_img is None:
             g.alert('Make sure a classified, DAPI image is selected')
-        elif self.eroded_roi_states is None:
+        elif self.eroded_labeled_img is None:
             g.alert('Make sure to run the Fiber Erosion before calculating DAPI Overlap')
         else:
-            # Turn each image into lists
-            erodedlist = list(chain.from_iterable(zip(*self.eroded_labeled_img)))
-            dapilist = list(chain.from_iterable(zip(*self.dapi_binarized_img)))
-
-            overlappedcoords = []
-            imagewidth = len(list(self.dapi_binarized_img))
-
-            count = 0
-            # loop to check if there is overlap between DAPI and the eroded rois
-            while count < len(erodedlist):
-                # add an item to the overlapped coordinates list
-                if erodedlist[count] > 0 and dapilist[count] > 0:
-                    overlapx = math.floor(count / imagewidth) - 1
-                    overlapy = count % imagewidth
-                    newlist = [overlapx, overlapy]
-                    overlappedcoords.append(newlist)
-                count += 1
-
-            previouscentroid = 0
-
-            for coord in overlappedcoords:
-                roi_num = self.dapi_img.labeled_img[coord[1], coord[0]] - 1
-                if self.dapi_img.window_states[roi_num] == 1:
-                    prop = self.dapi_img.window_props[roi_num]
-                    # Check that the last processed ROI's centroid is not the exact same as the current ROI's centroid
-                    # This is a method of checking uniqueness that doesn't require the use of nested loops
-                    centroid = prop.centroid
-                    if centroid != previouscentroid:
-                        previouscentroid = centroid
-                        self.dapi_img.window_states[roi_num] = 3
+            self.run_in_background('Please wait while CNF is being calculated...', central_nuclei_job,
+                                   (self.dapi_img.labeled_img, self.eroded_labeled_img, self.dapi_binarized_img,
+                                    np.copy(self.dapi_img.window_states)), self.show_central_nuclei)
+
+    def show_central_nuclei(self, result):
+        if self.dapi_img is not None:
+            self.dapi_contingency, self.dapi_img.window_states = result
+            n_nuclei, overlap_areas = get_central_nuclei_counts(self.dapi_contingency)
+            print('{} fibers with central nuclei, {} nuclei in total'.format(
+                np.count_nonzero(self.dapi_img.window_states == 3), np.sum(n_nuclei[self.dapi_img.window_states == 3])))
             self.paint_dapi_colored_image()
 
-    def save_dapi(self):
-        print("Saving DAPI Data")
+    def run_erosion(self):
+        # Erodes the fibers of the DAPI window selected last
+        if self.dapi_img is None:
+            g.alert('Make sure a DAPI image is selected')
+        else:
+            self.dapi_img.run_erosion()
 
-        progress = self.create_progress_bar('Please wait while CNF data is being saved...')
-        progress.show()
-        QtWidgets.QApplication.processEvents()
+    def erosion_percentage_changed(self):
+        # After the first erosion, the eroded image follows the spin box
+        if self.dapi_img is not None and self.eroded_labeled_img is not None:
+            self.dapi_img.update_erosion()
 
-        self.saved_dapi_rois = self.dapi_img.window_props
+    def save_dapi(self):
+        print("Saving DAPI Data")
+        self.saved_dapi_rois = self.dapi_img.fiber_table
         self.saved_dapi_states = np.copy(self.dapi_img.window_states)
 
     def paint_dapi_colored_image(self):
         if self.dapi_img is not None:
             # Green, Red, and Purple
-            self.dapi_img.set_roi_states()
+            self.dapi_img.render_roi_states()
             # Yellow eroded ROIS
-            if self.eroded_roi_states is not None:
-                for prop in self.eroded_roi_states:
-                    x, y = prop.coords.T
-                    self.dapi_img.colored_img[x, y] = ClassifierWindow.YELLOW
+            if self.eroded_labeled_img is not None:
+                self.dapi_img.colored_img[self.eroded_labeled_img > 0] = ClassifierWindow.YELLOW
             self.dapi_img.update_image(self.dapi_img.colored_img)
 
     def reset_dapi_data(self):
         self.dapi_rois = None
-        self.eroded_roi_states = None
+        self.eroded_labeled_img = None
+        self.dapi_contingency = None
         self.saved_dapi_rois = None
         self.saved_dapi_states = None
         if self.dapi_img is not None:
@@ -769,121 +826,51 @@ class Quantimus:
     def print_data(self):
 
         if self.classifier_window is not None:
-            self.classifier_window.calculate_window_props()
-            props = self.classifier_window.window_props
+            window = self.classifier_window
         elif self.trained_img is not None:
-            self.trained_img.calculate_window_props()
-            props = self.trained_img.window_props
+            window = self.trained_img
         elif self.filtered_trained_img is not None:
-            self.filtered_trained_img.calculate_window_props()
-            props = self.filtered_trained_img.window_props
-        elif self.intensity_img is not None:
-            self.intensity_img.calculate_window_props()
-            props = self.intensity_img.window_props
+            window = self.filtered_trained_img
+        elif self.flourescence_img is not None:
+            window = self.flourescence_img
         else:
-            self.dapi_img.calculate_window_props()
-            props = self.dapi_img.window_props
-
-        progress = self.create_progress_bar('Please wait while data is printed...')
-        progress.show()
-        QtWidgets.QApplication.processEvents()
+            window = self.dapi_img
+        fibers = window.fiber_table
 
+        filesaveasname = save_file_gui('Save file as...', filetypes='*.xlsx')
+        if filesaveasname is None:
+            return None
         scalefactor = self.algorithm_gui.microns_per_pixel_SpinBox.value()
         resizefactor = g.quantimus.algorithm_gui.resize_factor_SpinBox.value()
-        minferetprops = self.calc_min_feret_diameters(props)
-
-        # Set up the multi-dimensional array to store all of the data
-        dataarray = [['ROI #'], ['Area'], ['Minferet'], ['CNF'], ['MFI'], ['Positive']]
-
-        for i in range(len(props)):
-            QtWidgets.QApplication.processEvents()
-
-            # Green States
-            if self.roiStates[i] == 1 or self.roiStates[i] == 3:
-                # ROI Number
-                dataarray[0].append(str(i))
-
-                # Area
-                area = props[i].area
-                area /= (scalefactor ** 2 * resizefactor ** 2)
-                dataarray[1].append(area)
-
-                # MinFeret
-                minferet = minferetprops[i] / (scalefactor * resizefactor)
-                dataarray[2].append(minferet)
-
-                # CNF - Purple States
-                if self.saved_dapi_states is not None:
-                    if self.saved_dapi_states[i] == 3:
-                        dataarray[3].append("1")
-                    else:
-                        dataarray[3].append("0")
-
-                # MFI
-                if self.isIntensityCalculated:
-                    subtractionvalue = g.quantimus.algorithm_gui.flourescence_subtraction_SpinBox.value()
-                    measuredintensity = self.flourescenceIntensities[i]
-                    intensity = 0
-
-                    if measuredintensity > subtractionvalue:
-                        intensity = measuredintensity - subtractionvalue
-
-                    dataarray[4].append(intensity)
-
-                # Positive Fibers
-                if self.saved_positive_rois is not None:
-                    if self.saved_positive_states[i] == 3:
-                        dataarray[5].append("1")
-                    else:
-                        dataarray[5].append("0")
 
-        filesaveasname = save_file_gui('Save file as...', filetypes='*.xlsx')
-        workbook = xlsxwriter.Workbook(filesaveasname)
-        worksheet = workbook.add_worksheet()
-        worksheet.write_column('A1', dataarray[0])
-        worksheet.write_column('B1', dataarray[1])
-        worksheet.write_column('C1', dataarray[2])
-        worksheet.write_column('D1', dataarray[3])
-        worksheet.write_column('E1', dataarray[4])
-        worksheet.write_column('F1', dataarray[5])
-
-        worksheet.write('G1', 'Scale Factor (pixels/micron)')
-        worksheet.write('G2', scalefactor)
-        worksheet.write('H1', 'Resize Factor')
-        worksheet.write('H2', resizefactor)
-
-        workbook.close()
-
-    def calc_min_feret_diameters(self, props):
-        # Calculates all the minimum feret diameters for regions in props
-        min_feret_diameters = []
-        thetas = np.arange(0, np.pi / 2, .01)
-        rs = [rotation_matrix(theta) for theta in thetas]
-        for prop in props:
-            # Update the progress bar so it shows movement
-            QtWidgets.QApplication.processEvents()
-
-            # Determine if all items in the array are True
-            alltrue = True
-            for row in prop.convex_image:
-                if not all(row):
-                    alltrue = False
-                    break
-
-            if alltrue:
-                min_feret_diameters.append(len(prop.convex_image.shape))
-            else:
-                identity_convex_hull = prop.convex_image
-                coordinates = np.vstack(measure.find_contours(identity_convex_hull, 0.5, fully_connected='high'))
-                coordinates -= np.mean(coordinates, 0)
-                diams = []
-                for r in rs:
-                    newcoords = np.dot(coordinates, r.T)
-                    w, h = np.max(newcoords, 0) - np.min(newcoords, 0)
-                    diams.extend([w, h])
-                min_feret_diameters.append(np.min(diams))
-        min_feret_diameters = np.array(min_feret_diameters)
-        return min_feret_diameters
+        intensities = None
+        if self.isIntensityCalculated:
+            intensities = self.flourescenceIntensities
+        positive_states = None
+        if self.saved_positive_rois is not None:
+            positive_states = self.saved_positive_states
+        if self.isIntensityCalculated and len(self.channelIntensities) > 1:
+            # One MFI and Positive column per channel
+            intensities = np.array(self.channelIntensities)
+            positive_states = [self.saved_channel_positive_states.get(channel)
+                               for channel in range(len(self.channelIntensities))]
+        self.run_in_background('Please wait while data is printed...', export_job,
+                               (filesaveasname, np.copy(self.roiStates), fibers, scalefactor, resizefactor,
+                                self.saved_dapi_states, intensities, positive_states),
+                               lambda filename: print('Saved {}'.format(filename)))
+
+    def print_memory_report(self):
+        # Memory held by the window of every stage, in the order of the workflow. Arrays shared between windows are
+        # counted for the first one, and the segmentations shared by the classifier windows are counted on their own.
+        original = None if self.original_window_selector is None else self.original_window_selector.window
+        stages = [('Original', original), ('Image pyramid', self.image_pyramid), ('Markers', self.markers_win),
+                  ('Filled Boundaries', self.filled_boundaries_win), ('Segmentations', segmentation_cache),
+                  ('Binary', self.binary_img),
+                  ('Training Image', self.classifier_window),
+                  ('Trained Image', self.trained_img), ('Filtered Trained Image', self.filtered_trained_img),
+                  ('Flourescence Image', self.flourescence_img), ('DAPI Image', self.dapi_img),
+                  ('Quantimus', self)]
+        print(format_memory_report(get_memory_report(stages)))
 
     def reset_data(self, originating_window):
         reset = False
@@ -961,12 +948,14 @@ class Quantimus:
 
         # ROIs and States
         self.roiStates = None
-        self.eroded_roi_states = None
         self.dapi_rois = None
+        self.dapi_contingency = None
         self.roiProps = None
         self.flourescenceIntensities = None
+        self.channelIntensities = None
         self.positiveFiberRois = None
         self.positiveFiberStates = None
+        self.channelPositiveStates = {}
         # Printing Data
         self.saved_flourescence_rois = None
         self.saved_flourescence_states = None
@@ -974,6 +963,7 @@ class Quantimus:
         self.saved_dapi_states = None
         self.saved_positive_rois = None
         self.saved_positive_states = None
+        self.saved_channel_positive_states = {}
 
         # Misc
         self.isIntensityCalculated = False
@@ -987,5 +977,25 @@ class Quantimus:
             defaultButton=QtWidgets.QMessageBox.No)
 
 
-quantimus = Quantimus()
-g.quantimus = quantimus
+def get_quantimus():
+    # The Quantimus instance, created the first time the plugin is used
+    if not isinstance(getattr(g, 'quantimus', None), Quantimus):
+        g.quantimus = Quantimus()
+    return g.quantimus
+
+
+class LazyQuantimus:
+    """
+    Stands in for the Quantimus instance in the flika menu (quantimus.gui in info.xml), so loading the plugin when
+    flika starts does not create it. The instance is created when QuantiMus is opened, and attributes are forwarded
+    to it.
+    """
+
+    def gui(self):
+        return get_quantimus().gui()
+
+    def __getattr__(self, name):
+        return getattr(get_quantimus(), name)
+
+
+quantimus = LazyQuantimus()
@@ -0,0 +1,69 @@
+"""
+Maps a function over every ROI of a label image, in a pool of threads.
+
+Each ROI is cut out of the label image with its bounding box from scipy.ndimage.find_objects, so the function only
+sees the pixels it needs:
+
+    func(mask, intensity, *args)
+
+where mask is the boolean image of the ROI inside its bounding box and intensity is the same box of the intensity
+image (or None). The ROIs are split into chunks of chunk_size that run in a pool of threads. The threads share the
+images, so nothing is copied, and the numpy and scipy.ndimage operations that do the work release the GIL while they
+run. func must not modify shared state without a lock.
+"""
+import os
+import numpy as np
+from scipy import ndimage
+from concurrent.futures import ThreadPoolExecutor
+
+
+def get_roi_slices(label_img):
+    # Bounding box of every ROI. ROI i (label i + 1) is label_img[slices[i]]. Labels that are not present are None.
+    return ndimage.find_objects(label_img)
+
+
+def _map_chunk(func, label_img, intensity_img, rois, slices, args):
+    results = []
+    for roi_num in rois:
+        bbox = slices[roi_num]
+        mask = label_img[bbox] == roi_num + 1
+        intensity = None if intensity_img is None else intensity_img[bbox]
+        results.append(func(mask, intensity, *args))
+    return results
+
+
+def map_rois(func, label_img, intensity_img=None, rois=None, args=(), threads=None, chunk_size=64, callback=None,
+             slices=None):
+    # Returns [func(mask, intensity, *args) for each ROI in rois], in the order of rois. rois defaults to every ROI.
+    # threads defaults to the number of CPUs, and threads=1 runs in the calling thread. callback is called in the
+    # calling thread after every chunk of chunk_size ROIs, e.g. to report progress.
+    if slices is None:
+        slices = get_roi_slices(label_img)
+    if rois is None:
+        rois = np.arange(len(slices))
+    rois = [int(roi_num) for roi_num in rois]
+    chunks = [rois[i:i + chunk_size] for i in range(0, len(rois), chunk_size)]
+    if threads is None:
+        threads = os.cpu_count() or 1
+    threads = min(threads, len(chunks))
+
+    results = []
+    if threads <= 1:
+        for chunk in chunks:
+            results.extend(_map_chunk(func, label_img, intensity_img, chunk, slices, args))
+            if callback is not None:
+                callback()
+        return results
+    with ThreadPoolExecutor(threads) as executor:
+        futures = [executor.submit(_map_chunk, func, label_img, intensity_img, chunk, slices, args) for chunk in chunks]
+        try:
+            # Chunks are collected in order, so the results need no reordering
+            for future in futures:
+                results.extend(future.result())
+                if callback is not None:
+                    callback()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return results
@@ -0,0 +1,129 @@
+"""
+Declarative filters for fibers.
+
+A rule is a condition that a fiber must satisfy to be kept. Rules are plain dicts, so a list of rules can be saved as
+JSON with the rest of the parameters of a session:
+
+    {'feature': 'convexity', 'min': .7}                              a range. Either bound can be left out.
+    {'feature': 'filled_area / 4000', 'min': .05, 'max': 3}          the feature of a range can be an expression
+    {'expression': 'not (eccentricity > .96 and convexity < .85)'}   any boolean expression
+
+Expressions use the names of the columns of a fiber_table.FiberTable (or of any mapping from names to arrays), numbers,
+arithmetic, comparisons, and, or, not and the functions in EXPRESSION_FUNCTIONS. Any rule can have 'enabled': False.
+
+Every rule is evaluated for all fibers at once as a boolean mask, and the masks of a list of rules are combined with
+and. Columns of a FiberTable are computed the first time a rule reads them.
+"""
+import ast
+import json
+import codecs
+import numpy as np
+
+
+EXPRESSION_FUNCTIONS = {'abs': np.abs, 'sqrt': np.sqrt, 'log': np.log, 'minimum': np.minimum, 'maximum': np.maximum}
+
+_BINARY_OPERATORS = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.true_divide,
+                     ast.Pow: np.power, ast.Mod: np.mod}
+_COMPARISONS = {ast.Lt: np.less, ast.LtE: np.less_equal, ast.Gt: np.greater, ast.GtE: np.greater_equal,
+                ast.Eq: np.equal, ast.NotEq: np.not_equal}
+
+# The rules of quantimus.remove_false_positives, over the features of quantimus.get_important_features
+FALSE_POSITIVE_RULES = [
+    {'feature': 'area', 'min': .05, 'max': 3},
+    {'feature': 'convexity', 'min': .7},
+    {'expression': 'not (eccentricity > .96 and convexity < .85)'},
+    {'feature': 'circularity', 'min': .4},
+]
+
+
+def _evaluate_node(node, columns):
+    if isinstance(node, ast.Expression):
+        return _evaluate_node(node.body, columns)
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return node.value
+    if isinstance(node, ast.Name):
+        return np.asarray(columns[node.id])
+    if isinstance(node, ast.BoolOp):
+        combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+        return combine.reduce([_evaluate_node(value, columns) for value in node.values])
+    if isinstance(node, ast.UnaryOp):
+        operand = _evaluate_node(node.operand, columns)
+        if isinstance(node.op, ast.Not):
+            return np.logical_not(operand)
+        if isinstance(node.op, ast.USub):
+            return np.negative(operand)
+        if isinstance(node.op, ast.UAdd):
+            return operand
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+        return _BINARY_OPERATORS[type(node.op)](_evaluate_node(node.left, columns),
+                                                _evaluate_node(node.right, columns))
+    if isinstance(node, ast.Compare) and all(type(op) in _COMPARISONS for op in node.ops):
+        # a < b < c is (a < b) and (b < c)
+        left = _evaluate_node(node.left, columns)
+        mask = True
+        for op, comparator in zip(node.ops, node.comparators):
+            right = _evaluate_node(comparator, columns)
+            mask = np.logical_and(mask, _COMPARISONS[type(op)](left, right))
+            left = right
+        return mask
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in EXPRESSION_FUNCTIONS \
+            and not node.keywords:
+        return EXPRESSION_FUNCTIONS[node.func.id](*[_evaluate_node(arg, columns) for arg in node.args])
+    raise ValueError('Unsupported syntax in a filter expression: {}'.format(ast.dump(node)))
+
+
+def evaluate_expression(expression, columns):
+    # Value of expression for every fiber. columns is a FiberTable or a mapping from column names to arrays.
+    # Raises a ValueError for invalid expressions and a KeyError for unknown columns.
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError('Invalid filter expression {!r}: {}'.format(expression, e.msg))
+    return _evaluate_node(tree, columns)
+
+
+def get_rule_mask(rule, columns, n_rois):
+    # Boolean mask of the fibers that satisfy rule
+    if not rule.get('enabled', True):
+        return np.ones(n_rois, dtype=bool)
+    if 'expression' in rule:
+        mask = evaluate_expression(rule['expression'], columns)
+    else:
+        feature = evaluate_expression(rule['feature'], columns)
+        mask = np.ones(np.shape(feature), dtype=bool)
+        if rule.get('min') is not None:
+            mask &= feature >= rule['min']
+        if rule.get('max') is not None:
+            mask &= feature <= rule['max']
+    return np.broadcast_to(np.asarray(mask, dtype=bool), (n_rois,))
+
+
+def get_rules_mask(rules, columns, n_rois):
+    # Boolean mask of the fibers that satisfy every rule
+    keep = np.ones(n_rois, dtype=bool)
+    for rule in rules:
+        keep &= get_rule_mask(rule, columns, n_rois)
+    return keep
+
+
+def apply_rules(rules, columns, states):
+    # New states: green fibers (1) that satisfy every rule stay green and all others become red (2)
+    states = np.asarray(states)
+    keep = (states == 1) & get_rules_mask(rules, columns, len(states))
+    return np.where(keep, 1, 2).astype(states.dtype)
+
+
+def ranges_to_rules(filters):
+    # Rules from a dict mapping feature names to (min, max) ranges, or None for a disabled filter
+    return [{'feature': name, 'min': limits[0], 'max': limits[1]}
+            for name, limits in filters.items() if limits is not None]
+
+
+def save_rules(filename, rules):
+    data = {'rules': rules}
+    json.dump(data, codecs.open(filename, 'w', encoding='utf-8'), separators=(',', ':'), sort_keys=True, indent=4)
+
+
+def load_rules(filename):
+    obj_text = codecs.open(filename, 'r', encoding='utf-8').read()
+    return json.loads(obj_text)['rules']
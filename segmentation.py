@@ -0,0 +1,158 @@
+import numpy as np
+from skimage.measure import label
+
+
+def normalize_image(image, dtype=float):
+    # The threshold sliders expect an image with values between 0 and 1
+    image = image.astype(dtype)
+    image -= np.min(image)
+    image /= np.max(image)
+    return image
+
+
+def get_markers(image, thresh1, thresh2):
+    markers = (image > thresh1).astype(dtype=np.uint8)
+    markers[image > thresh2] = 2
+    return markers
+
+
+def select_labels(label_img, labels):
+    # Mask of the pixels whose label is in labels, as a single lookup table gather over the label image
+    lut = np.zeros(int(np.max(label_img)) + 1, dtype=bool)
+    lut[labels] = True
+    return lut[label_img]
+
+
+def remove_borders(binary_image):
+    label_img = label(binary_image, connectivity=2)
+    border_labels = np.unique(np.r_[label_img[:, 0], label_img[0, :], label_img[-1, :], label_img[:, -1]])
+    binary_image[select_labels(label_img, border_labels)] = 0
+    return binary_image
+
+
+class LabelStack:
+    """
+    Read-only (n_rois, mx, my) boolean stack where frame i is the mask of ROI i + 1 in a label image.
+
+    Frames are computed from the label image only when they are indexed, so the stack costs no more memory than the
+    label image itself. It can be passed to a Window in place of an array.
+    """
+
+    def __init__(self, label_img):
+        self.label_img = label_img
+        self.shape = (int(np.max(label_img)),) + label_img.shape
+        self.ndim = 3
+        self.dtype = np.dtype(bool)
+        self.size = int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        rois = np.arange(self.shape[0])[key[0]]
+        label_img = self.label_img[key[1:]]
+        if np.ndim(rois) == 0:
+            return label_img == rois + 1
+        return label_img[np.newaxis] == (rois + 1).reshape((-1,) + (1,) * label_img.ndim)
+
+    def __array__(self, dtype=None, copy=None):
+        frames = self[:]
+        if dtype is not None:
+            frames = frames.astype(dtype)
+        return frames
+
+
+# The 4-connected neighbourhood used by binary_dilation, including the pixel itself
+NEIGHBOURHOOD = np.array([[0, 0], [-1, 0], [1, 0], [0, -1], [0, 1]])
+
+
+def get_ring_pixels(label_img, selected, inner=1, outer=3):
+    # Returns the rows, columns and labels of every pixel whose city block distance to a selected region is
+    # greater than inner and at most outer. selected is a boolean lookup table indexed by label.
+    # Every region gets its own ring, even where the rings of neighbouring regions overlap. The rings are grown
+    # from the region boundaries as sparse (pixel, label) pairs, so the cost scales with the length of the
+    # boundaries rather than with the number of regions times their size.
+    mx, my = label_img.shape
+    n_labels = len(selected)
+    edge = np.zeros(label_img.shape, dtype=bool)
+    edge[:-1] |= label_img[:-1] != label_img[1:]
+    edge[1:] |= label_img[1:] != label_img[:-1]
+    edge[:, :-1] |= label_img[:, :-1] != label_img[:, 1:]
+    edge[:, 1:] |= label_img[:, 1:] != label_img[:, :-1]
+    edge &= selected[label_img]
+    x, y = np.nonzero(edge)
+    keys = (x * my + y) * n_labels + label_img[x, y]
+    inner_keys = np.array([], dtype=keys.dtype)
+    for step in range(1, outer + 1):
+        pixels, labels = np.divmod(keys, n_labels)
+        x, y = np.divmod(pixels, my)
+        x = (x[:, np.newaxis] + NEIGHBOURHOOD[:, 0]).ravel()
+        y = (y[:, np.newaxis] + NEIGHBOURHOOD[:, 1]).ravel()
+        labels = np.repeat(labels, len(NEIGHBOURHOOD))
+        keep = (x >= 0) & (x < mx) & (y >= 0) & (y < my)
+        x, y, labels = x[keep], y[keep], labels[keep]
+        keep = label_img[x, y] != labels
+        keys = np.unique((x[keep] * my + y[keep]) * n_labels + labels[keep])
+        if step == inner:
+            inner_keys = keys
+    keys = np.setdiff1d(keys, inner_keys, assume_unique=True)
+    pixels, labels = np.divmod(keys, n_labels)
+    x, y = np.divmod(pixels, my)
+    return x, y, labels
+
+
+def get_merge_borders(label_im_1, label_im_2, resizefactor=1):
+    # Returns the rows and columns of the borders that separate the regions of label_im_1 (the lower threshold)
+    # that merged into a larger region of label_im_2 (the upper threshold).
+    # Every region below the lower threshold lies inside exactly one region below the upper threshold
+    upper_labels = np.zeros(np.max(label_im_1) + 1, dtype=label_im_2.dtype)
+    upper_labels[label_im_1] = label_im_2
+    area_1 = np.bincount(label_im_1.ravel())
+    area_2 = np.bincount(label_im_2.ravel())
+
+    # A region that grows by more than 20% between the two thresholds has merged with a neighbour
+    merged = (area_1 > 65 * resizefactor ** 2) & (area_2[upper_labels] > 1.2 * area_1)
+    merged[0] = False
+
+    # Draw a border 2-3 pixels outside each merged region, inside the region it merged into
+    x, y, labels = get_ring_pixels(label_im_1, merged, 1, 3)
+    inside = label_im_2[x, y] == upper_labels[labels]
+    return x[inside], y[inside]
+
+
+def get_new_image(image, thresh1=.20, thresh2=.30, resizefactor=1):
+    label_im_1 = label(image < thresh1, connectivity=2)
+    label_im_2 = label(image < thresh2, connectivity=2)
+    x, y = get_merge_borders(label_im_1, label_im_2, resizefactor)
+    image_new = np.copy(image)
+    image_new[x, y] = 2
+    return image_new
+
+
+def fill_boundaries(image, lower_bound, upper_bound, resizefactor=1, n_thresholds=8, callback=None):
+    # Walks the thresholds between lower_bound and upper_bound, drawing a border (value 2) wherever a region
+    # below one threshold merges with a neighbour below the next one.
+    thresholds = np.linspace(lower_bound, upper_bound, n_thresholds)
+    image_new = np.copy(image)
+
+    for i in np.arange(len(thresholds) - 1):
+        if callback is not None:
+            callback()
+        label_im_1 = label(image_new < thresholds[i], connectivity=2)
+        label_im_2 = label(image_new < thresholds[i + 1], connectivity=2)
+        x, y = get_merge_borders(label_im_1, label_im_2, resizefactor)
+        image_new[x, y] = 2
+
+    # Remove ROIs that do not contain any pixel below the lower bound
+    label_im_1 = label(image < lower_bound, connectivity=2)
+    label_im_2 = label(image < upper_bound, connectivity=2)
+    has_lower = np.bincount(label_im_2[label_im_1 > 0], minlength=np.max(label_im_2) + 1) > 0
+    has_lower[0] = True
+    image_new[~has_lower[label_im_2]] = 2
+    return image_new
+
+
+def get_binary_image(filled_boundaries, upper_bound):
+    return remove_borders(filled_boundaries < upper_bound)
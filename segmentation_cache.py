@@ -0,0 +1,90 @@
+"""
+Cache of the segmentations of binary images.
+
+A Segmentation holds everything that depends only on a binary image: the binary image itself, its label image, the
+bounding box of every ROI and the FiberTable of its features. Every ClassifierWindow of the same binary image shares
+one Segmentation, so the training, trained, filtered, fluorescence and DAPI windows hold only their own states and
+colors, and opening one costs no segmentation work.
+
+Segmentations are found by the hash of the binary image (get_segmentation). The cache keeps the most recently used
+segmentations, up to SegmentationCache.MAX_SIZE.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from .memory import label_fibers
+from .fiber_table import FiberTable
+from .roi_map import get_roi_slices
+
+
+def get_binary_hash(binary_image):
+    # Identifies a binary image by its shape and which pixels are set
+    binary_image = np.asarray(binary_image)
+    return hashlib.sha1(str(binary_image.shape).encode() + np.packbits(binary_image > 0).tobytes()).hexdigest()
+
+
+class Segmentation:
+    """
+    The label image, ROI bounding boxes and features of one binary image. ROI i is label i + 1.
+    """
+
+    def __init__(self, binary_image, key=None):
+        self.binary_image = np.asarray(binary_image) > 0
+        self.binary_image.flags.writeable = False
+        self.key = get_binary_hash(self.binary_image) if key is None else key
+        self.labeled_img = label_fibers(self.binary_image)
+        self.labeled_img.flags.writeable = False
+        self.n_rois = int(np.max(self.labeled_img, initial=0))
+        self.fiber_table = FiberTable(self.labeled_img)
+        self.roi_slices = None
+
+    def __len__(self):
+        return self.n_rois
+
+    def get_roi_slices(self):
+        # Bounding box of every ROI, computed the first time it is needed
+        if self.roi_slices is None:
+            self.roi_slices = get_roi_slices(self.labeled_img)
+        return self.roi_slices
+
+
+class SegmentationCache:
+    """
+    Segmentations by the hash of their binary image, least recently used first.
+    """
+    MAX_SIZE = 4
+
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self.segmentations = OrderedDict()
+        # Segmentations can be requested from worker threads (see workers.py)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.segmentations)
+
+    def get(self, binary_image):
+        # The segmentation of binary_image, segmenting it only if it is not cached
+        key = get_binary_hash(binary_image)
+        with self.lock:
+            if key in self.segmentations:
+                self.segmentations.move_to_end(key)
+                return self.segmentations[key]
+            segmentation = Segmentation(binary_image, key)
+            self.segmentations[key] = segmentation
+            while len(self.segmentations) > self.max_size:
+                self.segmentations.popitem(last=False)
+            return segmentation
+
+    def clear(self):
+        with self.lock:
+            self.segmentations.clear()
+
+
+segmentation_cache = SegmentationCache()
+
+
+def get_segmentation(binary_image):
+    return segmentation_cache.get(binary_image)
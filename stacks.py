@@ -0,0 +1,61 @@
+import os
+import numpy as np
+
+
+def _memory_map(filename):
+    # The image in filename, memory-mapped, or None if it cannot be, e.g. a compressed .tif file
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.npy':
+        return np.load(filename, mmap_mode='r')
+    if ext in ('.tif', '.tiff'):
+        try:
+            import tifffile
+            return tifffile.memmap(filename, mode='r')
+        except (ImportError, ValueError):
+            return None
+    return None
+
+
+def open_channel_stack(filename, channel_axis=None):
+    # Opens a fluorescence image as a (n_channels, mx, my) stack. A 2D image is a stack of one channel.
+    # .npy files and uncompressed .tif files are memory-mapped, so each channel is only read from disk when it is
+    # used. channel_axis defaults to the shortest axis of a 3D image.
+    stack = _memory_map(filename)
+    if stack is None:
+        from skimage import io
+        stack = io.imread(filename)
+    return as_channel_stack(stack, channel_axis)
+
+
+def get_memory_mappable(filename, npy_path):
+    # filename if it can be memory-mapped. Otherwise the image is decoded once into the .npy file npy_path, which is
+    # returned. .tif files are decoded by tifffile a tile or strip at a time, straight into the memory-mapped .npy
+    # file, so the image is never held in memory as a whole.
+    stack = _memory_map(filename)
+    if stack is not None:
+        del stack
+        return filename
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in ('.tif', '.tiff'):
+        import tifffile
+        with tifffile.TiffFile(filename) as tif:
+            series = tif.series[0]
+            out = np.lib.format.open_memmap(npy_path, mode='w+', dtype=series.dtype, shape=series.shape)
+            series.asarray(out=out)
+            out.flush()
+            del out
+    else:
+        from skimage import io
+        np.save(npy_path, io.imread(filename))
+    return npy_path
+
+
+def as_channel_stack(image, channel_axis=None):
+    # View of a 2D image or 3D stack with the channels first. Does not copy memory-mapped stacks.
+    if image.ndim == 2:
+        return image[np.newaxis]
+    if image.ndim != 3:
+        raise ValueError('Expected a 2D image or a 3D stack of channels, got shape {}'.format(image.shape))
+    if channel_axis is None:
+        channel_axis = int(np.argmin(image.shape))
+    return np.moveaxis(image, channel_axis, 0)
@@ -0,0 +1,14 @@
+"""
+Makes the plugin importable as the package quantimus from any checkout directory, so the tests can import its
+Qt-free modules without flika.
+"""
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if 'quantimus' not in sys.modules:
+    package = types.ModuleType('quantimus')
+    package.__path__ = [ROOT]
+    sys.modules['quantimus'] = package
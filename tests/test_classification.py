@@ -0,0 +1,88 @@
+import json
+import numpy as np
+import pytest
+
+from quantimus.classification import (Classifier, CLASSIFIER_BACKENDS, get_norm_coeffs, normalize_data,
+                                      _get_tree_params, _tree_decision_function)
+
+
+def make_training_data(n_samples=400, seed=0):
+    # Two overlapping clouds of (area, eccentricity, convexity, circularity) features. 1 is a fiber, 0 is not.
+    rng = np.random.RandomState(seed)
+    y = rng.randint(0, 2, n_samples)
+    x = rng.normal(0, 1, (n_samples, 4)) + y[:, np.newaxis] * [1.5, -1, 1, 1]
+    x[:, 0] = x[:, 0] * 500 + 2000
+    return x, y
+
+
+@pytest.mark.parametrize('backend', CLASSIFIER_BACKENDS)
+def test_save_and_load(backend, tmp_path):
+    x, y = make_training_data()
+    mu, sigma = get_norm_coeffs(x)
+    classifier = Classifier.train(x, y, mu, sigma, backend=backend)
+    states = classifier.predict(x)
+    assert set(np.unique(states)) <= {1, 2}
+    # Most training samples are classified correctly
+    assert np.mean((states == 1) == (y == 1)) > .8
+    filename = str(tmp_path / 'classifier.json')
+    classifier.save(filename)
+    loaded = Classifier.load(filename)
+    assert loaded.backend == backend
+    assert loaded.feature_columns == classifier.feature_columns
+    assert np.array_equal(loaded.predict(x), states)
+    assert np.allclose(loaded.decision_function(x), classifier.decision_function(x))
+
+
+@pytest.mark.parametrize('backend', CLASSIFIER_BACKENDS)
+def test_one_class_is_refused(backend):
+    x, y = make_training_data()
+    mu, sigma = get_norm_coeffs(x)
+    with pytest.raises(ValueError, match='1 positive and 1 negative'):
+        Classifier.train(x, np.ones_like(y), mu, sigma, backend=backend)
+
+
+def test_chunked_predict_matches():
+    x, y = make_training_data(1000)
+    mu, sigma = get_norm_coeffs(x)
+    classifier = Classifier.train(x, y, mu, sigma, backend='nystroem')
+    steps = []
+    states = classifier.predict(x, chunk_size=64, threads=4, callback=lambda: steps.append(1))
+    assert len(steps) == 16
+    assert np.array_equal(states, classifier.predict(x, chunk_size=len(x), threads=1))
+
+
+def test_svc_gamma_is_the_default_of_scikit_learn():
+    from sklearn import svm
+    x, y = make_training_data()
+    mu, sigma = get_norm_coeffs(x)
+    classifier = Classifier.train(x, y, mu, sigma, backend='svc')
+    normalized = normalize_data(x, mu, sigma)
+    assert np.isclose(classifier.params['gamma'], 1. / (x.shape[1] * normalized.var()))
+    clf = svm.SVC().fit(normalized, y)
+    assert np.allclose(classifier.decision_function(x), clf.decision_function(normalized))
+
+
+def test_boosted_trees_match_scikit_learn_with_missing_values():
+    from sklearn.ensemble import HistGradientBoostingClassifier
+    x, y = make_training_data(1000)
+    x[::7, 1] = np.nan
+    clf = HistGradientBoostingClassifier(random_state=0).fit(x, y)
+    x_test, _ = make_training_data(500, seed=1)
+    x_test[::3, 2] = np.nan
+    assert np.allclose(_tree_decision_function(x_test, _get_tree_params(clf)), clf.decision_function(x_test))
+
+
+def test_pickled_boosted_trees_are_refused(tmp_path):
+    x, y = make_training_data()
+    mu, sigma = get_norm_coeffs(x)
+    filename = str(tmp_path / 'classifier.json')
+    Classifier.train(x, y, mu, sigma, backend='boosted_trees').save(filename)
+    with open(filename) as f:
+        data = json.load(f)
+    assert 'model' not in data['params']
+    data['version'] = 2
+    data['params'] = {'model': 'gASV', 'sklearn_version': '1.0'}
+    with open(filename, 'w') as f:
+        json.dump(data, f)
+    with pytest.raises(ValueError, match='pickled'):
+        Classifier.load(filename)
@@ -0,0 +1,143 @@
+import sqlite3
+import threading
+import numpy as np
+import pytest
+
+from quantimus import mysql_interface
+from quantimus.database import FiberDatabase, SQLiteBackend, SampleExistsError
+
+
+def make_fibers(n_fibers, seed=0):
+    return np.random.RandomState(seed).uniform(0, 1, (n_fibers, 5))
+
+
+def make_legacy_database(filename, names=('m1',)):
+    # Tables as created for the first versions of mysql_interface, without any index
+    con = sqlite3.connect(filename)
+    con.execute('CREATE TABLE mice (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(255))')
+    con.execute('CREATE TABLE fibers (id INTEGER PRIMARY KEY AUTOINCREMENT, mouse_id INTEGER, area DOUBLE, '
+                'eccentricity DOUBLE, convexity DOUBLE, circularity DOUBLE, minor_axis_length DOUBLE)')
+    for name in names:
+        con.execute('INSERT INTO mice (name) VALUES (?)', (name,))
+        con.execute('INSERT INTO fibers (mouse_id, area, eccentricity, convexity, circularity, minor_axis_length) '
+                    'VALUES ((SELECT id FROM mice WHERE name=?), 1, 2, 3, 4, 5)', (name,))
+    con.commit()
+    con.close()
+
+
+def get_indexes(filename):
+    con = sqlite3.connect(filename)
+    indexes = {name: (table, sql) for name, table, sql in con.execute(
+        "SELECT name, tbl_name, sql FROM sqlite_master WHERE type = 'index'")}
+    con.close()
+    return indexes
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = FiberDatabase(SQLiteBackend(str(tmp_path / 'fibers.db')))
+    yield database
+    database.close()
+
+
+def test_add_and_replace(database):
+    fibers = make_fibers(10)
+    assert database.add_fibers('m1', fibers) == 10
+    assert np.allclose(database.get_fibers('m1'), fibers)
+    with pytest.raises(SampleExistsError):
+        database.add_fibers('m1', make_fibers(3, 1), replace=False)
+    assert np.allclose(database.get_fibers('m1'), fibers)
+    database.add_fibers('m1', make_fibers(3, 1))
+    assert np.allclose(database.get_fibers('m1'), make_fibers(3, 1))
+    assert database.get_sample_names() == ['m1']
+    assert database.get_fibers('m2') is None
+
+
+def test_failed_cohort_stores_nothing(database):
+    with pytest.raises(ValueError):
+        database.add_samples({'m1': make_fibers(4), 'm2': np.ones((2, 3))})
+    assert database.get_sample_names() == []
+
+
+def test_legacy_schema_is_migrated(tmp_path):
+    filename = str(tmp_path / 'legacy.db')
+    make_legacy_database(filename)
+    database = FiberDatabase(SQLiteBackend(filename))
+    indexes = get_indexes(filename)
+    assert 'UNIQUE' in indexes['mice_name'][1]
+    assert indexes['fibers_mouse_id'][0] == 'fibers'
+    with pytest.raises(SampleExistsError):
+        database.add_fibers('m1', make_fibers(3), replace=False)
+    assert database.get_sample_names() == ['m1']
+    assert np.allclose(database.get_fibers('m1'), [[1, 2, 3, 4, 5]])
+    database.add_fibers('m2', make_fibers(3))
+    assert database.get_sample_names() == ['m1', 'm2']
+    database.close()
+    # Opening the database again finds the indexes
+    FiberDatabase(SQLiteBackend(filename)).close()
+    assert get_indexes(filename) == indexes
+
+
+def test_legacy_schema_with_duplicate_names(tmp_path):
+    filename = str(tmp_path / 'legacy.db')
+    make_legacy_database(filename, ['m1', 'm1'])
+    database = FiberDatabase(SQLiteBackend(filename))
+    assert 'UNIQUE' not in get_indexes(filename)['mice_name'][1]
+    with pytest.raises(SampleExistsError):
+        database.add_fibers('m1', make_fibers(3), replace=False)
+    assert database.get_sample_names() == ['m1', 'm1']
+    database.close()
+
+
+def test_mysql_interface_messages(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'legacy.db')
+    make_legacy_database(filename)
+    monkeypatch.setattr(mysql_interface, '_database', FiberDatabase(SQLiteBackend(filename)))
+    message = mysql_interface.add_fibers('m1', make_fibers(3))
+    assert message == "An entry with the mousname 'm1' already exists. Change the name and try again"
+    assert mysql_interface.add_fibers('m2', make_fibers(3)) == 'Successfully added all fibers to database'
+    assert mysql_interface.get_database().get_sample_names() == ['m1', 'm2']
+
+
+class FlakySQLiteBackend(SQLiteBackend):
+    """
+    A SQLite backend whose connections stop answering once they are marked broken
+    """
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        # The broken connections themselves, so their ids are not reused by new connections
+        self.broken = []
+        self.n_connects = 0
+
+    def connect(self):
+        self.n_connects += 1
+        return super().connect()
+
+    def ping(self, con):
+        if any(con is broken for broken in self.broken):
+            raise sqlite3.OperationalError('server has gone away')
+
+
+def test_pool_replaces_broken_connections(tmp_path):
+    backend = FlakySQLiteBackend(str(tmp_path / 'fibers.db'))
+    database = FiberDatabase(backend, pool_size=2)
+    for i in range(5):
+        with database.pool.connection() as con:
+            backend.broken.append(con)
+        database.add_fibers('m{}'.format(i), make_fibers(2))
+    assert database.pool.n_open <= 2
+    assert backend.n_connects == 6
+
+    # Threads waiting for a connection get the replacement of a broken one
+    threads = [threading.Thread(target=database.add_fibers, args=('t{}'.format(i), make_fibers(2))) for i in range(8)]
+    for con in list(database.pool.idle.queue):
+        backend.broken.append(con)
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert not any(thread.is_alive() for thread in threads)
+    assert len(database.get_sample_names()) == 13
+    assert database.pool.n_open <= 2
+    database.close()
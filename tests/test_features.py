@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+from skimage.measure import label, regionprops
+
+from quantimus.benchmarks import make_label_image, _swept_min_feret_diameters
+from quantimus.features import get_perimeters, get_convex_hulls, get_convex_areas, calc_min_feret_diameters
+from quantimus.fiber_table import FiberTable
+
+
+def make_blobs(seed):
+    # Irregular ROIs with holes, thin branches and single pixels, from thresholded smoothed noise
+    rng = np.random.RandomState(seed)
+    noise = ndimage.gaussian_filter(rng.normal(0, 1, (120, 160)), 2)
+    return label(noise > .1, connectivity=2)
+
+
+LABEL_IMAGES = [('shapes', seed) for seed in range(3)] + [('blobs', seed) for seed in range(3)]
+
+
+@pytest.fixture(params=LABEL_IMAGES, ids=['{}-{}'.format(*p) for p in LABEL_IMAGES])
+def label_img(request):
+    kind, seed = request.param
+    if kind == 'shapes':
+        return make_label_image(n_rois=64, roi_size=30, seed=seed)
+    return make_blobs(seed)
+
+
+def test_perimeters_match_regionprops(label_img):
+    props = regionprops(label_img)
+    assert np.allclose(get_perimeters(label_img), [p.perimeter for p in props])
+
+
+def test_convex_areas_match_regionprops(label_img):
+    props = regionprops(label_img)
+    assert np.array_equal(get_convex_areas(get_convex_hulls(label_img)), [p.area_convex for p in props])
+
+
+def test_min_feret_diameters_match_an_angle_sweep(label_img):
+    hulls = get_convex_hulls(label_img)
+    min_feret = calc_min_feret_diameters(hulls)
+    swept = _swept_min_feret_diameters(hulls)
+    # The sweep can only miss the narrowest direction, by less than half its angular step
+    assert np.all(min_feret <= swept + 1e-9)
+    assert np.all(swept - min_feret < 1e-3 * np.maximum(swept, 1))
+
+
+def test_circularity_and_convexity_match_regionprops(label_img):
+    fibers = FiberTable(label_img)
+    props = regionprops(label_img)
+    perimeters = np.array([p.perimeter for p in props])
+    filled_areas = np.array([p.area_filled for p in props])
+    circularity = np.where(perimeters == 0, 0, 4 * np.pi * filled_areas / np.where(perimeters == 0, 1, perimeters) ** 2)
+    assert np.allclose(fibers['circularity'], circularity)
+    assert np.allclose(fibers['convexity'], filled_areas / np.array([p.area_convex for p in props]))
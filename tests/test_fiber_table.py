@@ -0,0 +1,83 @@
+import time
+import threading
+import numpy as np
+from skimage.measure import label, regionprops
+
+from quantimus import fiber_table as fiber_table_module
+from quantimus.fiber_table import FiberTable
+from quantimus.analysis import find_positive_fibers
+
+
+def make_label_image():
+    image = np.zeros((60, 80), dtype=bool)
+    image[5:20, 5:30] = True
+    image[30:55, 10:25] = True
+    image[25:50, 40:75] = True
+    image[28:35, 60:70] = False
+    return label(image, connectivity=2)
+
+
+def test_columns_match_regionprops():
+    label_img = make_label_image()
+    fibers = FiberTable(label_img)
+    props = regionprops(label_img)
+    assert len(fibers) == len(props)
+    assert np.array_equal(fibers['area'], [p.area for p in props])
+    assert np.array_equal(fibers['filled_area'], [p.area_filled for p in props])
+    assert np.allclose(fibers['eccentricity'], [p.eccentricity for p in props])
+    assert np.allclose(fibers['minor_axis_length'], [p.axis_minor_length for p in props])
+
+
+def test_intensity_columns_follow_the_intensity_image():
+    label_img = make_label_image()
+    fibers = FiberTable(label_img, np.ones(label_img.shape))
+    assert np.allclose(fibers['mfi'], 1)
+    fibers.set_intensity_image(np.stack([np.full(label_img.shape, 2.), np.full(label_img.shape, 3.)]))
+    assert 'mfi' not in fibers
+    assert np.allclose(fibers['mfi_ch1'], 2)
+    assert np.allclose(fibers['mfi_ch2'], 3)
+
+
+def test_columns_are_computed_once_across_threads(monkeypatch):
+    calls = []
+    get_convex_hulls = fiber_table_module.get_convex_hulls
+
+    def slow_get_convex_hulls(label_img):
+        calls.append(1)
+        time.sleep(.05)
+        return get_convex_hulls(label_img)
+
+    monkeypatch.setattr(fiber_table_module, 'get_convex_hulls', slow_get_convex_hulls)
+    fibers = FiberTable(make_label_image())
+    results = []
+    threads = [threading.Thread(target=lambda name=name: results.append(fibers[name]))
+               for name in ['convexity', 'min_feret', 'convex_area'] * 4]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert len(results) == len(threads)
+
+
+def test_corrected_mfi_follows_the_background_without_another_pass(monkeypatch):
+    calls = []
+    get_channel_intensity_stats = fiber_table_module.get_channel_intensity_stats
+
+    def counted_get_channel_intensity_stats(*args):
+        calls.append(1)
+        return get_channel_intensity_stats(*args)
+
+    monkeypatch.setattr(fiber_table_module, 'get_channel_intensity_stats', counted_get_channel_intensity_stats)
+    label_img = make_label_image()
+    fibers = FiberTable(label_img, label_img * 10.)
+    assert np.allclose(fibers['corrected_mfi'], [10, 20, 30])
+    fibers.set_background(15)
+    assert np.allclose(fibers['corrected_mfi'], [0, 5, 15])
+    assert np.allclose(fibers['mfi'], [10, 20, 30])
+    assert len(calls) == 1
+    positives = find_positive_fibers(fibers['corrected_mfi'], np.array([1, 1, 2]), 5)
+    assert np.array_equal(positives, [1, 3, 2])
+    fibers.set_intensity_image(np.stack([label_img * 10., label_img * 20.]))
+    assert np.allclose(fibers['corrected_mfi_ch2'], [5, 25, 45])
+    assert len(calls) == 2
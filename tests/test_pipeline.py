@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+from skimage.measure import label
+
+from quantimus.benchmarks import make_laminin_image
+from quantimus.segmentation import normalize_image, fill_boundaries, get_binary_image
+from quantimus.pipeline import load_parameters, process_sample
+
+tifffile = pytest.importorskip('tifffile')
+openpyxl = pytest.importorskip('openpyxl')
+pytest.importorskip('xlsxwriter')
+
+COLUMNS = ['ROI #', 'Area', 'Minferet', 'CNF', 'MFI', 'Positive', 'Scale Factor (pixels/micron)', 'Resize Factor']
+
+
+@pytest.fixture(scope='module')
+def sample(tmp_path_factory):
+    # A laminin image, a DAPI image with a nucleus on the deepest pixel of every third fiber, and a fluorescence image
+    # where every fiber has a uniform intensity of 100 * (label % 4)
+    directory = tmp_path_factory.mktemp('sample')
+    laminin = make_laminin_image(size=400, fiber_size=30)
+    labels = label(get_binary_image(fill_boundaries(normalize_image(laminin), .2, .4, 1, 8), .4), connectivity=2)
+    n_fibers = int(np.max(labels))
+    depths = ndimage.distance_transform_cdt(labels > 0, metric='taxicab')
+    nucleated = np.arange(0, n_fibers, 3)
+    dapi = np.zeros(labels.shape, dtype=np.uint8)
+    for x, y in ndimage.maximum_position(depths, labels, nucleated + 1):
+        dapi[x - 1:x + 2, y - 1:y + 2] = 255
+    flourescence = (100 * (labels % 4)).astype(np.uint16)
+    paths = {}
+    for channel, image in (('laminin', laminin), ('dapi', dapi), ('flourescence', flourescence)):
+        paths[channel] = str(directory / 's0_{}.tif'.format(channel))
+        tifffile.imwrite(paths[channel], image)
+    return paths, labels, nucleated
+
+
+def read_xlsx(filename):
+    rows = list(openpyxl.load_workbook(filename).active.iter_rows(values_only=True))
+    return [list(column) for column in zip(*rows)]
+
+
+@pytest.mark.parametrize('tile_size', [None, 128])
+def test_process_sample(sample, tile_size, tmp_path):
+    paths, labels, nucleated = sample
+    parameters = load_parameters()
+    parameters.update({'microns_per_pixel': 1., 'tile_size': tile_size, 'tile_overlap': 48,
+                       'flourescence_subtraction': 50., 'positive_mfi_threshold': 150.})
+    filename = process_sample('s0', paths, parameters, str(tmp_path))
+    columns = read_xlsx(filename)
+    assert [column[0] for column in columns] == COLUMNS
+
+    # Without a classifier or filters, every fiber is exported
+    n_fibers = int(np.max(labels))
+    assert n_fibers > 50
+    roi_nums = np.array([int(roi_num) for roi_num in columns[0][1:] if roi_num is not None])
+    assert np.array_equal(roi_nums, np.arange(n_fibers))
+    areas = np.bincount(labels.ravel())[1:]
+    assert np.array_equal(columns[1][1:n_fibers + 1], areas)
+    # The deepest pixel survives the erosion of every fiber that is eroded at all, i.e. larger than 10 pixels after it
+    cnf = np.isin(roi_nums, nucleated) & (areas * .2 > 10)
+    assert np.count_nonzero(cnf) > 20
+    assert np.array_equal(columns[3][1:n_fibers + 1], np.where(cnf, '1', '0'))
+    mfi = np.maximum(100 * ((roi_nums + 1) % 4) - 50, 0)
+    assert np.allclose(columns[4][1:n_fibers + 1], mfi)
+    assert np.array_equal(columns[5][1:n_fibers + 1], np.where(mfi >= 150, '1', '0'))
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+from skimage.measure import label
+
+from quantimus.roi_map import map_rois
+from quantimus.features import get_filled_areas
+
+
+def make_label_image():
+    image = np.zeros((40, 60), dtype=bool)
+    image[2:12, 2:12] = True
+    image[5:8, 5:8] = False
+    image[20:35, 10:50] = True
+    image[25:30, 20:25] = False
+    image[2:10, 40:55] = True
+    return label(image, connectivity=2)
+
+
+def test_map_rois_in_order_of_rois():
+    label_img = make_label_image()
+    steps = []
+    areas = map_rois(lambda mask, intensity: int(np.sum(mask)), label_img, rois=[2, 0], chunk_size=1,
+                     callback=lambda: steps.append(1))
+    assert areas == [np.sum(label_img == 3), np.sum(label_img == 1)]
+    assert len(steps) == 2
+    intensity_img = np.arange(label_img.size, dtype=float).reshape(label_img.shape)
+    sums = map_rois(lambda mask, intensity: np.sum(intensity[mask]), label_img, intensity_img)
+    assert np.allclose(sums, ndimage.sum(intensity_img, label_img, np.arange(1, np.max(label_img) + 1)))
+
+
+def test_filled_areas():
+    label_img = make_label_image()
+    expected = [np.sum(ndimage.binary_fill_holes(label_img == i)) for i in range(1, np.max(label_img) + 1)]
+    assert np.array_equal(get_filled_areas(label_img), expected)
+
+
+def test_threads_match_serial():
+    label_img = label(np.random.RandomState(0).uniform(size=(200, 200)) > .6, connectivity=1)
+    intensity_img = np.random.RandomState(1).uniform(size=label_img.shape)
+
+    def func(mask, intensity):
+        return np.sum(intensity[ndimage.binary_fill_holes(mask)])
+
+    steps = []
+    serial = map_rois(func, label_img, intensity_img, threads=1, chunk_size=16)
+    threaded = map_rois(func, label_img, intensity_img, threads=4, chunk_size=16, callback=lambda: steps.append(1))
+    assert threaded == serial
+    assert len(steps) == int(np.ceil(np.max(label_img) / 16))
+
+
+def test_threads_raise_errors_of_func():
+    label_img = make_label_image()
+
+    def func(mask, intensity):
+        if np.sum(mask) > 100:
+            raise ValueError('too large')
+        return 0
+
+    with pytest.raises(ValueError):
+        map_rois(func, label_img, threads=2, chunk_size=1)
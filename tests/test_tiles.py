@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from skimage.measure import label
+
+from quantimus.benchmarks import make_laminin_image
+from quantimus.segmentation import normalize_image, fill_boundaries, get_binary_image
+from quantimus.tiles import segment_tiled
+
+
+def segment_whole(image):
+    filled_boundaries = fill_boundaries(normalize_image(image), .2, .4, 1, 8)
+    return label(get_binary_image(filled_boundaries, .4), connectivity=2)
+
+
+@pytest.fixture(scope='module')
+def image():
+    return make_laminin_image(size=400, fiber_size=30)
+
+
+@pytest.mark.parametrize('tile_size', [96, 128, 400])
+def test_tiles_match_whole_image(image, tile_size, tmp_path):
+    whole = segment_whole(image)
+    tiled = segment_tiled(image, str(tmp_path / 'segmentation'), .2, .4, 1, 8, tile_size, 48, 2)
+    assert np.max(whole) > 50
+    assert np.array_equal(np.asarray(tiled), whole)
+
+
+def test_tiles_of_a_file_in_processes(image, tmp_path):
+    filename = str(tmp_path / 'laminin.npy')
+    np.save(filename, image)
+    tiled = segment_tiled(filename, str(tmp_path / 'segmentation'), .2, .4, 1, 8, 128, 48, 2)
+    assert np.array_equal(np.asarray(tiled), segment_whole(image))
+
+
+def test_tiles_of_a_compressed_tif(image, tmp_path):
+    tifffile = pytest.importorskip('tifffile')
+    filename = str(tmp_path / 'laminin.tif')
+    tifffile.imwrite(filename, image, compression='zlib', tile=(64, 64))
+    with pytest.raises(ValueError):
+        tifffile.memmap(filename, mode='r')
+    output_dir = tmp_path / 'segmentation'
+    tiled = segment_tiled(filename, str(output_dir), .2, .4, 1, 8, 128, 48, 2)
+    assert np.array_equal(np.load(str(output_dir / 'image.npy')), image)
+    assert np.array_equal(np.asarray(tiled), segment_whole(image))
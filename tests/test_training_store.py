@@ -0,0 +1,47 @@
+import numpy as np
+
+from quantimus.training_store import TrainingStore, get_image_hash
+
+
+def make_session(n_rois, seed):
+    rng = np.random.RandomState(seed)
+    features = rng.uniform(0, 1, (n_rois, 4)).astype(np.float32)
+    states = rng.randint(0, 3, n_rois)
+    return features, states, np.arange(n_rois)
+
+
+def test_image_hash_does_not_depend_on_dtype():
+    label_img = np.arange(60).reshape(6, 10) % 7
+    hashes = {get_image_hash(label_img.astype(dtype)) for dtype in (np.int32, np.int64, np.uint16, np.uint32)}
+    assert len(hashes) == 1
+    assert get_image_hash(label_img) != get_image_hash(label_img.T)
+
+
+def test_latest_sample_of_each_fiber_is_kept(tmp_path):
+    store = TrainingStore(str(tmp_path / 'store'))
+    sessions = [(make_session(50, 0), 'a'), (make_session(30, 1), 'b'), (make_session(50, 2), 'a')]
+    for (features, states, rois), image_hash in sessions:
+        store.append(features, states, rois, image_hash)
+    features, states, rois, image_hashes = TrainingStore(str(tmp_path / 'store')).get_samples()
+
+    # The latest labeled sample of every (image, ROI), in the order the samples were stored
+    expected = {}
+    for session, ((f, s, r), image_hash) in enumerate(sessions):
+        for i in np.nonzero((s == 1) | (s == 2))[0]:
+            expected.pop((image_hash, r[i]), None)
+            expected[(image_hash, r[i])] = (session, i, f[i], s[i])
+    order = sorted(expected.items(), key=lambda item: item[1][:2])
+    assert [(h, r) for (h, r), _ in order] == list(zip(image_hashes, rois))
+    assert np.array_equal(features, [value[2] for _, value in order])
+    assert np.array_equal(states, [value[3] for _, value in order])
+    assert len(store.get_samples(deduplicate=False)[0]) == len(store)
+
+
+def test_merge_copies_each_session_once(tmp_path):
+    first, second = TrainingStore(str(tmp_path / 'first')), TrainingStore(str(tmp_path / 'second'))
+    first.append(*make_session(20, 0), image_hash='a')
+    second.append(*make_session(20, 0), image_hash='a')
+    second.append(*make_session(20, 1), image_hash='b')
+    assert first.merge(second) == 1
+    assert first.merge(str(tmp_path / 'second')) == 0
+    assert len(TrainingStore(str(tmp_path / 'first')).segments) == 2
@@ -0,0 +1,189 @@
+"""
+Tiled segmentation of images that do not fit in memory.
+
+segment_tiled runs the same stages as the GUI up to the label image (markers -> filled boundaries -> binary -> labels)
+on overlapping tiles of a memory-mapped image, in parallel, and writes the results to .npy files on disk:
+
+    binary.npy   uint8 binary image of the fibers
+    labels.npy   int32 label image of the fibers
+
+Each tile is read with a margin of overlap pixels on every side, so boundary filling sees the fibers around the
+edges of the tile, and only the core of the tile is kept. The cores are labeled separately, and labels that touch
+across the seams between cores are joined, so labels.npy is the same as labeling the whole binary image at once:
+the fibers are numbered in raster order, and fibers touching the edge of the image are removed. Only a few tiles and
+the pixels along the seams are in memory at once.
+
+Every tile reads its own part of the image file. Images that cannot be memory-mapped, like compressed .tif files,
+are first decoded once into output_dir/image.npy (see stacks.get_memory_mappable), rather than decoded whole for
+every tile.
+"""
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from skimage.measure import label
+
+from .segmentation import fill_boundaries
+from .stacks import open_channel_stack, get_memory_mappable
+
+
+def _open_image(image):
+    # image is a filename or an array. Files are memory-mapped when possible.
+    if isinstance(image, str):
+        return open_channel_stack(image)[0]
+    return image
+
+
+def get_tiles(shape, tile_size):
+    # (x0, x1, y0, y1) of the core of every tile, in raster order
+    return [(x0, min(x0 + tile_size, shape[0]), y0, min(y0 + tile_size, shape[1]))
+            for x0 in range(0, shape[0], tile_size) for y0 in range(0, shape[1], tile_size)]
+
+
+def get_value_range(image, block_rows=1024):
+    # Minimum and maximum of a memory-mapped image, reading block_rows rows at a time
+    image = _open_image(image)
+    blocks = [image[x:x + block_rows] for x in range(0, image.shape[0], block_rows)]
+    return min(np.min(block) for block in blocks), max(np.max(block) for block in blocks)
+
+
+def _segment_tile(image, binary_path, tile, overlap, value_range, thresh1, thresh2, resizefactor, n_thresholds):
+    # Fills the boundaries of one tile and its margin, and writes the binary image of its core
+    image = _open_image(image)
+    x0, x1, y0, y1 = tile
+    mx0, my0 = max(x0 - overlap, 0), max(y0 - overlap, 0)
+    mx1, my1 = min(x1 + overlap, image.shape[0]), min(y1 + overlap, image.shape[1])
+    # The same normalization as segmentation.normalize_image on the whole image
+    crop = np.asarray(image[mx0:mx1, my0:my1], dtype=float)
+    vmin, vmax = value_range
+    if vmax > 1:
+        crop = (crop - vmin) / (vmax - vmin)
+    filled = fill_boundaries(crop, thresh1, thresh2, resizefactor, n_thresholds)
+    binary = np.load(binary_path, mmap_mode='r+')
+    binary[x0:x1, y0:y1] = filled[x0 - mx0:x1 - mx0, y0 - my0:y1 - my0] < thresh2
+    binary.flush()
+
+
+def _label_tile(binary_path, labels_path, tile):
+    # Labels the core of one tile on its own. Returns the number of labels and the raster index (in the whole image)
+    # of the first pixel of each label.
+    x0, x1, y0, y1 = tile
+    binary = np.load(binary_path, mmap_mode='r')
+    tile_labels = label(np.asarray(binary[x0:x1, y0:y1]), connectivity=2).astype(np.int32)
+    labels = np.load(labels_path, mmap_mode='r+')
+    labels[x0:x1, y0:y1] = tile_labels
+    labels.flush()
+    n_labels = int(np.max(tile_labels)) if tile_labels.size else 0
+    first = np.zeros(n_labels, dtype=np.int64)
+    values, index = np.unique(tile_labels.ravel(), return_index=True)
+    tx, ty = np.divmod(index[values > 0], y1 - y0)
+    first[values[values > 0] - 1] = (tx + x0) * labels.shape[1] + ty + y0
+    return n_labels, first
+
+
+def _relabel_tile(labels_path, tile, offset, lut):
+    x0, x1, y0, y1 = tile
+    labels = np.load(labels_path, mmap_mode='r+')
+    tile_labels = np.asarray(labels[x0:x1, y0:y1], dtype=np.int64)
+    labels[x0:x1, y0:y1] = np.where(tile_labels > 0, lut[tile_labels + offset], 0)
+    labels.flush()
+
+
+def _get_seam_pairs(line_a, line_b):
+    # Pairs of global labels that touch across a seam between two adjacent lines of pixels, with 8-connectivity
+    pairs = []
+    n = len(line_a)
+    for shift in (-1, 0, 1):
+        a = line_a[max(0, -shift):n - max(0, shift)]
+        b = line_b[max(0, shift):n - max(0, -shift)]
+        touching = (a > 0) & (b > 0)
+        pairs.append(np.column_stack((a[touching], b[touching])))
+    return np.concatenate(pairs)
+
+
+def _read_global_line(labels, tiles, offsets, row=None, column=None):
+    # One row or column of the label image, with the local labels of each tile converted to global labels
+    if row is not None:
+        line = np.asarray(labels[row], dtype=np.int64)
+        for (x0, x1, y0, y1), offset in zip(tiles, offsets):
+            if x0 <= row < x1:
+                line[y0:y1] = np.where(line[y0:y1] > 0, line[y0:y1] + offset, 0)
+    else:
+        line = np.asarray(labels[:, column], dtype=np.int64)
+        for (x0, x1, y0, y1), offset in zip(tiles, offsets):
+            if y0 <= column < y1:
+                line[x0:x1] = np.where(line[x0:x1] > 0, line[x0:x1] + offset, 0)
+    return line
+
+
+def segment_tiled(image, output_dir, thresh1=.2, thresh2=.4, resizefactor=1, n_thresholds=8, tile_size=2048,
+                  overlap=256, processes=None):
+    # Segments image (a filename, or an array for images that fit in memory) and returns the label image, memory-
+    # mapped from output_dir/labels.npy. Fibers must be smaller than overlap for the tiles to agree with segmenting
+    # the whole image at once. Filenames are processed in a pool of processes, and arrays in a pool of threads.
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    if isinstance(image, str):
+        image = get_memory_mappable(image, os.path.join(output_dir, 'image.npy'))
+    shape = _open_image(image).shape
+    binary_path = os.path.join(output_dir, 'binary.npy')
+    labels_path = os.path.join(output_dir, 'labels.npy')
+    np.lib.format.open_memmap(binary_path, mode='w+', dtype=np.uint8, shape=shape).flush()
+    np.lib.format.open_memmap(labels_path, mode='w+', dtype=np.int32, shape=shape).flush()
+    tiles = get_tiles(shape, tile_size)
+    value_range = get_value_range(image)
+
+    executor_class = ProcessPoolExecutor if isinstance(image, str) else ThreadPoolExecutor
+    with executor_class(processes) as executor:
+        # Boundary filling of every tile, then labeling of every core
+        list(executor.map(_segment_tile, [image] * len(tiles), [binary_path] * len(tiles), tiles,
+                          [overlap] * len(tiles), [value_range] * len(tiles), [thresh1] * len(tiles),
+                          [thresh2] * len(tiles), [resizefactor] * len(tiles), [n_thresholds] * len(tiles)))
+        tile_results = list(executor.map(_label_tile, [binary_path] * len(tiles), [labels_path] * len(tiles), tiles))
+        n_labels = np.array([n for n, _ in tile_results], dtype=np.int64)
+        offsets = np.cumsum(n_labels) - n_labels
+        first_pixels = np.concatenate([np.zeros(1, dtype=np.int64)] + [first for _, first in tile_results])
+
+        # Join the labels that touch across the seams between tiles
+        labels = np.load(labels_path, mmap_mode='r')
+        seam_rows = sorted(set(x0 for x0, _, _, _ in tiles) - {0})
+        seam_columns = sorted(set(y0 for _, _, y0, _ in tiles) - {0})
+        pairs = [np.zeros((0, 2), dtype=np.int64)]
+        for row in seam_rows:
+            pairs.append(_get_seam_pairs(_read_global_line(labels, tiles, offsets, row=row - 1),
+                                         _read_global_line(labels, tiles, offsets, row=row)))
+        for column in seam_columns:
+            pairs.append(_get_seam_pairs(_read_global_line(labels, tiles, offsets, column=column - 1),
+                                         _read_global_line(labels, tiles, offsets, column=column)))
+        pairs = np.concatenate(pairs)
+        n_total = int(np.sum(n_labels)) + 1
+        graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n_total, n_total))
+        _, components = connected_components(graph, directed=False)
+
+        # Remove the fibers touching the edge of the image, like segmentation.remove_borders
+        edges = [_read_global_line(labels, tiles, offsets, row=0),
+                 _read_global_line(labels, tiles, offsets, row=shape[0] - 1),
+                 _read_global_line(labels, tiles, offsets, column=0),
+                 _read_global_line(labels, tiles, offsets, column=shape[1] - 1)]
+        removed = np.zeros(n_total, dtype=bool)
+        removed[components[np.concatenate(edges)]] = True
+        del labels
+
+        # Number the remaining fibers in raster order of their first pixel, like label() on the whole image
+        first_of_component = np.full(n_total, np.iinfo(np.int64).max)
+        np.minimum.at(first_of_component, components[1:], first_pixels[1:])
+        kept = np.nonzero(~removed & (first_of_component < np.iinfo(np.int64).max))[0]
+        component_labels = np.zeros(n_total, dtype=np.int32)
+        component_labels[kept[np.argsort(first_of_component[kept])]] = np.arange(1, len(kept) + 1)
+        lut = component_labels[components]
+        lut[0] = 0
+        list(executor.map(_relabel_tile, [labels_path] * len(tiles), tiles, offsets, [lut] * len(tiles)))
+
+    # The binary image without the fibers that were removed
+    for tile in tiles:
+        x0, x1, y0, y1 = tile
+        binary = np.load(binary_path, mmap_mode='r+')
+        binary[x0:x1, y0:y1] = np.load(labels_path, mmap_mode='r')[x0:x1, y0:y1] > 0
+        binary.flush()
+    return np.load(labels_path, mmap_mode='r')
@@ -0,0 +1,195 @@
+"""
+Append-only binary store of classifier training data.
+
+A training store is a directory holding a manifest (training_store.json) and one segment file per saved annotation
+session. A segment is a .npy structured array with one row per labeled fiber: its float32 features, its state (1 for
+a fiber, 2 for not a fiber) and its ROI number. The manifest records the feature columns and version of the store, and
+for every segment the hash and name of the label image it was annotated on.
+
+Saving a session only writes a new segment, so existing segments are never rewritten. Segments are memory-mapped when
+they are loaded, and only the samples that are kept are read from them. When a fiber of the same image was labeled in
+several sessions, the latest label is used. Segments are named by the hash of their contents, so merging stores copies
+each distinct session once.
+
+From the directory containing the plugin:
+    python -m quantimus.training_store merge <destination store> <source store> [<source store> ...]
+    python -m quantimus.training_store info <store>
+"""
+import os
+import sys
+import json
+import codecs
+import shutil
+import hashlib
+import numpy as np
+
+from .fiber_table import CLASSIFICATION_COLUMNS
+
+
+# Increase when the definition of a feature in CLASSIFICATION_COLUMNS changes, so old samples are not mixed with new
+FEATURE_VERSION = 1
+
+
+def get_image_hash(label_img):
+    # Identifies the segmentation a sample was labeled on. The labels are hashed as int64, so the hash does not depend
+    # on the dtype the label image is held in (see memory.get_label_dtype).
+    label_img = np.ascontiguousarray(label_img, dtype=np.int64)
+    return hashlib.sha1(str(label_img.shape).encode() + label_img.tobytes()).hexdigest()
+
+
+def is_training_store(path):
+    return os.path.isfile(os.path.join(path, TrainingStore.MANIFEST)) or \
+        os.path.basename(path) == TrainingStore.MANIFEST
+
+
+class TrainingStore:
+    """
+    A directory of training samples from any number of annotation sessions and images. Opening a path that does not
+    exist creates an empty store there. The path can also be the manifest file inside the store.
+    """
+    VERSION = 1
+    MANIFEST = 'training_store.json'
+
+    def __init__(self, path, feature_columns=CLASSIFICATION_COLUMNS):
+        if os.path.basename(path) == TrainingStore.MANIFEST:
+            path = os.path.dirname(path)
+        self.path = path
+        manifest = os.path.join(path, TrainingStore.MANIFEST)
+        if os.path.isfile(manifest):
+            data = json.loads(codecs.open(manifest, 'r', encoding='utf-8').read())
+            if data['version'] != TrainingStore.VERSION:
+                raise ValueError('{} is a version {} training store. Version {} is supported.'.format(
+                    path, data['version'], TrainingStore.VERSION))
+            self.feature_columns = data['feature_columns']
+            self.feature_version = data['feature_version']
+            self.segments = data['segments']
+        else:
+            self.feature_columns = list(feature_columns)
+            self.feature_version = FEATURE_VERSION
+            self.segments = []
+
+    def __len__(self):
+        # Number of stored samples, before duplicates are removed
+        return sum(segment['n_samples'] for segment in self.segments)
+
+    def get_dtype(self):
+        return np.dtype([('features', np.float32, (len(self.feature_columns),)), ('state', np.uint8),
+                         ('roi', np.int32)])
+
+    def _write_manifest(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        data = {'version': TrainingStore.VERSION, 'feature_columns': self.feature_columns,
+                'feature_version': self.feature_version, 'segments': self.segments}
+        # Replace the manifest in one step, so an interrupted save leaves the previous manifest
+        tmp = os.path.join(self.path, TrainingStore.MANIFEST + '.tmp')
+        json.dump(data, codecs.open(tmp, 'w', encoding='utf-8'), separators=(',', ':'), sort_keys=True, indent=1)
+        os.replace(tmp, os.path.join(self.path, TrainingStore.MANIFEST))
+
+    def _check_compatible(self, other):
+        if other.feature_columns != self.feature_columns or other.feature_version != self.feature_version:
+            raise ValueError('The training store {} has features {} (version {}), but {} has {} (version {})'.format(
+                other.path, other.feature_columns, other.feature_version, self.path, self.feature_columns,
+                self.feature_version))
+
+    def _add_segment(self, samples, image_hash, image_name):
+        # Returns False if the same samples are already stored
+        name = hashlib.sha1(image_hash.encode() + samples.tobytes()).hexdigest()[:16] + '.npy'
+        if any(segment['file'] == name for segment in self.segments):
+            return False
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        np.save(os.path.join(self.path, name), samples)
+        self.segments.append({'file': name, 'image_hash': image_hash, 'image_name': image_name,
+                              'n_samples': len(samples)})
+        return True
+
+    def append(self, features, states, roi_nums, image_hash, image_name=''):
+        # Adds one annotation session. Only fibers with state 1 or 2 are stored.
+        features = np.asarray(features)
+        states = np.asarray(states)
+        if features.ndim != 2 or features.shape[1] != len(self.feature_columns):
+            raise ValueError('Expected features with {} columns ({}), got shape {}'.format(
+                len(self.feature_columns), ', '.join(self.feature_columns), features.shape))
+        labeled = (states == 1) | (states == 2)
+        samples = np.zeros(np.count_nonzero(labeled), dtype=self.get_dtype())
+        samples['features'] = features[labeled]
+        samples['state'] = states[labeled]
+        samples['roi'] = np.asarray(roi_nums)[labeled]
+        if self._add_segment(samples, image_hash, image_name):
+            self._write_manifest()
+
+    def merge(self, other):
+        # Adds every session of other that is not already stored. Returns the number of sessions added.
+        if not isinstance(other, TrainingStore):
+            other = TrainingStore(other)
+        self._check_compatible(other)
+        added = 0
+        for segment in other.segments:
+            if not any(s['file'] == segment['file'] for s in self.segments):
+                if not os.path.isdir(self.path):
+                    os.makedirs(self.path)
+                shutil.copyfile(os.path.join(other.path, segment['file']), os.path.join(self.path, segment['file']))
+                self.segments.append(dict(segment))
+                added += 1
+        if added:
+            self._write_manifest()
+        return added
+
+    def load_segment(self, segment):
+        return np.load(os.path.join(self.path, segment['file']), mmap_mode='r')
+
+    def get_samples(self, deduplicate=True):
+        # Returns (features, states, roi_nums, image_hashes) of all samples, in the order they were stored. With
+        # deduplicate, only the latest sample of each fiber of each image is kept.
+        segments = [self.load_segment(segment) for segment in self.segments]
+        lengths = [len(segment) for segment in segments]
+        # Index of the image of every sample in image_hashes
+        image_hashes, segment_images = np.unique([segment['image_hash'] for segment in self.segments] or [''],
+                                                 return_inverse=True)
+        image_index = np.repeat(segment_images[:len(segments)], lengths).astype(np.int64)
+        # Only the ROI numbers of every segment are read to find the samples to keep
+        rois = np.concatenate([segment['roi'] for segment in segments]) if segments else np.zeros(0, dtype=np.int32)
+        keep = np.arange(len(rois))
+        if deduplicate and len(rois) > 0:
+            keys = image_index * (int(np.max(rois)) + 1) + rois
+            # np.unique returns the first occurrence, so search the samples from the latest to the earliest
+            _, last = np.unique(keys[::-1], return_index=True)
+            keep = np.sort(len(keys) - 1 - last)
+        # The kept features and states are copied from each segment straight into the output
+        features = np.empty((len(keep), len(self.feature_columns)), dtype=np.float32)
+        states = np.empty(len(keep), dtype=np.uint8)
+        bounds = np.r_[0, np.cumsum(lengths)].astype(np.int64)
+        for segment, start, stop in zip(segments, bounds[:-1], bounds[1:]):
+            lo, hi = np.searchsorted(keep, [start, stop])
+            rows = keep[lo:hi] - start
+            features[lo:hi] = segment['features'][rows]
+            states[lo:hi] = segment['state'][rows]
+        return features, states, rois[keep], image_hashes[image_index[keep]]
+
+    def get_training_data(self):
+        # x, y as returned by classification.load_training_data. y is 1 for fibers and 0 otherwise.
+        features, states, _, _ = self.get_samples()
+        return features.astype(np.float64), np.where(states == 1, 1, 0)
+
+
+def main(argv=None):
+    args = sys.argv[1:] if argv is None else argv
+    if len(args) >= 3 and args[0] == 'merge':
+        store = TrainingStore(args[1])
+        for source in args[2:]:
+            print('{}: {} sessions added'.format(source, store.merge(source)))
+    elif len(args) == 2 and args[0] == 'info':
+        store = TrainingStore(args[1])
+        features, _, _, image_hashes = store.get_samples()
+        print('{} sessions, {} images, {} samples ({} after removing duplicates)'.format(
+            len(store.segments), len(set(image_hashes)), len(store), len(features)))
+        print('features: {} (version {})'.format(', '.join(store.feature_columns), store.feature_version))
+    else:
+        print(__doc__)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+Background execution of long stages.
+
+A Job runs a function in a pool of worker threads, so the GUI thread stays free to redraw and respond. The function
+reports how far it is, and finds out whether it was cancelled, through a Progress, which is safe to share between
+threads. The GUI polls the progress of its jobs with a timer (quantimus.Quantimus.run_in_background) instead of
+pumping events from inside the computation.
+
+Functions that take a callback, like segmentation.fill_boundaries and classification.Classifier.predict, are given
+progress.get_callback(...). Every call of the callback advances the progress and raises Cancelled once the job was
+cancelled, so cancellation takes effect at the next step of the computation. Nothing in this module needs Qt.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Progress:
+    """
+    Fraction of a job that is done, a message describing the current step, and whether the job was cancelled.
+    The worker writes it and the GUI reads it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fraction = 0.
+        self._message = ''
+        self._cancelled = threading.Event()
+
+    def get(self):
+        # (fraction, message)
+        with self._lock:
+            return self._fraction, self._message
+
+    def set(self, fraction, message=None):
+        # Raises Cancelled if the job was cancelled
+        self.check()
+        with self._lock:
+            self._fraction = min(max(fraction, 0.), 1.)
+            if message is not None:
+                self._message = message
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        if self._cancelled.is_set():
+            raise Cancelled()
+
+    def get_callback(self, n_steps, start=0., stop=1., message=None):
+        # Callback for a computation of n_steps steps, covering the progress from start to stop. Each call without an
+        # argument is one step. A call with a fraction sets the fraction of the steps that are done.
+        steps = [0]
+        if message is not None:
+            self.set(start, message)
+
+        def callback(fraction=None):
+            if fraction is None:
+                steps[0] += 1
+                fraction = steps[0] / max(n_steps, 1)
+            self.set(start + (stop - start) * min(fraction, 1.))
+        return callback
+
+
+# Number of jobs that can run at once
+MAX_WORKERS = os.cpu_count() or 1
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    # The worker pool, created the first time a job is submitted
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(MAX_WORKERS, thread_name_prefix='quantimus')
+        return _executor
+
+
+class Job:
+    """
+    func(*args, progress=progress, **kwargs) running in the worker pool.
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self.progress = Progress()
+        self.future = get_executor().submit(self._run, func, args, kwargs)
+
+    def _run(self, func, args, kwargs):
+        result = func(*args, progress=self.progress, **kwargs)
+        self.progress.set(1.)
+        return result
+
+    def cancel(self):
+        # Cooperative. A running job stops at its next progress update.
+        self.progress.cancel()
+        self.future.cancel()
+
+    def done(self):
+        return self.future.done()
+
+    def cancelled(self):
+        if self.future.cancelled():
+            return True
+        return self.future.done() and isinstance(self.future.exception(), Cancelled)
+
+    def result(self, timeout=None):
+        # The return value of func. Raises Cancelled if the job was cancelled, or the exception raised by func.
+        try:
+            return self.future.result(timeout)
+        except CancelledError:
+            raise Cancelled()